@@ -0,0 +1,61 @@
+"""
+Checks that a set of shard manifests (written by e.g. files_to_vw.py
+--shard_manifest) cover every shard exactly once, and optionally that
+together they cover the same documents as a reference manifest.
+"""
+import argparse
+import sys
+
+from declass.utils import common
+
+
+def _cli():
+    # Text to display after help
+    epilog = """
+    EXAMPLES
+
+    Check the 4 shards of mydir against a manifest of the unsharded run
+    $ python check_shards.py mydir-0.json mydir-1.json mydir-2.json \\
+        mydir-3.json --reference mydir-all.json
+    """
+    parser = argparse.ArgumentParser(
+        description=globals()['__doc__'], epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        'manifests', nargs='+',
+        help='Paths to the shard manifests.')
+    parser.add_argument(
+        '--reference',
+        help='Path to a manifest of the whole corpus.')
+
+    # Parse and check args
+    args = parser.parse_args()
+
+    # Call the module interface
+    try:
+        combined = check(args.manifests, args.reference)
+    except ValueError as e:
+        sys.stderr.write('FAILED:  %s\n' % e)
+        sys.exit(1)
+
+    sys.stdout.write(
+        'OK:  %d shards, %d documents\n'
+        % (len(args.manifests), combined.num_docs))
+
+
+def check(manifest_paths, reference_path=None):
+    """
+    Load manifests and check them with common.check_shard_manifests.
+    """
+    manifests = [common.ShardManifest.load(path) for path in manifest_paths]
+    if reference_path is not None:
+        reference = common.ShardManifest.load(reference_path)
+    else:
+        reference = None
+
+    return common.check_shard_manifests(manifests, reference=reference)
+
+
+if __name__ == '__main__':
+    _cli()
@@ -0,0 +1,52 @@
+"""
+Merges the segments written by files_to_vw.py --incremental into one sfile,
+keeping the latest record of every document and dropping deleted ones.
+"""
+import argparse
+import sys
+
+from declass.utils import text_processors
+
+
+def _cli():
+    # Text to display after help
+    epilog = """
+    EXAMPLES
+
+    Write the current corpus to mydir.vw
+    $ python compact_segments.py mydir-segments -o mydir.vw
+
+    Also replace the segments by a single compacted segment
+    $ python compact_segments.py mydir-segments -o mydir.vw --in_place
+    """
+    parser = argparse.ArgumentParser(
+        description=globals()['__doc__'], epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        'segment_dir', help='Directory given to files_to_vw.py --incremental')
+    parser.add_argument(
+        '-o', '--outfile', default=sys.stdout, type=argparse.FileType('w'),
+        help='Write to OUT_FILE rather than sys.stdout.')
+    parser.add_argument(
+        '--in_place', action='store_true', default=False,
+        help="Replace the segments in SEGMENT_DIR by one compacted segment.")
+
+    # Parse and check args
+    args = parser.parse_args()
+
+    # Call the module interface
+    compact(args.segment_dir, args.outfile, in_place=args.in_place)
+
+
+def compact(segment_dir, outfile, in_place=False):
+    """
+    Write the compacted segments in segment_dir to outfile.  See _cli.
+    """
+    num_docs = text_processors.SFileSegments(segment_dir).compact(
+        outfile, in_place=in_place)
+    sys.stderr.write('Wrote %d documents\n' % num_docs)
+
+
+if __name__ == '__main__':
+    _cli()
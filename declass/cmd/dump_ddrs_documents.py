@@ -2,11 +2,29 @@
 Dump the DDRS Documents to flat files.
 """
 import argparse
+import os
+
 import declass.ddrs as ddrs
+import declass.utils.filefilter as ff
+from declass.utils.streamers import DBStreamer
+
 
 def _cli():
+    # Text to display after help
+    epilog = """
+    EXAMPLES
+
+    Write raw, clean and nofoot versions of every document in one pass over
+    the database, with 4 processes cleaning and writing
+    $ python dump_ddrs_documents.py -s db -o ddrs/ --output_spec raw,clean,nofoot \\
+        --n_jobs 4
+
+    Restart an interrupted dump, skipping documents already written
+    $ python dump_ddrs_documents.py -s db -o ddrs/ --output_spec raw,clean,nofoot \\
+        --n_jobs 4 --resume
+    """
     parser = argparse.ArgumentParser(
-        description=globals()['__doc__'],
+        description=globals()['__doc__'], epilog=epilog,
         formatter_class=argparse.RawDescriptionHelpFormatter)
 
     parser.add_argument(
@@ -27,27 +45,89 @@ def _cli():
 
     parser.add_argument(
         '--output_spec', required=True,
-        help="""Specifies the format to write out the files.
+        help="""Specifies the format to write out the files.  Give a comma
+            separated list (e.g. raw,clean,nofoot) to write several formats
+            in one pass.
             clean -> Remove all the formatting.
             nofoot -> Remove all the formatting and footers.
             raw -> Original text with markup.""")
+
+    parser.add_argument(
+        '--resume', action='store_true', default=False,
+        help='Skip documents with every output_spec already in outdir.')
+
+    parser.add_argument(
+        '--n_jobs', type=int, default=1,
+        help='Clean and write files with N_JOBS processes.  -1 means all '
+        'available CPUs.  [default: %(default)s]')
+
+    parser.add_argument(
+        '--chunksize', type=int, default=100,
+        help='Send CHUNKSIZE documents to a process at a time.  '
+        '[default: %(default)s]')
+
+    parser.add_argument(
+        '--batch_size', type=int, default=1000,
+        help='With -s db, fetch BATCH_SIZE rows per query.  '
+        '[default: %(default)s]')
     args = parser.parse_args()
 
-    dbCon = ddrs.make_db_connect()
+    output_specs = args.output_spec.split(',')
+    # Ids already written are dropped here, before any text is read, so
+    # write_documents need not scan outdir again
+    done = ddrs.get_written_ids(
+        args.outdir, output_specs) if args.resume else None
     if args.source == "db":
-        query = "SELECT id, body FROM Document"
-        if args.limit:
-            query += " LIMIT %d" % args.limit
-        rows = dbCon.run_query(query)
-        documents = (ddrs.Document(row["id"], row["body"])
-                     for row in rows)
+        dbCon = ddrs.make_db_connect()
+        streamer = DBStreamer(
+            dbCon, table='Document', limit=args.limit,
+            batch_size=args.batch_size, skip_empty_text=False)
+        rows = _iter_db_rows(streamer, done=done)
     elif args.source == "file":
-        documents = ddrs.Document.fetch_from_files(args.indir)
-        
-    ddrs.Document.write_to_files(args.outdir, documents, args.output_spec)
+        rows = _iter_raw_files(args.indir, args.limit, done=done)
+    else:
+        raise ValueError("source %s not recognized." % args.source)
 
+    ddrs.write_documents(
+        args.outdir, rows, output_specs, n_jobs=args.n_jobs,
+        chunksize=args.chunksize)
 
-if __name__ == '__main__':
-    _cli()
 
+def _iter_db_rows(streamer, done=None):
+    """
+    Returns an iterator over (id, unformatted_text) of the rows of streamer.
+    If done (a set of ids as strings) is given, those ids are dropped before
+    any text is fetched from the database.
+    """
+    if done is None:
+        info_iter = streamer.info_stream()
+    else:
+        # Read every id before fetching text:  the id query streams through
+        # an unbuffered cursor, which must be exhausted before the
+        # connection runs another query.
+        doc_ids = [
+            doc_id for doc_id in streamer.doc_id_stream()
+            if str(doc_id) not in done]
+        info_iter = streamer.info_stream(doc_id=doc_ids)
+
+    for info in info_iter:
+        yield info['doc_id'], info['text']
 
+
+def _iter_raw_files(directory, limit=None, done=None):
+    """
+    Returns an iterator over (id, unformatted_text) of the *.raw.txt files in
+    directory, skipping ids in done (a set of ids as strings).
+    """
+    path_iter = ff.get_paths(
+        directory, file_type="*.raw.txt", limit=limit, get_iter=True)
+    for path in path_iter:
+        id = os.path.basename(path).split('.')[0]
+        if (done is not None) and (id in done):
+            continue
+        with open(path) as in_doc:
+            yield id, in_doc.read()
+
+
+if __name__ == '__main__':
+    _cli()
@@ -4,14 +4,18 @@ Tokens are represented in Vowpal Wabbit format.
 """
 import argparse
 from functools import partial
+import hashlib
+from multiprocessing import Pool
+import os
 import sys
+from time import time
 from collections import Counter
-from random import shuffle
+from itertools import imap
+import random
 
-from declass.utils import filefilter, text_processors, nlp
+from declass.utils import common, filefilter, text_processors, nlp
 from declass.utils.common import SaveLoad
 
-from parallel_easy.base import imap_easy
 
 
 def _cli():
@@ -28,6 +32,31 @@ def _cli():
     Convert the first 10 files in mydir/ to vw format 
     $ find mydir/ -type f | head | python files_to_vw.py
 
+    Convert the files inside a tarball, without extracting it, using 4 jobs
+    $ python files_to_vw.py --archive cables.tar.gz --n_jobs 4 -o cables.vw
+
+    Start writing at once, holding only 10000 paths in memory, then shuffle
+    the output fully on disk
+    $ python files_to_vw.py --base_path=mydir --shuffle_buffer 10000 \
+        | python shuffle_sfile.py > mydir.vw
+
+    Tokenize only what changed in mydir/ since last week
+    $ python files_to_vw.py --base_path=mydir --incremental mydir-segments
+    $ python compact_segments.py mydir-segments -o mydir.vw
+
+    Convert all files in mydir/, resuming if a previous run was interrupted
+    $ python files_to_vw.py --base_path=mydir --n_jobs 8 \
+        --checkpoint_dir mydir-ckpt -o mydir.vw
+
+    Write one file per year, using the year column of meta.csv
+    $ python files_to_vw.py --base_path=mydir --partition key \
+        --partition_meta meta.csv --partition_key year \
+        --partition_template 'mydir-{}.vw' --compress gz
+
+    On node 2 of 4, convert only the files with doc_id in shard 2/4
+    $ python files_to_vw.py --base_path=mydir --shard 2/4 \
+        --shard_manifest mydir-2.json -o mydir-2.vw
+
     The supported Vowpal Wabbit format is 
     [target] [Importance [Tag]]| feature1[:value1] feature2[:value2] ...
     See: https://github.com/JohnLangford/vowpal_wabbit/wiki/Input-format
@@ -44,6 +73,11 @@ def _cli():
         'paths', nargs='*',
         help='Convert files in this space separated list.  If not specified,'
         ' use base_path or read paths from stdin.')
+    io_grp.add_argument(
+        '--archive', dest='archives', action='append',
+        help="Convert the files inside this .tar, .tar.gz, .tar.bz2 or .zip "
+        "archive, reading it sequentially without extraction.  doc_id is "
+        "formed from member names as with --doc_id_level.  May be repeated.")
     io_grp.add_argument(
         '-o', '--outfile', dest='outfile', default=sys.stdout,
         type=argparse.FileType('w'),
@@ -53,10 +87,74 @@ def _cli():
         help='Form the record doc_id using items this far back in the path'
         ' e.g. if doc_id_level == 2, and path = mydata/1234/3.txt, then we '
         'will have doc_id = 1234_3.  [default: %(default)s]')
+    io_grp.add_argument(
+        '--path_manifest',
+        help="With --base_path, keep a manifest of the directory tree (path, "
+        "size, mtime) here.  Later runs re-list only changed directories.")
+    io_grp.add_argument(
+        '--shuffle_buffer', type=int, default=0,
+        help="With --base_path, rather than listing and shuffling every path "
+        "before starting, shuffle lazily with a buffer of SHUFFLE_BUFFER "
+        "paths.  Output starts at once and memory is bounded, but the order "
+        "is only partially random (pipe through shuffle_sfile.py for a full "
+        "shuffle).")
+    io_grp.add_argument(
+        '--incremental',
+        help="With --base_path, keep the output as segments in the directory "
+        "INCREMENTAL.  Each run tokenizes only files added or modified since "
+        "the last run (new segment), and lists the doc_id of deleted files "
+        "(tombstones).  Merge the segments with compact_segments.py.  "
+        "OUTFILE is not used.")
+    io_grp.add_argument(
+        '--use_hash', action='store_true', default=False,
+        help="With --incremental, skip files whose size or mtime changed but "
+        "whose content (md5) did not.")
     io_grp.add_argument(
         '--no_shuffle', action='store_true', default=False,
         help="Unless this flag is given, paths denoted by --base_path will be "
         "read in random order.")
+    io_grp.add_argument(
+        '--seed', type=int,
+        help="Seed the random order of --base_path paths, so that runs are "
+        "reproducible.")
+
+    shard_grp = parser.add_argument_group('Sharding group')
+    shard_grp.add_argument(
+        '--shard', type=common.parse_shard,
+        help="Given K/N, convert only documents whose doc_id hashes to shard K"
+        " of N (0 <= K < N).  Nodes given 0/N,...,(N-1)/N write disjoint "
+        "parts of the corpus.")
+    shard_grp.add_argument(
+        '--shard_manifest',
+        help="Write a JSON manifest (shard, number of documents, doc_id "
+        "checksums) to this path.  Check a set of these with check_shards.py")
+
+    part_grp = parser.add_argument_group('Partitioning group')
+    part_grp.add_argument(
+        '--partition', choices=['roundrobin', 'hash', 'key'],
+        help="Rather than OUT_FILE, write to partition files named by "
+        "--partition_template.  roundrobin/hash:  NUM_PARTITIONS files, "
+        "records dealt in turn, or by doc_id hash (as with shards).  key:  "
+        "one file per value of column PARTITION_KEY of PARTITION_META.")
+    part_grp.add_argument(
+        '--partition_template',
+        help="Partition paths, with {} replaced by the partition, e.g. "
+        "'cables-{}.vw'.")
+    part_grp.add_argument(
+        '--num_partitions', type=int,
+        help="Number of partitions for --partition roundrobin or hash.")
+    part_grp.add_argument(
+        '--partition_meta',
+        help="Metadata file with a doc_id column, e.g. meta.csv.")
+    part_grp.add_argument(
+        '--partition_key',
+        help="Partition by this column of PARTITION_META, e.g. year.")
+    part_grp.add_argument(
+        '--meta_sep', default='|',
+        help="Delimiter of PARTITION_META.  [default: %(default)s]")
+    part_grp.add_argument(
+        '--compress', choices=['gz'],
+        help="Compress the partition files.")
 
     tok_grp = parser.add_mutually_exclusive_group(required=False)
     tok_grp.add_argument(
@@ -76,6 +174,22 @@ def _cli():
         '--chunksize', type=int, default=1000, 
         help="Have workers process CHUNKSIZE files at a time.  "
         "[default: %(default)s]")
+    perf_grp.add_argument(
+        '--report', action='store_true', default=False,
+        help="Print the time to the first record, the total time, and the "
+        "peak memory use to stderr.")
+    perf_grp.add_argument(
+        '--crawl_threads', type=int, default=1,
+        help="With --base_path, list directories in CRAWL_THREADS threads.  "
+        "[default: %(default)s]")
+    perf_grp.add_argument(
+        '--checkpoint_dir',
+        help="Record progress in CHECKPOINT_DIR, writing every chunk to a "
+        "sealed segment file there.  If the run is interrupted, rerun the "
+        "same command to resume with the unfinished chunks.  The segments "
+        "are concatenated to the output (and CHECKPOINT_DIR removed) at the "
+        "end.  Must not be inside --base_path.  Not supported with "
+        "--archive.")
         
 
     # Parse and check args
@@ -86,46 +200,308 @@ def _cli():
     if args.tokenizer_pickle is not None:
         args.tokenizer_type = None
 
-    if args.base_path:
+    if args.base_path or args.archives:
         assert args.paths == []
+        assert not (args.base_path and args.archives)
     elif args.paths == []:
         args.paths = sys.stdin
 
+    if args.partition:
+        assert args.partition_template, "--partition needs --partition_template"
+        args.outfile = common.PartitionedWriter(
+            args.partition_template, common.get_partitioner(
+                args.partition, num_partitions=args.num_partitions,
+                meta_path=args.partition_meta, key=args.partition_key,
+                sep=args.meta_sep),
+            compress=args.compress)
+
     # Call the module interface
     tokenize(
         args.outfile, args.paths, args.base_path, args.no_shuffle,
         args.tokenizer_type, args.tokenizer_pickle, args.doc_id_level,
-        args.n_jobs, args.chunksize)
+        args.n_jobs, args.chunksize, shard=args.shard,
+        shard_manifest=args.shard_manifest, archives=args.archives,
+        checkpoint_dir=args.checkpoint_dir, crawl_threads=args.crawl_threads,
+        path_manifest=args.path_manifest, incremental=args.incremental,
+        use_hash=args.use_hash, shuffle_buffer=args.shuffle_buffer,
+        report=args.report, seed=args.seed)
+    if args.partition:
+        args.outfile.close()
 
 
 def tokenize(
     outfile, paths, base_path, no_shuffle, tokenizer_type, tokenizer_pickle,
-    doc_id_level, n_jobs, chunksize):
+    doc_id_level, n_jobs, chunksize, shard=None, shard_manifest=None,
+    archives=None, checkpoint_dir=None, crawl_threads=1, path_manifest=None,
+    incremental=None, use_hash=False, shuffle_buffer=0, report=False,
+    seed=None):
     """
     Write later if module interface is needed. See _cli for the documentation.
     """
+    start_time = time()
+
+    if incremental is not None:
+        assert base_path is not None, "incremental requires base_path"
+        assert (archives, checkpoint_dir, shard, shard_manifest) == (
+            None, None, None, None)
+        return tokenize_incremental(
+            incremental, base_path, _get_tokenizer(
+                tokenizer_type, tokenizer_pickle),
+            doc_id_level, n_jobs, chunksize, crawl_threads=crawl_threads,
+            use_hash=use_hash)
+
     assert (paths == []) or (base_path is None)
+    assert (archives is None) or ((paths == []) and (base_path is None))
+    assert (archives is None) or (checkpoint_dir is None)
 
     if base_path:
-        paths = filefilter.get_paths(base_path, file_type='*', get_iter=True)
-        if no_shuffle is False:
+        get_paths = partial(
+            _crawl_paths, base_path, no_shuffle, shuffle_buffer, seed,
+            crawl_threads, path_manifest)
+    else:
+        get_paths = lambda: paths
+
+    if checkpoint_dir is not None:
+        checkpoint = common.Checkpoint(
+            checkpoint_dir, config={
+                'base_path': base_path,
+                'outfile': common.get_outfile_name(outfile),
+                'doc_id_level': doc_id_level, 'shard': shard,
+                'tokenizer_type': tokenizer_type,
+                'tokenizer_pickle': tokenizer_pickle})
+        # On a restart, use the (shuffled) paths saved by the first run,
+        # without crawling again
+        paths = checkpoint.get_items(get_paths)
+    else:
+        paths = get_paths()
+
+    manifest = None
+    if (shard is not None) or (shard_manifest is not None):
+        manifest = common.ShardManifest(shard if shard else (0, 1))
+        if archives is None:
+            paths = _shard_paths(paths, doc_id_level, manifest)
+
+    tokenizer = _get_tokenizer(tokenizer_type, tokenizer_pickle)
+
+    formatter = text_processors.VWFormatter()
+
+    if checkpoint_dir is not None:
+        checkpoint.run(
+            _worker_tokenize_chunk, list(paths), outfile,
+            chunksize=chunksize, n_jobs=n_jobs, initializer=_init_worker,
+            initargs=(tokenizer, formatter, doc_id_level))
+        if shard_manifest is not None:
+            manifest.save(shard_manifest)
+        checkpoint.remove()
+        return
+
+    # Workers get the tokenizer once, from _init_worker.  Items are not read
+    # ahead more than needed, so memory stays bounded (e.g. by the shuffle
+    # buffer).
+    if archives is not None:
+        # Members are read here, in one pass, and tokenized by the workers
+        func = _worker_tokenize_texts
+        items = _archive_docs(archives, doc_id_level, manifest)
+    else:
+        func = _worker_tokenize_chunk
+        items = paths
+    results_iterator = _bounded_imap_chunks(
+        func, items, n_jobs, chunksize, initializer=_init_worker,
+        initargs=(tokenizer, formatter, doc_id_level))
+
+    first_time = None
+    num_records = 0
+    for result in results_iterator:
+        if first_time is None:
+            first_time = time() - start_time
+        outfile.write(result + '\n')
+        num_records += 1
+
+    if shard_manifest is not None:
+        manifest.save(shard_manifest)
+
+    if report:
+        sys.stderr.write(
+            "Wrote %d records.  First record after %.2fs, total %.2fs.  "
+            "Peak memory %.0fMB (workers %.0fMB)\n" % (
+                num_records, first_time if first_time else 0,
+                time() - start_time, common.peak_rss_mb(),
+                common.peak_rss_mb(children=True)))
+
+
+def _crawl_paths(
+    base_path, no_shuffle, shuffle_buffer, seed, crawl_threads,
+    path_manifest):
+    """
+    Return the paths under base_path, in random order unless no_shuffle.
+    """
+    paths = filefilter.get_paths(
+        base_path, file_type='*', get_iter=True, n_threads=crawl_threads,
+        manifest=path_manifest)
+    if no_shuffle is False:
+        if shuffle_buffer:
+            paths = common.buffered_shuffle(paths, shuffle_buffer, seed=seed)
+        else:
             paths = list(paths)
-            shuffle(paths)
+            random.Random(seed).shuffle(paths)
+
+    return paths
+
 
+def _bounded_imap_chunks(
+    func, items, n_jobs, chunksize, initializer=None, initargs=()):
+    """
+    Yield the results of func(chunk) for chunks of items, concatenated and in
+    order, with at most 2 * n_jobs chunks in flight.  If given, every worker
+    (or this process if n_jobs == 1) first calls initializer(*initargs).
+    """
+    n_jobs = common.get_num_jobs(n_jobs)
+    chunks = common.chunker(items, chunksize)
+    if n_jobs == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for results in imap(func, chunks):
+            for result in results:
+                yield result
+        raise StopIteration
+
+    pool = Pool(n_jobs, initializer, initargs)
+    try:
+        for results in common.bounded_imap(pool, func, chunks, 2 * n_jobs):
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# The tokenizer, formatter and doc_id_level of a worker.  Set once per worker
+# by _init_worker, rather than pickled with every chunk.
+_worker_state = {}
+
+
+def _init_worker(tokenizer, formatter, doc_id_level):
+    _worker_state['args'] = (tokenizer, formatter, doc_id_level)
+
+
+def _worker_tokenize_chunk(paths):
+    tokenizer, formatter, doc_id_level = _worker_state['args']
+
+    return _tokenize_chunk(tokenizer, formatter, doc_id_level, paths)
+
+
+def _worker_tokenize_texts(docs):
+    tokenizer, formatter, doc_id_level = _worker_state['args']
+
+    return [_tokenize_text(tokenizer, formatter, doc) for doc in docs]
+
+
+def _get_tokenizer(tokenizer_type, tokenizer_pickle):
     if tokenizer_pickle is not None:
-        tokenizer = SaveLoad.load(tokenizer_pickle)
+        return SaveLoad.load(tokenizer_pickle)
     else:
         tokenizer_dict = {'basic': text_processors.TokenizerBasic}
-        tokenizer = tokenizer_dict[tokenizer_type]()
+        return tokenizer_dict[tokenizer_type]()
+
+
+def tokenize_incremental(
+    incremental_dir, base_path, tokenizer, doc_id_level, n_jobs, chunksize,
+    crawl_threads=1, use_hash=False):
+    """
+    Add a segment to the text_processors.SFileSegments in incremental_dir
+    holding the files in base_path that were added or modified since the
+    last call, and tombstones for the files that were deleted.
+
+    Changes are found by comparing the (size, mtime) of every file, as stat'ed
+    by the PathManifest update (with restat_files, so files modified in place
+    are caught), with those recorded by the last segment.
+
+    Returns
+    -------
+    num_changed, num_deleted : Integers
+    """
+    segments = text_processors.SFileSegments(incremental_dir)
+    old_files = segments.load_files()
+    manifest = filefilter.PathManifest.update(
+        os.path.join(incremental_dir, 'tree.manifest'), base_path,
+        n_threads=crawl_threads, restat_files=True)
+
+    files = {}
+    changed = []
+    for path, size, mtime in manifest.iter_files():
+        old = old_files.get(path)
+        if (old is not None) and (old[:2] == (size, mtime)):
+            files[path] = old
+            continue
+        md5 = _md5(path) if use_hash else None
+        files[path] = (size, mtime, md5)
+        if (old is None) or (md5 is None) or (old[2] != md5):
+            changed.append(path)
+
+    tombstones = [
+        filefilter.path_to_newname(path, name_level=doc_id_level)
+        for path in old_files if path not in files]
 
     formatter = text_processors.VWFormatter()
+    records = _bounded_imap_chunks(
+        _worker_tokenize_chunk, changed, n_jobs, chunksize,
+        initializer=_init_worker,
+        initargs=(tokenizer, formatter, doc_id_level))
+    segments.add_segment(records, tombstones, files)
 
-    func = partial(_tokenize_one, tokenizer, formatter, doc_id_level)
+    return len(changed), len(tombstones)
 
-    results_iterator = imap_easy(func, paths, n_jobs, chunksize)
 
-    for result in results_iterator:
-        outfile.write(result + '\n')
+def _md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), ''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def _shard_paths(paths, doc_id_level, manifest):
+    """
+    Yield the paths whose doc_id is in manifest.shard, adding them to manifest.
+    """
+    for path in paths:
+        doc_id = filefilter.path_to_newname(
+            path.strip(), name_level=doc_id_level)
+        if common.in_shard(doc_id, manifest.shard):
+            manifest.add(doc_id)
+            yield path
+
+
+def _archive_docs(archives, doc_id_level, manifest=None):
+    """
+    Yield (doc_id, text) for the files in archives.  If manifest is given,
+    yield only documents in manifest.shard, adding them to manifest.
+    """
+    for archive in archives:
+        for name, text in filefilter.iter_archive(archive):
+            doc_id = filefilter.path_to_newname(name, name_level=doc_id_level)
+            if manifest is not None:
+                if not common.in_shard(doc_id, manifest.shard):
+                    continue
+                manifest.add(doc_id)
+            yield doc_id, text
+
+
+def _tokenize_text(tokenizer, formatter, doc):
+    """
+    Tokenize doc = (doc_id, text).  Return results in a sparse format.
+    """
+    doc_id, text = doc
+    feature_values = tokenizer.text_to_counter(text)
+
+    return formatter.get_sstr(feature_values, importance=1, doc_id=doc_id)
+
+
+def _tokenize_chunk(tokenizer, formatter, doc_id_level, paths):
+    return [
+        _tokenize_one(tokenizer, formatter, doc_id_level, path)
+        for path in paths]
 
 
 def _tokenize_one(tokenizer, formatter, doc_id_level, path):
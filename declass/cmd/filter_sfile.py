@@ -4,6 +4,7 @@ Filters an sfile, reading from a file or stdin, writing to a file or stdout.
 import argparse
 import sys
 
+from declass.utils import common
 from declass.utils.text_processors import SFileFilter
 
 
@@ -15,6 +16,15 @@ def _cli():
     Read from stdin, write to stdout and pipe to vw
     head myfile.vw | python filter_sfile.py -s saved_sfile_filter.pkl \
         | vw --lda 5
+
+    Write BM25 weighted, l2 normalized features
+    python filter_sfile.py -s saved_sfile_filter.pkl --weighting bm25 \
+        --normalize l2 myfile.vw > myfile-bm25.vw
+
+    Write 8 gzipped hash partitions, myfile-0.vw.gz,...,myfile-7.vw.gz
+    python filter_sfile.py -s saved_sfile_filter.pkl --partition hash \
+        --num_partitions 8 --partition_template 'myfile-{}.vw' --compress gz \
+        myfile.vw
     """
     parser = argparse.ArgumentParser(
         description=globals()['__doc__'], epilog=epilog,
@@ -30,18 +40,75 @@ def _cli():
         '-s', '--sfile_filter', required=True,
         help='Load a pickled sfile_filter from this path')
 
+    weight_grp = parser.add_argument_group('Weighting group')
+    weight_grp.add_argument(
+        '--weighting', choices=['tfidf', 'sublinear_tf', 'bm25'],
+        help="Reweight the feature values.  If not given, write raw counts.")
+    weight_grp.add_argument(
+        '--normalize', choices=['l1', 'l2'],
+        help="Normalize every record to unit length in this norm.")
+    weight_grp.add_argument(
+        '--bm25_k1', type=float, default=1.2,
+        help="BM25 term frequency saturation.  [default: %(default)s]")
+    weight_grp.add_argument(
+        '--bm25_b', type=float, default=0.75,
+        help="BM25 length normalization.  [default: %(default)s]")
+
+    part_grp = parser.add_argument_group('Partitioning group')
+    part_grp.add_argument(
+        '--partition', choices=['roundrobin', 'hash', 'key'],
+        help="Rather than OUT_FILE, write to partition files named by "
+        "--partition_template.  roundrobin/hash:  NUM_PARTITIONS files, "
+        "records dealt in turn, or by doc_id hash (as with shards).  key:  "
+        "one file per value of column PARTITION_KEY of PARTITION_META.")
+    part_grp.add_argument(
+        '--partition_template',
+        help="Partition paths, with {} replaced by the partition, e.g. "
+        "'cables-{}.vw'.")
+    part_grp.add_argument(
+        '--num_partitions', type=int,
+        help="Number of partitions for --partition roundrobin or hash.")
+    part_grp.add_argument(
+        '--partition_meta',
+        help="Metadata file with a doc_id column, e.g. meta.csv.")
+    part_grp.add_argument(
+        '--partition_key',
+        help="Partition by this column of PARTITION_META, e.g. year.")
+    part_grp.add_argument(
+        '--meta_sep', default='|',
+        help="Delimiter of PARTITION_META.  [default: %(default)s]")
+    part_grp.add_argument(
+        '--compress', choices=['gz'],
+        help="Compress the partition files.")
+
     # Parse and check args
     args = parser.parse_args()
 
+    if args.partition:
+        assert args.partition_template, "--partition needs --partition_template"
+        args.outfile = common.PartitionedWriter(
+            args.partition_template, common.get_partitioner(
+                args.partition, num_partitions=args.num_partitions,
+                meta_path=args.partition_meta, key=args.partition_key,
+                sep=args.meta_sep),
+            compress=args.compress)
+
     # Call the module interface
-    do_filter(args.infile, args.outfile, args.sfile_filter)
+    do_filter(
+        args.infile, args.outfile, args.sfile_filter, weighting=args.weighting,
+        normalize=args.normalize, bm25_k1=args.bm25_k1, bm25_b=args.bm25_b)
+    if args.partition:
+        args.outfile.close()
 
 
-def do_filter(infile, outfile, sfile_filter):
+def do_filter(infile, outfile, sfile_filter, **kwargs):
+    """
+    Load a pickled SFileFilter and filter infile.  kwargs are passed to
+    SFileFilter.filter_sfile.
+    """
     sfile_filter = SFileFilter.load(sfile_filter)
-    sfile_filter.filter_sfile(infile, outfile)
+    sfile_filter.filter_sfile(infile, outfile, **kwargs)
 
 
 if __name__ == '__main__':
     _cli()
-
@@ -0,0 +1,88 @@
+"""
+Packs a directory of text files (one file per document) into a single
+docstore.DocStore:  an append-only data file plus a doc_id offset index.
+"""
+import argparse
+import sys
+
+from declass.utils import docstore, filefilter
+
+
+def _cli():
+    # Text to display after help
+    epilog = """
+    EXAMPLES
+
+    Pack every file in bodyfiles/, compressing with a zstd dictionary trained
+    on the first 5000 files
+    $ python pack_documents.py --base_path=bodyfiles --compression zstd \\
+        --dict_sample_size 5000 -o cables.pack
+
+    Pack a list of files, uncompressed
+    $ find bodyfiles/ -name '*.txt' | python pack_documents.py -o cables.pack
+
+    Stream the result
+    >>> from declass.utils.streamers import DocStoreStreamer
+    >>> streamer = DocStoreStreamer('cables.pack', tokenizer=my_tokenizer)
+    """
+    parser = argparse.ArgumentParser(
+        description=globals()['__doc__'], epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    io_grp = parser.add_argument_group('I/O group')
+    io_grp.add_argument(
+        '--base_path', dest='base_path',
+        help='Walk this directory for documents.')
+    io_grp.add_argument(
+        'paths', nargs='*',
+        help='Pack files in this space separated list.  If not specified,'
+        ' use base_path or read paths from stdin.')
+    io_grp.add_argument(
+        '-o', '--outfile', required=True,
+        help='Path of the store.  Appends if the store exists.')
+    io_grp.add_argument(
+        '--file_type', default='*',
+        help="Pack only files matching this glob (compared to the lowercased "
+        "filename).  [default: %(default)s]")
+    io_grp.add_argument(
+        '--name_strip', default=r'\..*',
+        help="Regex stripped from filenames to form the doc_id.  "
+        "[default: %(default)s]")
+
+    comp_grp = parser.add_argument_group('Compression group')
+    comp_grp.add_argument(
+        '--compression', choices=['zlib', 'zstd'],
+        help="Compress documents.  zstd requires the zstandard package.  "
+        "Ignored when appending to an existing store.")
+    comp_grp.add_argument(
+        '--level', type=int, default=3,
+        help="Compression level.  [default: %(default)s]")
+    comp_grp.add_argument(
+        '--dict_sample_size', type=int, default=0,
+        help="With zstd, train a dictionary on this many documents.")
+    comp_grp.add_argument(
+        '--dict_size', type=int, default=2**17,
+        help="Size of the zstd dictionary in bytes.  [default: %(default)s]")
+
+    # Parse and check args
+    args = parser.parse_args()
+
+    if args.base_path:
+        assert args.paths == []
+        paths = filefilter.get_paths(
+            args.base_path, file_type=args.file_type, get_iter=True)
+    elif args.paths == []:
+        paths = sys.stdin
+    else:
+        paths = args.paths
+
+    # Call the module interface
+    num_docs = docstore.pack_paths(
+        args.outfile, paths, name_strip=args.name_strip,
+        compression=args.compression, level=args.level,
+        dict_sample_size=args.dict_sample_size, dict_size=args.dict_size)
+    sys.stderr.write('Packed %d documents\n' % num_docs)
+
+
+if __name__ == '__main__':
+    _cli()
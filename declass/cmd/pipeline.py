@@ -0,0 +1,370 @@
+"""
+Converts a directory of text files into model input in one process:
+tokenize, count, filter extreme tokens, compactify and map tokens to ids,
+then write VW, SVM-Light, or binary (npz) output.
+
+Between stages the corpus is held as compressed sparse rows of token counts
+rather than VW text, so nothing is re-parsed.  The tokenized corpus can be
+cached, so the filter step can be redone without retokenizing.
+"""
+import argparse
+from array import array
+from collections import OrderedDict
+import cPickle
+import hashlib
+from itertools import imap
+import json
+from multiprocessing import Pool
+import os
+import sys
+
+import numpy as np
+
+from declass.utils import common, filefilter, text_processors
+from declass.utils.common import SaveLoad
+
+
+def _cli():
+    # Text to display after help
+    epilog = """
+    EXAMPLES
+
+    Tokenize mydir/ with 4 jobs, keep tokens in at least 5 documents and at
+    most half of them, and write VW with compact ids
+    $ declass-pipeline --base_path=mydir --n_jobs 4 --doc_freq_min 5 \\
+        --doc_fraction_max 0.5 -s mydir-filter.pkl -o mydir.vw
+
+    Cache the tokenized corpus, then try a different filter without
+    retokenizing, writing a binary sparse matrix
+    $ declass-pipeline --base_path=mydir --cache mydir-tokens.npz \\
+        --doc_freq_min 5 -o mydir.vw
+    $ declass-pipeline --base_path=mydir --cache mydir-tokens.npz \\
+        --doc_freq_min 20 --format npz -o mydir.npz
+    """
+    parser = argparse.ArgumentParser(
+        description=globals()['__doc__'], epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    io_grp = parser.add_argument_group('I/O group')
+    io_grp.add_argument(
+        '--base_path', dest='base_path',
+        help='Walk this directory for documents.')
+    io_grp.add_argument(
+        'paths', nargs='*',
+        help='Convert files in this space separated list.  If not specified,'
+        ' use base_path or read paths from stdin.')
+    io_grp.add_argument(
+        '-o', '--outfile', default=sys.stdout,
+        help='Write to OUTFILE rather than sys.stdout.')
+    io_grp.add_argument(
+        '--format', dest='out_format', default='vw',
+        choices=['vw', 'svmlight', 'npz'],
+        help="Output format.  npz holds a scipy.sparse style CSR matrix "
+        "(indptr, indices, data, shape) and doc_id.  [default: %(default)s]")
+    io_grp.add_argument(
+        '-s', '--sfile_filter',
+        help='Save the SFileFilter (holding token2id and id2token) here.')
+    io_grp.add_argument(
+        '--file_type', default='*',
+        help="With --base_path, use only files matching this glob.  "
+        "[default: %(default)s]")
+    io_grp.add_argument(
+        '--doc_id_level', default=1, type=int,
+        help='Form the record doc_id using items this far back in the path'
+        ' (as in files_to_vw.py).  [default: %(default)s]')
+    io_grp.add_argument(
+        '--cache',
+        help="Path of the tokenized corpus (npz).  If it exists and was "
+        "built from the same --base_path (or paths), --file_type, tokenizer "
+        "and --doc_id_level, load it rather than tokenizing.  Otherwise "
+        "(re)write it after tokenizing.")
+
+    tok_grp = parser.add_mutually_exclusive_group(required=False)
+    tok_grp.add_argument(
+        '--tokenizer_pickle', help="Path to a pickled Tokenizer to load/use")
+    tok_grp.add_argument(
+        '--tokenizer_type', default='basic',
+        help="Use TOKENIZER_TYPE to tokenize the raw text.  Currently "
+        "supported:  'basic' .  [default: %(default)s]")
+
+    filter_grp = parser.add_argument_group('Filter group')
+    filter_grp.add_argument(
+        '--doc_freq_min', type=int, default=0,
+        help="Remove tokens in fewer than this many documents.")
+    filter_grp.add_argument(
+        '--doc_freq_max', type=float, default=np.inf,
+        help="Remove tokens in more than this many documents.")
+    filter_grp.add_argument(
+        '--doc_fraction_min', type=float, default=0,
+        help="Remove tokens in less than this fraction of documents.")
+    filter_grp.add_argument(
+        '--doc_fraction_max', type=float, default=1,
+        help="Remove tokens in more than this fraction of documents.")
+    filter_grp.add_argument(
+        '--token_score_min', type=float, default=0,
+        help="Remove tokens with total count below this.")
+    filter_grp.add_argument(
+        '--bit_precision', type=int, default=18,
+        help="Hash tokens modulo 2**BIT_PRECISION before compactifying.  "
+        "[default: %(default)s]")
+
+    perf_grp = parser.add_argument_group('Performance group')
+    perf_grp.add_argument(
+        '--n_jobs', help="Use n_jobs to tokenize files.",
+        type=int, default=1)
+    perf_grp.add_argument(
+        '--chunksize', type=int, default=1000,
+        help="Have workers process CHUNKSIZE files at a time.  "
+        "[default: %(default)s]")
+
+    # Parse and check args
+    args = parser.parse_args()
+
+    if args.tokenizer_pickle is not None:
+        tokenizer = SaveLoad.load(args.tokenizer_pickle)
+    else:
+        tokenizer_dict = {'basic': text_processors.TokenizerBasic}
+        tokenizer = tokenizer_dict[args.tokenizer_type]()
+
+    if args.base_path:
+        assert args.paths == []
+        paths = filefilter.get_paths(
+            args.base_path, file_type=args.file_type, get_iter=True)
+        source = {
+            'base_path': os.path.abspath(args.base_path),
+            'file_type': args.file_type}
+    else:
+        # Read paths from stdin up front, so the cache can be checked
+        paths = args.paths if args.paths else [
+            line.strip() for line in sys.stdin if line.strip()]
+        source = {'paths': [os.path.abspath(path) for path in paths]}
+
+    filter_kwargs = {
+        'doc_freq_min': args.doc_freq_min, 'doc_freq_max': args.doc_freq_max,
+        'doc_fraction_min': args.doc_fraction_min,
+        'doc_fraction_max': args.doc_fraction_max,
+        'token_score_min': args.token_score_min}
+
+    # Call the module interface
+    run(
+        args.outfile, paths, tokenizer, out_format=args.out_format,
+        doc_id_level=args.doc_id_level, cache=args.cache, source=source,
+        filter_kwargs=filter_kwargs, bit_precision=args.bit_precision,
+        sfile_filter_path=args.sfile_filter, n_jobs=args.n_jobs,
+        chunksize=args.chunksize)
+
+
+def run(
+    outfile, paths, tokenizer, out_format='vw', doc_id_level=1, cache=None,
+    filter_kwargs=None, bit_precision=18, sfile_filter_path=None, n_jobs=1,
+    chunksize=1000, source=None):
+    """
+    Run the pipeline.  See _cli for the documentation.
+
+    The cache is only used if it was built from the same source (a JSON
+    serializable description of paths, e.g. the base_path), tokenizer and
+    doc_id_level.  Otherwise it is rebuilt.
+
+    Returns
+    -------
+    sfile_filter : text_processors.SFileFilter
+        Holds token2id, id2token and the token statistics.
+    """
+    settings = {
+        'source': source, 'doc_id_level': doc_id_level,
+        'tokenizer': hashlib.md5(cPickle.dumps(tokenizer, 2)).hexdigest()}
+
+    corpus = None
+    if (cache is not None) and os.path.exists(cache):
+        corpus = TokenCorpus.load(cache)
+        if corpus.settings != settings:
+            corpus = None
+    if corpus is None:
+        corpus = TokenCorpus.from_paths(
+            paths, tokenizer, doc_id_level=doc_id_level, n_jobs=n_jobs,
+            chunksize=chunksize)
+        corpus.settings = settings
+        if cache is not None:
+            corpus.save(cache)
+
+    sfile_filter = corpus.get_sfile_filter(bit_precision=bit_precision)
+    sfile_filter.filter_extremes(**(filter_kwargs if filter_kwargs else {}))
+    sfile_filter.compactify()
+    sfile_filter.set_id2token()
+    if sfile_filter_path is not None:
+        sfile_filter.save(sfile_filter_path)
+
+    indptr, indices, values = corpus.map_ids(sfile_filter.token2id)
+
+    if out_format == 'npz':
+        # Through an open file, since np.savez would append '.npz' to a path
+        with common.smart_open(outfile, 'wb') as open_outfile:
+            np.savez(
+                open_outfile, indptr=indptr, indices=indices, data=values,
+                shape=np.array([len(corpus), sfile_filter.vocab_size]),
+                doc_id=corpus.doc_id)
+    else:
+        formatter = {
+            'vw': text_processors.VWFormatter,
+            'svmlight': text_processors.SVMLightFormatter}[out_format]()
+        with common.smart_open(outfile, 'w') as open_outfile:
+            for i, doc_id in enumerate(corpus.doc_id):
+                row = slice(indptr[i], indptr[i + 1])
+                feature_values = OrderedDict(
+                    sorted(zip(indices[row], values[row])))
+                open_outfile.write(formatter.get_sstr(
+                    feature_values, importance=1, doc_id=doc_id) + '\n')
+
+    return sfile_filter
+
+
+class TokenCorpus(object):
+    """
+    Token counts of a corpus as compressed sparse rows:  document i has
+    tokens self.vocab[self.indices[self.indptr[i]: self.indptr[i + 1]]] with
+    counts self.values[self.indptr[i]: self.indptr[i + 1]].
+
+    settings (a JSON serializable dict, or None) records how the corpus was
+    built, and is saved with it.
+    """
+    def __init__(self, doc_id, vocab, indptr, indices, values, settings=None):
+        self.doc_id = doc_id
+        self.vocab = vocab
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self.settings = settings
+
+    @classmethod
+    def from_paths(
+        cls, paths, tokenizer, doc_id_level=1, n_jobs=1, chunksize=1000):
+        """
+        Tokenize the files in paths, in n_jobs processes.
+        """
+        n_jobs = common.get_num_jobs(n_jobs)
+        path_groups = common.chunker(paths, chunksize)
+        initargs = (tokenizer, doc_id_level)
+        if n_jobs == 1:
+            pool = None
+            _init_worker(*initargs)
+            results_iterator = imap(_worker_count_group, path_groups)
+        else:
+            pool = Pool(n_jobs, _init_worker, initargs)
+            results_iterator = common.bounded_imap(
+                pool, _worker_count_group, path_groups, 2 * n_jobs)
+
+        doc_id = []
+        token_to_index = {}
+        indptr = array('l', [0])
+        indices = array('i')
+        values = array('i')
+        try:
+            for group in results_iterator:
+                for doc, counts in group:
+                    doc_id.append(doc)
+                    for token, count in counts:
+                        indices.append(token_to_index.setdefault(
+                            token, len(token_to_index)))
+                        values.append(count)
+                    indptr.append(len(indices))
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        vocab = [None] * len(token_to_index)
+        for token, index in token_to_index.iteritems():
+            vocab[index] = token
+
+        return cls(
+            np.array(doc_id), np.array(vocab), np.frombuffer(indptr, 'l'),
+            np.frombuffer(indices, 'i'), np.frombuffer(values, 'i'))
+
+    def __len__(self):
+        return len(self.doc_id)
+
+    def save(self, savefile):
+        with common.smart_open(savefile, 'wb') as f:
+            np.savez(
+                f, doc_id=self.doc_id, vocab=self.vocab, indptr=self.indptr,
+                indices=self.indices, values=self.values,
+                settings=json.dumps(self.settings, sort_keys=True))
+
+    @classmethod
+    def load(cls, loadfile):
+        arrays = np.load(loadfile)
+        # Caches written before settings were recorded have none
+        settings = json.loads(str(arrays['settings'])) if (
+            'settings' in arrays.files) else None
+
+        return cls(
+            arrays['doc_id'], arrays['vocab'], arrays['indptr'],
+            arrays['indices'], arrays['values'], settings=settings)
+
+    def get_sfile_filter(self, bit_precision=18):
+        """
+        Returns an SFileFilter loaded with the token statistics of self.
+        """
+        size = len(self.vocab)
+        doc_freq = np.bincount(self.indices, minlength=size)
+        token_score = np.bincount(
+            self.indices, weights=self.values, minlength=size)
+
+        sfile_filter = text_processors.SFileFilter(
+            text_processors.VWFormatter(), bit_precision=bit_precision)
+        sfile_filter.load_counts(
+            dict(zip(self.vocab, token_score)),
+            dict(zip(self.vocab, doc_freq)), len(self))
+
+        return sfile_filter
+
+    def map_ids(self, token2id):
+        """
+        Replace token indices by token2id[token], dropping tokens not in
+        token2id.
+
+        Returns
+        -------
+        indptr, indices, values : numpy arrays
+            The new compressed sparse rows.
+        """
+        new_ids = np.array(
+            [token2id.get(token, -1) for token in self.vocab], dtype=int)
+        ids = new_ids[self.indices] if len(self.indices) else new_ids[:0]
+        keep = ids >= 0
+        kept_before = np.concatenate([[0], np.cumsum(keep)])
+
+        return kept_before[self.indptr], ids[keep], self.values[keep]
+
+
+# The tokenizer and doc_id_level of a worker.  Set once per worker by
+# _init_worker, rather than pickled with every path group.
+_worker_state = {}
+
+
+def _init_worker(tokenizer, doc_id_level):
+    _worker_state['args'] = (tokenizer, doc_id_level)
+
+
+def _worker_count_group(path_group):
+    tokenizer, doc_id_level = _worker_state['args']
+
+    return _count_group(tokenizer, doc_id_level, path_group)
+
+
+def _count_group(tokenizer, doc_id_level, path_group):
+    """
+    Returns [(doc_id, [(token, count),...]),...] for the files in path_group.
+    """
+    results = []
+    for path in path_group:
+        path = path.strip()
+        with open(path, 'r') as f:
+            counts = tokenizer.text_to_counter(f.read())
+        doc_id = filefilter.path_to_newname(path, name_level=doc_id_level)
+        results.append((doc_id, counts.items()))
+
+    return results
+
+
+if __name__ == '__main__':
+    _cli()
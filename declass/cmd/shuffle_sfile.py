@@ -0,0 +1,60 @@
+"""
+Shuffles the lines of an sfile (or any line-based file) using temporary
+files on disk, so the file need not fit in memory.
+"""
+import argparse
+import sys
+
+from declass.utils import common
+
+
+def _cli():
+    # Text to display after help
+    epilog = """
+    EXAMPLES
+
+    Shuffle myfile.vw, reproducibly, writing buckets of about 256MB to /scratch
+    $ python shuffle_sfile.py --seed 1976 --tmpdir /scratch myfile.vw \\
+        -o myfile-shuffled.vw
+
+    Shuffle the output of files_to_vw.py
+    $ python files_to_vw.py --base_path=mydir --no_shuffle \\
+        | python shuffle_sfile.py --num_buckets 64 > myfile-shuffled.vw
+    """
+    parser = argparse.ArgumentParser(
+        description=globals()['__doc__'], epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        'infile', nargs='?', default=sys.stdin,
+        help='Shuffle this file.  If not specified, read from stdin.')
+    parser.add_argument(
+        '-o', '--outfile', default=sys.stdout, type=argparse.FileType('w'),
+        help='Write to OUT_FILE rather than sys.stdout.')
+    parser.add_argument(
+        '--seed', type=int,
+        help='Seed for the random number generator.')
+    parser.add_argument(
+        '--num_buckets', type=int,
+        help='Number of temporary buckets.  If not given and infile is a '
+        'path, use enough buckets to hold about BUCKET_MB each.  If reading '
+        'from stdin, the default is 16.')
+    parser.add_argument(
+        '--bucket_mb', type=float, default=256,
+        help='Target size of a bucket in MB.  [default: %(default)s]')
+    parser.add_argument(
+        '--tmpdir',
+        help='Write temporary buckets here.  Defaults to the system tempdir.')
+
+    # Parse and check args
+    args = parser.parse_args()
+
+    # Call the module interface
+    common.external_shuffle(
+        args.infile, args.outfile, seed=args.seed,
+        num_buckets=args.num_buckets,
+        bucket_bytes=int(args.bucket_mb * 2**20), tmpdir=args.tmpdir)
+
+
+if __name__ == '__main__':
+    _cli()
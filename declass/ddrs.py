@@ -1,10 +1,35 @@
 """
 Managing and formatting of DDRS document.
 """
+from functools import partial
+from itertools import imap
+from multiprocessing import Pool
 import os
+import re
 
+import declass.utils.common as common
 import declass.utils.database as db
 import declass.utils.filefilter as ff
+import declass.utils.streamers as streamers
+import declass.utils.text_processors as text_processors
+
+OUTPUT_SPECS = ('clean', 'nofoot', 'raw')
+
+# Markup and what Document._clean replaces it with
+CLEAN_REPLACEMENTS = {
+    "</PARA>": " \n ",
+    "<PARA>": " \n ",
+    "<?BR?>": " \n ",
+    "<?PRE?>": " *PAGE* ",
+    "<?HR?>": " *FOOTER* ",
+    "</DOC.BODY>": " ",
+    "<DOC.BODY>": " ",
+    "\\n": " \n ",
+    }
+_CLEAN_RE = re.compile('|'.join(re.escape(markup) for markup in sorted(
+    CLEAN_REPLACEMENTS, key=len, reverse=True)))
+# Markup separating pages, and the body from the footer of a page
+_PAGE_RE = re.compile(r'<\?PRE\?>|<\?HR\?>')
 
 
 def make_db_connect():
@@ -21,6 +46,9 @@ class Document(object):
     """
     Class to hold and process documents from the ddrs collection.
     """
+    __slots__ = (
+        'id', 'unformatted_text', '_lazy_clean_text', '_lazy_sectioned_pages')
+
     def __init__(self, id, unformatted_text):
         """
         Parameters
@@ -33,22 +61,31 @@ class Document(object):
         """
         self.id = id
         self.unformatted_text = unformatted_text
-        self.clean_text = self._clean(self.unformatted_text)
 
-        pages = self.clean_text.split("*PAGE*")
-        self.sectioned_pages = []
-        for page in pages:
-            section_text = page.split("*FOOTER*")
+    @common.lazyprop
+    def clean_text(self):
+        return self._clean(self.unformatted_text)
+
+    @common.lazyprop
+    def sectioned_pages(self):
+        """
+        List of {"body": body, "footer": footer}, one per page.
+        """
+        sectioned_pages = []
+        for page in self.clean_text.split("*PAGE*"):
+            section_text = page.split("*FOOTER*", 1)
             sections = {"body" : section_text[0]}
-            if len(sections) == 2:
+            if len(section_text) == 2:
                 sections["footer"] = section_text[1]
             else:
                 sections["footer"] = ""
-            self.sectioned_pages.append(sections)
+            sectioned_pages.append(sections)
+
+        return sectioned_pages
 
     def _clean(self, text):
         """
-        Remove the markup in the text.
+        Remove the markup in the text, in one pass.
 
         Parameters
         ----------
@@ -60,14 +97,48 @@ class Document(object):
         String
             The cleaned text.
         """
-        return text.replace("</PARA>", " \n ") \
-            .replace("<PARA>", " \n ") \
-            .replace("<?BR?>", " \n ") \
-            .replace("<?PRE?>", " *PAGE* ") \
-            .replace("<?HR?>", " *FOOTER* ") \
-            .replace("</DOC.BODY>", " ") \
-            .replace("<DOC.BODY>", " ") \
-            .replace("\\n", " \n ")
+        return _CLEAN_RE.sub(
+            lambda match: CLEAN_REPLACEMENTS[match.group()], text)
+
+    def page_spans(self):
+        """
+        Locate the pages in the unformatted text, without copying it.
+
+        Returns
+        -------
+        List of (body_start, body_end, footer_start, footer_end)
+            Offsets into self.unformatted_text, one tuple per page.  If a page
+            has no footer, footer_start == footer_end == body_end.
+        """
+        text = self.unformatted_text
+        spans = []
+        start, footer = 0, None
+        for match in _PAGE_RE.finditer(text):
+            if match.group() == "<?PRE?>":
+                if footer is None:
+                    footer = (match.start(), match.start())
+                spans.append((start, footer[0], footer[1], match.start()))
+                start, footer = match.end(), None
+            elif footer is None:
+                footer = (match.start(), match.end())
+        if footer is None:
+            footer = (len(text), len(text))
+        spans.append((start, footer[0], footer[1], len(text)))
+
+        return spans
+
+    def iter_pages(self):
+        """
+        Returns an iterator over (page_no, body, footer) with page_no starting
+        at 1 and the body and footer cleaned.  Pages are sliced out of the
+        unformatted text one at a time, so only one is ever held in memory.
+        """
+        text = self.unformatted_text
+        for page_no, (body_start, body_end, footer_start, footer_end) in (
+            enumerate(self.page_spans(), 1)):
+            yield (
+                page_no, self._clean(text[body_start: body_end]),
+                self._clean(text[footer_start: footer_end]))
 
     def format(self, output_spec):
         """
@@ -153,6 +224,247 @@ class Document(object):
                 out.write(doc.format(output_spec))
 
 
+class PageStreamer(streamers.BaseStreamer):
+    """
+    For streaming every DDRS page as its own document, from *.raw.txt files
+    or straight from the Document table.
+    """
+    def __init__(
+        self, text_base_path=None, db=None, tokenizer=None,
+        tokenizer_func=None, limit=None, batch_size=1000, skip_empty=True):
+        """
+        Parameters
+        ----------
+        text_base_path : String
+            Directory of *.raw.txt files (as written by dump_ddrs_documents).
+        db : database.DBCONNECT or DB-API 2.0 connection
+            Stream the Document table instead of files.
+        tokenizer : Subclass of BaseTokenizer
+            Should have a text_to_token_list method.  Try using MakeTokenizer
+            to convert a function to a valid tokenizer.
+        tokenizer_func : Function
+            Transforms a string (representing one document) to a list of
+            strings (the 'tokens').
+        limit : int or None
+            Limit for number of pages processed.
+        batch_size : Integer
+            With db, fetch this many rows per query.
+        skip_empty : Boolean
+            If True, do not stream pages with a blank body.
+        """
+        assert (text_base_path is None) != (db is None), (
+            "Give exactly one of text_base_path and db")
+        self.text_base_path = text_base_path
+        self.db = db
+        self.limit = limit
+        self.batch_size = batch_size
+        self.skip_empty = skip_empty
+        self.tokenizer = tokenizer
+        self.tokenizer_func = tokenizer_func
+
+        assert (tokenizer is None) or (tokenizer_func is None)
+        if tokenizer_func:
+            self.tokenizer = text_processors.MakeTokenizer(tokenizer_func)
+
+    def __getstate__(self):
+        # Workers only need the tokenizer, not the connection
+        state = self.__dict__.copy()
+        state['db'] = None
+
+        return state
+
+    def document_stream(self):
+        """
+        Returns an iterator over the source as ddrs.Documents.
+        """
+        if self.db is None:
+            return Document.fetch_from_files(self.text_base_path)
+        else:
+            streamer = streamers.DBStreamer(
+                self.db, table='Document', batch_size=self.batch_size)
+            return (
+                Document(info['doc_id'], info['text'])
+                for info in streamer.info_stream())
+
+    def record_stream(self, limit=None):
+        """
+        Returns an iterator over (doc_id, page_no, body, footer).
+
+        Parameters
+        ----------
+        limit : Integer
+            Use limit in place of self.limit.
+        """
+        if limit is None:
+            limit = self.limit
+
+        num_yielded = 0
+        for doc in self.document_stream():
+            for page_no, body, footer in doc.iter_pages():
+                if num_yielded == limit:
+                    raise StopIteration
+                if self.skip_empty and not body.strip():
+                    continue
+                num_yielded += 1
+                yield doc.id, page_no, body, footer
+
+    def info_stream(self, limit=None):
+        """
+        Returns an iterator over pages yielding dictionaries with keys
+        'doc_id' (e.g. '1234_2' for page 2 of document 1234), 'ddrs_id',
+        'page_no', 'text' (the body), 'footer', and (if self.tokenizer)
+        'tokens'.
+
+        Parameters
+        ----------
+        limit : Integer
+            Use limit in place of self.limit.
+        """
+        for ddrs_id, page_no, body, footer in self.record_stream(limit=limit):
+            info_dict = {
+                'doc_id': '%s_%d' % (ddrs_id, page_no), 'ddrs_id': ddrs_id,
+                'page_no': page_no, 'text': body, 'footer': footer}
+            if self.tokenizer:
+                info_dict['tokens'] = self.tokenizer.text_to_token_list(body)
+
+            yield info_dict
+
+    def to_vw(self, outfile, n_jobs=1, chunksize=1000, buffer_size=None):
+        """
+        Write the page bodies to a VW (Vowpal Wabbit) formatted file.
+
+        Pages are read and cleaned by this process, and chunks of them are
+        tokenized by n_jobs workers.
+
+        Parameters
+        ----------
+        outfile : filepath or buffer
+        n_jobs : Integer
+            Use n_jobs different jobs to do the processing.  Set = 4 for 4
+            jobs.  Set = -1 to use all available, -2 for all except 1,...
+        chunksize : Integer
+            Workers tokenize this many pages at once.
+        buffer_size : Integer
+            At most this many chunks are in flight (submitted but not yet
+            written).  Defaults to 2 * n_jobs.
+        """
+        formatter = text_processors.VWFormatter()
+        n_jobs = common.get_num_jobs(n_jobs)
+
+        page_group_iter = common.chunker(
+            (('%s_%d' % (ddrs_id, page_no), body)
+             for ddrs_id, page_no, body, _ in self.record_stream()),
+            chunksize)
+
+        if n_jobs == 1:
+            streamers._init_to_vw_worker(self, formatter)
+            results_iterator = imap(
+                streamers._worker_texts_to_sstr, page_group_iter)
+            pool = None
+        else:
+            pool = Pool(
+                n_jobs, streamers._init_to_vw_worker, (self, formatter))
+            results_iterator = common.bounded_imap(
+                pool, streamers._worker_texts_to_sstr, page_group_iter,
+                buffer_size if buffer_size else 2 * n_jobs)
+
+        try:
+            with common.smart_open(outfile, 'w') as open_outfile:
+                for group_results in results_iterator:
+                    for sstr in group_results:
+                        open_outfile.write(sstr + '\n')
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+
+def write_documents(
+    directory, rows, output_specs, n_jobs=1, chunksize=100, resume=False):
+    """
+    Write documents to the filesystem in every format in output_specs, in
+    one pass over rows.  Cleaning and writing run in n_jobs processes.
+
+    Files are written to a temporary name then renamed, so an interrupted
+    run never leaves a partial file behind.
+
+    Parameters
+    ----------
+    directory : String
+        The file directory for the documents.
+    rows : Iterable over (id, unformatted_text) tuples
+        E.g. streamed from the Document table.
+    output_specs : List of strings
+        Formats to write each document in, e.g. ['raw', 'clean', 'nofoot'].
+    n_jobs : Integer
+        Number of processes.  -1 means all available CPUs.
+    chunksize : Integer
+        Send this many documents to a worker at a time.
+    resume : Boolean
+        If True, skip documents with every spec already in directory.
+
+    Returns
+    -------
+    num_written : Integer
+        Number of documents written.
+    """
+    for spec in output_specs:
+        if spec not in OUTPUT_SPECS:
+            raise ValueError("output_spec %s not recognized." % spec)
+
+    if resume:
+        done = get_written_ids(directory, output_specs)
+        rows = (row for row in rows if str(row[0]) not in done)
+
+    func = partial(_write_chunk, directory, output_specs)
+    chunks = common.chunker(rows, chunksize)
+    n_jobs = common.get_num_jobs(n_jobs)
+    if n_jobs == 1:
+        pool = None
+        results_iterator = imap(func, chunks)
+    else:
+        pool = Pool(n_jobs)
+        results_iterator = common.bounded_imap(pool, func, chunks, 2 * n_jobs)
+
+    try:
+        num_written = sum(results_iterator)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return num_written
+
+
+def get_written_ids(directory, output_specs):
+    """
+    Returns the set of ids (as strings) that have a file in directory for
+    every spec in output_specs.
+    """
+    ids_by_spec = dict((spec, set()) for spec in output_specs)
+    for file_name in os.listdir(directory):
+        parts = file_name.split('.')
+        if (len(parts) == 3) and (parts[1] in ids_by_spec) and (
+            parts[2] == 'txt'):
+            ids_by_spec[parts[1]].add(parts[0])
+
+    return set.intersection(*ids_by_spec.values())
+
+
+def _write_chunk(directory, output_specs, rows):
+    """
+    Write every spec of every (id, unformatted_text) in rows.  Returns the
+    number of documents written.  A text of None is written as empty.
+    """
+    for id, unformatted_text in rows:
+        doc = Document(id, unformatted_text or '')
+        for spec in output_specs:
+            path = os.path.join(directory, "{}.{}.txt".format(id, spec))
+            with open(path + '.tmp', "w") as out:
+                out.write(doc.format(spec))
+            os.rename(path + '.tmp', path)
+
+    return len(rows)
+
+
 if __name__ == "__main__":
     dbCon = make_db_connect()
     rows = dbCon.run_query("SELECT id, body FROM Document LIMIT 10")
@@ -1,12 +1,18 @@
 import unittest
 from StringIO import StringIO
+import os
+import shutil
 import sys
+import tarfile
+import tempfile
+import numpy as np
 from numpy.testing import assert_allclose
 from datetime import datetime
 import copy
 from collections import Counter, OrderedDict
 
-from declass.cmd import files_to_vw
+from declass.cmd import compact_segments, files_to_vw, pipeline
+from declass.utils import common, text_processors
 
 
 class TestFilesToVW(unittest.TestCase):
@@ -14,6 +20,10 @@ class TestFilesToVW(unittest.TestCase):
     """
     def setUp(self):
         self.outfile = StringIO()
+        self.tmpdir = tempfile.mkdtemp()
+        for i in range(20):
+            with open(os.path.join(self.tmpdir, 'doc%d.txt' % i), 'w') as f:
+                f.write('hello there doc%d' % i)
 
     def test_tokenize_basic_01(self):
         path_list = ['data/file1.txt', 'data/file2.txt', 'data/file3']
@@ -26,5 +36,239 @@ class TestFilesToVW(unittest.TestCase):
             "'file3 | this'ssss:1\n")
         self.assertEqual(result, benchmark)
 
+    def tokenize_shard(self, shard):
+        outfile = StringIO()
+        manifest = StringIO()
+        files_to_vw.tokenize(
+            outfile, [], self.tmpdir, False, 'basic', None, 1, 1, 5,
+            shard=shard, shard_manifest=manifest)
+        manifest.seek(0)
+        return outfile.getvalue().splitlines(), common.ShardManifest.load(
+            manifest)
+
+    def test_tokenize_shard(self):
+        lines, reference = self.tokenize_shard(None)
+        self.assertEqual(len(lines), 20)
+        shard_lines = []
+        manifests = []
+        for k in range(3):
+            lines_k, manifest_k = self.tokenize_shard((k, 3))
+            shard_lines += lines_k
+            manifests.append(manifest_k)
+        self.assertEqual(sorted(shard_lines), sorted(lines))
+        combined = common.check_shard_manifests(manifests, reference)
+        self.assertEqual(combined.num_docs, 20)
+
+    def test_tokenize_checkpoint(self):
+        lines, reference = self.tokenize_shard(None)
+        checkpoint_dir = os.path.join(tempfile.mkdtemp(), 'ckpt')
+        self.addCleanup(shutil.rmtree, os.path.dirname(checkpoint_dir))
+        outfile = StringIO()
+        files_to_vw.tokenize(
+            outfile, [], self.tmpdir, False, 'basic', None, 1, 2, 3,
+            checkpoint_dir=checkpoint_dir)
+        self.assertEqual(
+            sorted(outfile.getvalue().splitlines()), sorted(lines))
+        self.assertFalse(os.path.exists(checkpoint_dir))
+
+    def test_tokenize_checkpoint_resume(self):
+        checkpoint_dir = os.path.join(tempfile.mkdtemp(), 'ckpt')
+        self.addCleanup(shutil.rmtree, os.path.dirname(checkpoint_dir))
+        config = {
+            'base_path': self.tmpdir, 'outfile': None, 'doc_id_level': 1,
+            'shard': None, 'tokenizer_type': 'basic', 'tokenizer_pickle': None}
+        # A checkpoint from another corpus is refused
+        other_config = dict(config, base_path='/other/corpus')
+        common.Checkpoint(checkpoint_dir, config=other_config)
+        with self.assertRaises(ValueError):
+            files_to_vw.tokenize(
+                StringIO(), [], self.tmpdir, False, 'basic', None, 1, 1, 3,
+                checkpoint_dir=checkpoint_dir)
+        shutil.rmtree(checkpoint_dir)
+
+        # On resume, the saved paths are used and base_path is not crawled
+        checkpoint = common.Checkpoint(checkpoint_dir, config=config)
+        checkpoint.get_items(
+            [os.path.join(self.tmpdir, 'doc%d.txt' % i) for i in [4, 2]])
+        outfile = StringIO()
+        files_to_vw.tokenize(
+            outfile, [], self.tmpdir, False, 'basic', None, 1, 1, 3,
+            checkpoint_dir=checkpoint_dir)
+        self.assertEqual(
+            outfile.getvalue(), " 1 doc4| hello:1\n 1 doc2| hello:1\n")
+
+    def test_tokenize_shuffle_buffer(self):
+        lines, reference = self.tokenize_shard(None)
+        for n_jobs in [1, 2]:
+            outfile = StringIO()
+            files_to_vw.tokenize(
+                outfile, [], self.tmpdir, False, 'basic', None, 1, n_jobs, 3,
+                shuffle_buffer=5)
+            self.assertEqual(
+                sorted(outfile.getvalue().splitlines()), sorted(lines))
+
+    def test_tokenize_seed(self):
+        for shuffle_buffer in [0, 5]:
+            outputs = []
+            for n_jobs in [1, 2, 2]:
+                outfile = StringIO()
+                files_to_vw.tokenize(
+                    outfile, [], self.tmpdir, False, 'basic', None, 1, n_jobs,
+                    3, shuffle_buffer=shuffle_buffer, seed=7)
+                outputs.append(outfile.getvalue())
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertEqual(outputs[0], outputs[2])
+
+    def test_tokenize_partitioned(self):
+        lines, reference = self.tokenize_shard(None)
+        outdir = tempfile.mkdtemp()
+        try:
+            writer = common.PartitionedWriter(
+                os.path.join(outdir, 'part-{}.vw'),
+                common.hash_partitioner(3))
+            files_to_vw.tokenize(
+                writer, [], self.tmpdir, False, 'basic', None, 1, 1, 5)
+            writer.close()
+            result = []
+            for k in range(3):
+                with open(writer.paths[str(k)]) as f:
+                    result += f.read().splitlines()
+            self.assertEqual(sorted(result), sorted(lines))
+        finally:
+            shutil.rmtree(outdir)
+
+    def test_tokenize_incremental(self):
+        segment_dir = tempfile.mkdtemp()
+        try:
+            tokenize = lambda: files_to_vw.tokenize(
+                None, [], self.tmpdir, False, 'basic', None, 1, 1, 5,
+                incremental=segment_dir)
+            self.assertEqual(tokenize(), (20, 0))
+            self.assertEqual(tokenize(), (0, 0))
+
+            with open(os.path.join(self.tmpdir, 'doc3.txt'), 'w') as f:
+                f.write('goodbye')
+            with open(os.path.join(self.tmpdir, 'doc20.txt'), 'w') as f:
+                f.write('hello there doc20')
+            os.remove(os.path.join(self.tmpdir, 'doc5.txt'))
+            self.assertEqual(tokenize(), (2, 1))
+
+            outfile = StringIO()
+            compact_segments.compact(segment_dir, outfile, in_place=True)
+            lines = outfile.getvalue().splitlines()
+            self.assertEqual(len(lines), 20)
+            self.assertTrue(" 1 doc3| goodbye:1" in lines)
+            self.assertFalse(any(l.startswith(" 1 doc5|") for l in lines))
+            self.assertEqual(
+                text_processors.SFileSegments(segment_dir).segment_numbers,
+                [4])
+        finally:
+            shutil.rmtree(segment_dir)
+
+    def test_tokenize_incremental_modified_in_place(self):
+        segment_dir = tempfile.mkdtemp()
+        try:
+            tokenize = lambda: files_to_vw.tokenize(
+                None, [], self.tmpdir, False, 'basic', None, 1, 1, 5,
+                incremental=segment_dir)
+            self.assertEqual(tokenize(), (20, 0))
+
+            # Appending to a file leaves its directory's mtime unchanged
+            with open(os.path.join(self.tmpdir, 'doc7.txt'), 'a') as f:
+                f.write(' goodbye')
+            self.assertEqual(tokenize(), (1, 0))
+            self.assertEqual(tokenize(), (0, 0))
+
+            outfile = StringIO()
+            compact_segments.compact(segment_dir, outfile)
+            lines = outfile.getvalue().splitlines()
+            self.assertEqual(len(lines), 20)
+            doc7 = [l for l in lines if l.startswith(" 1 doc7|")]
+            self.assertEqual(len(doc7), 1)
+            self.assertTrue("goodbye:1" in doc7[0])
+        finally:
+            shutil.rmtree(segment_dir)
+
+    def test_tokenize_archive(self):
+        lines, reference = self.tokenize_shard(None)
+        archive = os.path.join(self.tmpdir, 'docs.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            tar.add(self.tmpdir, arcname='docs')
+        outfile = StringIO()
+        files_to_vw.tokenize(
+            outfile, [], None, False, 'basic', None, 1, 1, 5,
+            archives=[archive])
+        self.assertEqual(
+            sorted(outfile.getvalue().splitlines()), sorted(lines))
+
     def tearDown(self):
         self.outfile.close()
+        shutil.rmtree(self.tmpdir)
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(10):
+            path = os.path.join(self.tmpdir, 'doc%d.txt' % i)
+            with open(path, 'w') as f:
+                f.write('cable embassy' + ' telegram' * (i % 2))
+            self.paths.append(path)
+        self.cache = os.path.join(self.tmpdir, 'tokens.cache')
+        self.tokenizer = text_processors.TokenizerBasic()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_vw(self):
+        outfile = StringIO()
+        sfile_filter = pipeline.run(
+            outfile, self.paths, self.tokenizer, cache=self.cache,
+            filter_kwargs={'doc_freq_min': 2}, n_jobs=2, chunksize=3)
+        self.assertEqual(
+            sorted(sfile_filter.token2id), ['cable', 'embassy', 'telegram'])
+        self.assertEqual(sorted(sfile_filter.token2id.values()), [0, 1, 2])
+        lines = outfile.getvalue().splitlines()
+        self.assertEqual(len(lines), 10)
+        telegram = sfile_filter.token2id['telegram']
+        self.assertTrue(' 1 doc1| ' in lines[1])
+        self.assertTrue('%d:1' % telegram in lines[1])
+        self.assertFalse('%d:1' % telegram in lines[0])
+
+        # Refilter from the cache, without the files
+        sfile_filter = pipeline.run(
+            StringIO(), [], self.tokenizer, cache=self.cache,
+            filter_kwargs={'doc_freq_min': 6})
+        self.assertEqual(sorted(sfile_filter.token2id), ['cable', 'embassy'])
+
+    def test_stale_cache(self):
+        pipeline.run(
+            StringIO(), self.paths[:4], self.tokenizer, cache=self.cache,
+            source={'paths': self.paths[:4]})
+        # A cache of other paths is rebuilt, a matching one reused
+        for paths in [self.paths, []]:
+            outfile = StringIO()
+            pipeline.run(
+                outfile, paths, self.tokenizer, cache=self.cache,
+                source={'paths': self.paths})
+            self.assertEqual(len(outfile.getvalue().splitlines()), 10)
+        # A cache made with another tokenizer is rebuilt
+        other_tokenizer = text_processors.TokenizerBasic()
+        other_tokenizer.name = 'other'
+        outfile = StringIO()
+        pipeline.run(
+            outfile, self.paths[:2], other_tokenizer, cache=self.cache,
+            source={'paths': self.paths})
+        self.assertEqual(len(outfile.getvalue().splitlines()), 2)
+
+    def test_npz(self):
+        outpath = os.path.join(self.tmpdir, 'out.npz')
+        pipeline.run(
+            outpath, self.paths, self.tokenizer, out_format='npz',
+            filter_kwargs={'doc_fraction_min': 0.6})
+        arrays = np.load(outpath)
+        self.assertEqual(list(arrays['shape']), [10, 2])
+        self.assertEqual(list(arrays['indptr']), range(0, 21, 2))
+        self.assertEqual(list(arrays['data']), [1] * 20)
+        self.assertEqual(arrays['doc_id'][3], 'doc3')
@@ -1,4 +1,12 @@
 import unittest
+import gzip
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import zipfile
+import warnings
 from StringIO import StringIO
 import sys
 from datetime import datetime
@@ -6,11 +14,15 @@ import copy
 from collections import Counter, OrderedDict
 import random
 
+import numpy as np
 import pandas as pd
 from numpy.testing import assert_allclose
 from pandas.util.testing import assert_frame_equal
 
-from declass.utils import text_processors, streamers, topic_seek, vw_helpers
+from declass import ddrs
+from declass.utils import (
+    common, docstore, filefilter, text_processors, streamers, topic_seek,
+    vw_helpers)
 
 
 class TestTokenizerBasic(unittest.TestCase):
@@ -88,6 +100,14 @@ class TestVWHelpers(unittest.TestCase):
                 'weight': [0.2789, -0.1786]}).set_index('hash_val')
         assert_frame_equal(result, benchmark)
 
+    def test_parse_varinfo_top_k(self):
+        result = vw_helpers.parse_varinfo(
+            self.varinfo_path, top_k=1, chunksize=1,
+            id2token={77964: 'bcc', 1: 'other'})
+        self.assertEqual(list(result.index), [77964])
+        self.assertEqual(list(result.token), ['bcc'])
+        self.assertEqual(result.rel_score[77964], 1.)
+
     def test_parse_lda_topics_01(self):
         result = vw_helpers.parse_lda_topics(
             self.topics_file_1, self.num_topics_1, normalize=False)
@@ -96,6 +116,17 @@ class TestVWHelpers(unittest.TestCase):
             ).set_index('hash_val')
         assert_frame_equal(result, benchmark)
 
+    def test_parse_lda_topics_hash_vals(self):
+        topics_file = StringIO(
+            "Version 7.3\nlda:2\n0 0 0 0\n"
+            "0 1.1 2.2 \n1 1.11 2.22\n5 3.3 4.4\n")
+        result = vw_helpers.parse_lda_topics(
+            topics_file, 2, normalize=False, dtype=np.float32,
+            hash_vals=[5, 0, 7], chunk_bytes=1)
+        self.assertEqual(list(result.index), [0, 5])
+        self.assertEqual(result.topic_1.dtype, np.float32)
+        assert_allclose(result.topic_0.values, [1.1, 3.3], rtol=1e-6)
+
     def test_parse_lda_predictions_01(self):
         result = vw_helpers.parse_lda_predictions(
             self.predictions_file_1, self.num_topics_1, self.start_line_1,
@@ -105,6 +136,44 @@ class TestVWHelpers(unittest.TestCase):
                 'topic_1': [2.2, 2.22]}).set_index('doc_id')
         assert_frame_equal(result, benchmark)
 
+    def test_load_lda_predictions(self):
+        result = vw_helpers.load_lda_predictions(
+            self.predictions_file_1, self.num_topics_1, normalize=False)
+        benchmark = pd.DataFrame(
+            {'doc_id': ['doc1', 'doc2'], 'topic_0': [1.1, 1.11],
+                'topic_1': [2.2, 2.22]}).set_index('doc_id')
+        assert_frame_equal(result, benchmark)
+
+    def test_load_lda_predictions_all_passes(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            all_passes_file = os.path.join(tmpdir, 'passes.npy')
+            vw_helpers.load_lda_predictions(
+                self.predictions_file_1, self.num_topics_1,
+                all_passes_file=all_passes_file, chunk_bytes=1)
+            all_passes = np.load(all_passes_file, mmap_mode='r')
+            self.assertEqual(all_passes.shape, (2, 2, 2))
+            assert_allclose(all_passes[1, 1], [1.11, 2.22])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_find_start_offset_lda_predictions(self):
+        result = vw_helpers.find_start_offset_lda_predictions(
+            self.predictions_file_1, block_bytes=5)
+        self.assertEqual(result, 26)
+        # Blocks shorter than a line must not split it
+        predictions_file = StringIO("1 2 doc1\n3.33333 4.44444 doc1")
+        for block_bytes in range(1, 30):
+            self.assertEqual(
+                vw_helpers.find_start_offset_lda_predictions(
+                    predictions_file, block_bytes=block_bytes), 9)
+
+    def test_load_lda_predictions_misaligned(self):
+        # The token count is a multiple of 3, but the lines are not
+        predictions_file = StringIO("1 2 doc1\n3 4\n5 6 7 doc3\n")
+        with self.assertRaises(ValueError):
+            vw_helpers.load_lda_predictions(predictions_file, 2)
+
     def test_find_start_line_lda_predictions(self):
         result = vw_helpers.find_start_line_lda_predictions(
             self.predictions_file_1, self.num_topics_1)
@@ -244,6 +313,55 @@ class TestSFileFilter(unittest.TestCase):
             self.sff.filter_sfile(
                 self.sfile_1, self.outfile, doc_id_list=['doc1', 'unseen'])
 
+    def test_get_idf(self):
+        self.sff.load_sfile(self.sfile_1)
+        self.sff.compactify()
+        idf = self.sff.get_idf('tfidf')
+        token2id = self.sff.token2id
+        self.assertEqual(len(idf), 3)
+        self.assertAlmostEqual(idf[token2id['word1']], 1.)
+        self.assertAlmostEqual(idf[token2id['word2']], np.log(1.5) + 1)
+
+    def test_filter_sfile_tfidf_l2(self):
+        self.sff.load_sfile(self.sfile_1)
+        self.sff.compactify()
+        self.sff.filter_sfile(
+            self.sfile_1, self.outfile, weighting='tfidf', normalize='l2')
+        result = self.outfile.getvalue().split('\n')[0]
+        record_dict = text_processors.VWFormatter().sstr_to_dict(result)
+        values = record_dict['feature_values']
+        idf2 = np.log(1.5) + 1
+        norm = np.sqrt(1 + (2 * idf2)**2)
+        token2id = self.sff.token2id
+        self.assertAlmostEqual(values[str(token2id['word1'])], 1 / norm)
+        self.assertAlmostEqual(values[str(token2id['word2'])], 2 * idf2 / norm)
+
+    def test_filter_sfile_bm25(self):
+        self.sff.load_sfile(self.sfile_1)
+        self.sff.compactify()
+        self.sff.filter_sfile(self.sfile_1, self.outfile, weighting='bm25')
+        result = self.outfile.getvalue().split('\n')[0]
+        record_dict = text_processors.VWFormatter().sstr_to_dict(result)
+        values = record_dict['feature_values']
+        # doc1 has length 3, the average length is 6.1 / 2
+        idf = np.log(1 + 1.5 / 1.5)
+        denom = 2 + 1.2 * (1 - 0.75 + 0.75 * 3 / 3.05)
+        token2id = self.sff.token2id
+        self.assertAlmostEqual(
+            values[str(token2id['word2'])], idf * 2 * 2.2 / denom)
+
+    def test_filter_sfile_bm25_empty(self):
+        for sfile in ["", " 1 doc1| word1:0\n"]:
+            sff = text_processors.SFileFilter(
+                text_processors.VWFormatter(), verbose=False)
+            sff.load_sfile(StringIO(sfile))
+            outfile = StringIO()
+            sff.filter_sfile(StringIO(sfile), outfile, weighting='bm25')
+            for line in outfile.getvalue().splitlines():
+                record_dict = sff.formatter.sstr_to_dict(line)
+                self.assertTrue(
+                    np.isfinite(record_dict['feature_values'].values()).all())
+
     def test_compactify_1(self):
         self.sff.token2id = {'a': 1, 'b': 100, 'c': 1000}
         self.sff.compactify()
@@ -261,6 +379,875 @@ class TestSFileFilter(unittest.TestCase):
         self.outfile.close()
 
 
+class TestVWStreamerCached(unittest.TestCase):
+    @property
+    def sfile_1(self):
+        return StringIO(
+            " 1 doc1| word1:1 word2:2\n"
+            " 1 doc2| word1:1 word3:2\n"
+            " 2 doc3| word4:5")
+
+    def test_info_stream(self):
+        streamer = streamers.VWStreamer(self.sfile_1, cache_sfile=True)
+        result = list(streamer.info_stream())
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[0]['doc_id'], 'doc1')
+        self.assertEqual(result[0]['importance'], 1)
+        self.assertEqual(
+            result[0]['feature_values'], {'word1': 1, 'word2': 2})
+        self.assertEqual(sorted(result[2]['tokens']), ['word4'] * 5)
+
+    def test_doc_id(self):
+        streamer = streamers.VWStreamer(self.sfile_1, cache_sfile=True)
+        result = [
+            info['doc_id'] for info in
+            streamer.info_stream(doc_id=['doc3', 'doc1'])]
+        self.assertEqual(result, ['doc3', 'doc1'])
+        with self.assertRaises(KeyError):
+            list(streamer.info_stream(doc_id=['unseen']))
+
+    def test_shuffle(self):
+        streamer = streamers.VWStreamer(
+            self.sfile_1, cache_sfile=True, shuffle=True, seed=1976)
+        result = [info['doc_id'] for info in streamer.info_stream()]
+        self.assertEqual(sorted(result), ['doc1', 'doc2', 'doc3'])
+        self.assertEqual(result, streamer.doc_id)
+        other = streamers.VWStreamer(
+            self.sfile_1, cache_sfile=True, shuffle=True, seed=1976)
+        self.assertEqual(other.doc_id, result)
+
+    def test_duplicates_and_types(self):
+        sfile = StringIO(
+            "1.0 2.5 doc1| word1:1\n"
+            " 1 doc2| word2:2\n"
+            "0.5 2 doc1| word3:3\n")
+        streamer = streamers.VWStreamer(sfile, cache_sfile=True)
+        result = list(streamer.info_stream())
+        self.assertEqual([info['doc_id'] for info in result], ['doc2', 'doc1'])
+        self.assertEqual(streamer.doc_id, ['doc2', 'doc1'])
+        self.assertEqual(result[1]['feature_values'], {'word3': 3})
+        self.assertEqual(result[1]['target'], 0.5)
+        self.assertTrue(isinstance(result[1]['importance'], int))
+
+        streamer = streamers.VWStreamer(
+            StringIO("1.0 2.0 doc1| word1:1\n"), cache_sfile=True)
+        record_dict = streamer.get_record_dict(0)
+        self.assertTrue(isinstance(record_dict['target'], float))
+        self.assertTrue(isinstance(record_dict['importance'], float))
+
+
+class TestSFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sfile = os.path.join(self.tmpdir, 'sfile.vw')
+        with open(self.sfile, 'w') as f:
+            f.write(
+                " 1 doc1| word1:1 word2:2\n"
+                " 1 doc2| word1:1 word3:2\n"
+                " 1 doc3| word4:5\n")
+
+    def test_iter_lines(self):
+        index = text_processors.SFileIndex.get(self.sfile)
+        self.assertEqual(len(index), 3)
+        self.assertTrue(os.path.exists(self.sfile + '.idx'))
+        result = list(index.iter_lines(['doc3', 'unseen', 'doc1']))
+        benchmark = [" 1 doc1| word1:1 word2:2\n", " 1 doc3| word4:5\n"]
+        self.assertEqual(result, benchmark)
+
+    def test_rebuild_when_stale(self):
+        text_processors.SFileIndex.get(self.sfile)
+        with open(self.sfile, 'a') as f:
+            f.write(" 1 doc4| word5:1\n")
+        index = text_processors.SFileIndex.get(self.sfile)
+        self.assertEqual(
+            list(index.iter_lines(['doc4'])), [" 1 doc4| word5:1\n"])
+
+    def test_blank_and_malformed_lines(self):
+        with open(self.sfile, 'a') as f:
+            f.write("\nno preamble here\n 1 doc4| word5:1\n")
+        index = text_processors.SFileIndex.get(self.sfile)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(
+            list(index.iter_lines(['doc4'])), [" 1 doc4| word5:1\n"])
+
+    def test_unsaveable_index(self):
+        index_path = os.path.join(self.tmpdir, 'missing', 'sfile.vw.idx')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            index = text_processors.SFileIndex.get(
+                self.sfile, index_path=index_path)
+        self.assertEqual(len(index), 3)
+        self.assertFalse(os.path.exists(index_path))
+        self.assertEqual(len(caught), 1)
+
+    def test_corrupt_index(self):
+        text_processors.SFileIndex.get(self.sfile)
+        with open(self.sfile + '.idx', 'r+b') as f:
+            f.truncate(10)
+        index = text_processors.SFileIndex.get(self.sfile)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(
+            len(text_processors.SFileIndex.load(self.sfile + '.idx')), 3)
+
+    def test_vwstreamer_doc_id(self):
+        streamer = streamers.VWStreamer(self.sfile)
+        result = [
+            info['doc_id'] for info in streamer.info_stream(doc_id=['doc2'])]
+        self.assertEqual(result, ['doc2'])
+        self.assertFalse(os.path.exists(self.sfile + '.idx'))
+        streamer = streamers.VWStreamer(self.sfile, use_index=True)
+        result = [
+            info['doc_id'] for info in streamer.info_stream(doc_id=['doc2'])]
+        self.assertEqual(result, ['doc2'])
+        self.assertTrue(os.path.exists(self.sfile + '.idx'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class TestTextFileStreamer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for i in range(10):
+            with open(os.path.join(self.tmpdir, 'doc%d.txt' % i), 'w') as f:
+                f.write('hello doc%d' % i)
+        self.tokenizer = text_processors.TokenizerBasic()
+
+    def test_prefetch_order(self):
+        streamer = streamers.TextFileStreamer(
+            text_base_path=self.tmpdir, tokenizer=self.tokenizer,
+            shuffle=False)
+        benchmark = [info['doc_id'] for info in streamer.info_stream()]
+        streamer.prefetch = 3
+        result = [info['doc_id'] for info in streamer.info_stream()]
+        self.assertEqual(result, benchmark)
+        self.assertEqual(sorted(result), ['doc%d' % i for i in range(10)])
+        self.assertTrue(streamer.read_wait_time >= 0)
+
+    def test_prefetch_limit(self):
+        streamer = streamers.TextFileStreamer(
+            text_base_path=self.tmpdir, tokenizer=self.tokenizer,
+            prefetch=4)
+        result = list(streamer.info_stream(limit=3))
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[0]['tokens'][0], 'hello')
+
+    def test_to_vw(self):
+        streamer = streamers.TextFileStreamer(
+            text_base_path=self.tmpdir, tokenizer=self.tokenizer)
+        benchmark = StringIO()
+        streamer.to_vw(benchmark, chunksize=3)
+        result = StringIO()
+        streamer.to_vw(result, n_jobs=2, chunksize=3)
+        self.assertEqual(result.getvalue(), benchmark.getvalue())
+        self.assertEqual(len(result.getvalue().splitlines()), 10)
+        self.assertEqual(streamer.to_vw_stats['num_chunks'], 4)
+        self.assertTrue(streamer.to_vw_stats['bytes_saved'] > 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class TestDBStreamer(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute("CREATE TABLE Document (id INTEGER, body TEXT)")
+        rows = [(i, 'hello document number%d' % i) for i in range(1, 8)]
+        rows.append((8, ''))
+        self.db.executemany("INSERT INTO Document VALUES (?, ?)", rows)
+        self.tokenizer = text_processors.TokenizerBasic()
+
+    def test_info_stream(self):
+        streamer = streamers.DBStreamer(
+            self.db, table='Document', tokenizer=self.tokenizer, batch_size=3)
+        result = list(streamer.info_stream())
+        self.assertEqual(
+            [info['doc_id'] for info in result],
+            [str(i) for i in range(1, 8)])
+        self.assertEqual(result[0]['text'], 'hello document number1')
+        self.assertEqual(result[0]['tokens'][:2], ['hello', 'document'])
+
+    def test_doc_id_limit(self):
+        streamer = streamers.DBStreamer(
+            self.db, table='Document', batch_size=2)
+        result = [
+            info['doc_id'] for info in streamer.info_stream(doc_id=[5, 2, 7])]
+        self.assertEqual(sorted(result), ['2', '5', '7'])
+        self.assertEqual(len(list(streamer.info_stream(limit=4))), 4)
+
+    def test_doc_id_stream(self):
+        streamer = streamers.DBStreamer(
+            self.db, table='Document', batch_size=3)
+        doc_ids = list(streamer.doc_id_stream())
+        self.assertEqual(doc_ids, range(1, 9))
+        todo = (doc_id for doc_id in doc_ids if doc_id % 3 == 0)
+        result = [info['doc_id'] for info in streamer.info_stream(doc_id=todo)]
+        self.assertEqual(sorted(result), ['3', '6'])
+
+    def test_to_vw(self):
+        streamer = streamers.DBStreamer(
+            self.db, table='Document', tokenizer=self.tokenizer, limit=2)
+        outfile = StringIO()
+        streamer.to_vw(outfile)
+        lines = outfile.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith(" 1 1| "))
+
+    def tearDown(self):
+        self.db.close()
+
+
+class TestExternalShuffle(unittest.TestCase):
+    def setUp(self):
+        self.lines = ['line%d\n' % i for i in range(100)]
+
+    def shuffled(self, seed, num_buckets):
+        outfile = StringIO()
+        common.external_shuffle(
+            StringIO(''.join(self.lines)), outfile, seed=seed,
+            num_buckets=num_buckets)
+        return outfile.getvalue().splitlines(True)
+
+    def test_permutation(self):
+        result = self.shuffled(1976, 4)
+        self.assertEqual(sorted(result), sorted(self.lines))
+        self.assertNotEqual(result, self.lines)
+
+    def test_seed(self):
+        self.assertEqual(self.shuffled(1976, 4), self.shuffled(1976, 4))
+        self.assertNotEqual(self.shuffled(1976, 4), self.shuffled(1977, 4))
+
+    def test_many_buckets(self):
+        # More buckets than a process may usually have open files, written
+        # in several batches
+        outfile = StringIO()
+        common.external_shuffle(
+            StringIO(''.join(self.lines)), outfile, seed=1976,
+            num_buckets=5000, buffer_bytes=100)
+        self.assertEqual(
+            sorted(outfile.getvalue().splitlines(True)), sorted(self.lines))
+
+    def test_buffered_shuffle(self):
+        result = list(common.buffered_shuffle(self.lines, 10, seed=3))
+        self.assertEqual(sorted(result), sorted(self.lines))
+        self.assertNotEqual(result, self.lines)
+        self.assertEqual(
+            result, list(common.buffered_shuffle(self.lines, 10, seed=3)))
+        # Items move at most buffer_size positions earlier
+        for i, line in enumerate(result):
+            self.assertTrue(self.lines.index(line) <= i + 10)
+
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        self.doc_ids = ['doc%d' % i for i in range(100)]
+
+    def test_in_shard(self):
+        shards = [
+            [d for d in self.doc_ids if common.in_shard(d, (k, 3))]
+            for k in range(3)]
+        self.assertEqual(sum(len(shard) for shard in shards), 100)
+        self.assertEqual(sorted(sum(shards, [])), sorted(self.doc_ids))
+
+    def test_check_shard_manifests(self):
+        manifests = [
+            common.ShardManifest.from_doc_ids(
+                [d for d in self.doc_ids if common.in_shard(d, (k, 3))],
+                shard=(k, 3))
+            for k in range(3)]
+        reference = common.ShardManifest.from_doc_ids(self.doc_ids)
+        combined = common.check_shard_manifests(manifests, reference)
+        self.assertEqual(combined.num_docs, 100)
+        with self.assertRaises(ValueError):
+            common.check_shard_manifests(manifests[:2], reference)
+        with self.assertRaises(ValueError):
+            common.check_shard_manifests(
+                manifests, common.ShardManifest.from_doc_ids(
+                    self.doc_ids[1:]))
+
+    def test_manifest_save_load(self):
+        manifest = common.ShardManifest.from_doc_ids(self.doc_ids)
+        savefile = StringIO()
+        manifest.save(savefile)
+        savefile.seek(0)
+        loaded = common.ShardManifest.load(savefile)
+        self.assertEqual(loaded.to_dict(), manifest.to_dict())
+
+    def test_vwstreamer_shard(self):
+        sfile = ''.join(' 1 %s| a:1\n' % d for d in self.doc_ids)
+        result = []
+        for k in range(2):
+            streamer = streamers.VWStreamer(StringIO(sfile), shard=(k, 2))
+            result += [info['doc_id'] for info in streamer.info_stream()]
+        self.assertEqual(sorted(result), sorted(self.doc_ids))
+
+        # limit counts the records in the shard, not the lines read
+        streamer = streamers.VWStreamer(
+            StringIO(sfile), shard=(1, 2), limit=10)
+        result = [info['doc_id'] for info in streamer.info_stream()]
+        self.assertEqual(len(result), 10)
+        self.assertTrue(
+            all(common.in_shard(doc_id, (1, 2)) for doc_id in result))
+
+
+class TestSpillCache(unittest.TestCase):
+    def test_spill(self):
+        cache = common.SpillCache(max_bytes=500)
+        items = [['token%d' % i] * 3 for i in range(50)]
+        for item in items:
+            cache.append(item)
+        self.assertTrue(cache.num_spilled_blocks > 1)
+        self.assertEqual(len(cache), 50)
+        self.assertEqual(list(cache), items)
+        # Can iterate more than once
+        self.assertEqual(list(cache), items)
+        cache.close()
+
+    def test_single_stream_cache(self):
+        streamer = streamers.VWStreamer(
+            StringIO(" 1 doc1| a:1\n 1 doc2| b:2\n 1 doc3| c:1"))
+        tokens = list(streamer.token_stream(
+            cache_list=['doc_id'], cache_max_bytes=100))
+        self.assertEqual(tokens, [['a'], ['b', 'b'], ['c']])
+        self.assertEqual(list(streamer.doc_id_cache), ['doc1', 'doc2', 'doc3'])
+
+
+class TestArchiveStreamer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.texts = dict(
+            ('doc%d' % i, 'hello there cable%d' % i) for i in range(6))
+        self.tar_path = os.path.join(self.tmpdir, 'docs.tar.gz')
+        self.zip_path = os.path.join(self.tmpdir, 'docs.zip')
+        with tarfile.open(self.tar_path, 'w:gz') as tar:
+            for doc_id, text in sorted(self.texts.items()):
+                info = tarfile.TarInfo('docs/%s.txt' % doc_id)
+                info.size = len(text)
+                tar.addfile(info, StringIO(text))
+        with zipfile.ZipFile(self.zip_path, 'w') as archive:
+            for doc_id, text in sorted(self.texts.items()):
+                archive.writestr('docs/%s.txt' % doc_id, text)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_info_stream(self):
+        for path in [self.tar_path, self.zip_path]:
+            streamer = streamers.ArchiveStreamer(path)
+            result = dict(
+                (info['doc_id'], info['text'])
+                for info in streamer.info_stream())
+            self.assertEqual(result, self.texts)
+
+    def test_limit_file_type(self):
+        streamer = streamers.ArchiveStreamer(
+            [self.tar_path, self.zip_path], file_type='*.txt', limit=8)
+        self.assertEqual(len(list(streamer.info_stream())), 8)
+        streamer = streamers.ArchiveStreamer(self.zip_path, file_type='*.xml')
+        self.assertEqual(list(streamer.info_stream()), [])
+
+    def test_to_vw(self):
+        streamer = streamers.ArchiveStreamer(
+            self.tar_path, tokenizer=text_processors.TokenizerBasic())
+        serial, parallel = StringIO(), StringIO()
+        streamer.to_vw(serial, chunksize=2)
+        streamer.to_vw(parallel, n_jobs=2, chunksize=2)
+        self.assertEqual(serial.getvalue(), parallel.getvalue())
+        self.assertEqual(len(serial.getvalue().splitlines()), 6)
+
+
+class TestDocStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.tmpdir, 'docs.pack')
+        self.texts = [
+            ('doc%d' % i, 'The cable number %d was sent today.' % i)
+            for i in range(10)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _pack(self, **kwargs):
+        with docstore.DocStore(self.store_path, mode='a', **kwargs) as store:
+            for doc_id, text in self.texts:
+                store.add(doc_id, text)
+
+    def test_zlib_roundtrip(self):
+        self._pack(compression='zlib')
+        store = docstore.DocStore(self.store_path)
+        self.assertEqual(len(store), 10)
+        self.assertEqual(store.get('doc3'), self.texts[3][1])
+        self.assertEqual(list(store), self.texts)
+        self.assertEqual(
+            list(store.iter_doc_id(['doc7', 'doc2'])),
+            [self.texts[2], self.texts[7]])
+
+    def test_readd_supersedes(self):
+        self._pack()
+        with docstore.DocStore(self.store_path, mode='a') as store:
+            store.add('doc1', 'replaced')
+        store = docstore.DocStore(self.store_path)
+        self.assertEqual(len(store), 10)
+        self.assertEqual(store.get('doc1'), 'replaced')
+        self.assertEqual(store.doc_id[-1], 'doc1')
+        self.assertEqual(dict(store)['doc1'], 'replaced')
+
+    def test_crash_recovery(self):
+        self._pack(compression='zlib')
+        # Simulate a crash mid-add:  orphan data bytes, a partial index line
+        with open(self.store_path, 'ab') as f:
+            f.write('orphan bytes')
+        with open(self.store_path + '.idx', 'ab') as f:
+            f.write('doc10\t99')
+
+        store = docstore.DocStore(self.store_path)
+        self.assertEqual(list(store), self.texts)
+
+        with docstore.DocStore(self.store_path, mode='a') as store:
+            store.add('doc11', 'after the crash')
+        store = docstore.DocStore(self.store_path)
+        self.assertEqual(
+            list(store), self.texts + [('doc11', 'after the crash')])
+        self.assertEqual(store.get('doc11'), 'after the crash')
+
+    def test_zstd_dict(self):
+        if docstore.zstandard is None:
+            self.skipTest('zstandard not installed')
+        texts = [text for doc_id, text in self.texts] * 20
+        zstd_dict = docstore.train_zstd_dict(texts, dict_size=1024)
+        self._pack(compression='zstd', zstd_dict=zstd_dict)
+        store = docstore.DocStore(self.store_path)
+        self.assertEqual(list(store), self.texts)
+
+    def test_streamer(self):
+        self._pack(compression='zlib')
+        streamer = streamers.DocStoreStreamer(
+            self.store_path, tokenizer=text_processors.TokenizerBasic())
+        self.assertEqual(
+            [info['doc_id'] for info in streamer.info_stream(limit=3)],
+            ['doc0', 'doc1', 'doc2'])
+        tokens = list(streamer.token_stream(doc_id=['doc5']))
+        self.assertEqual(tokens, [['cable', 'number', 'sent', 'today']])
+
+
+class TestSampling(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for i in range(30):
+            subdir = os.path.join(self.tmpdir, 'year%d' % (i % 3))
+            if not os.path.exists(subdir):
+                os.mkdir(subdir)
+            with open(os.path.join(subdir, 'doc%d.txt' % i), 'w') as f:
+                f.write('hello there')
+        self.years = dict(('doc%d' % i, 2000 + i % 3) for i in range(30))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reservoir_sample(self):
+        sample = common.reservoir_sample(xrange(1000), 10, seed=3)
+        self.assertEqual(len(sample), 10)
+        self.assertEqual(sample, sorted(set(sample)))
+        self.assertEqual(
+            sample, common.reservoir_sample(xrange(1000), 10, seed=3))
+        self.assertEqual(common.reservoir_sample('ab', 5), ['a', 'b'])
+
+    def test_stratified_reservoir_sample(self):
+        sample = common.stratified_reservoir_sample(
+            xrange(100), {0: 2, 1: 3}, lambda x: x % 3, seed=0)
+        self.assertEqual(sorted(sample), [0, 1])
+        self.assertEqual(len(sample[0]), 2)
+        self.assertEqual(len(sample[1]), 3)
+        self.assertTrue(all(x % 3 == 1 for x in sample[1]))
+
+    def test_sampled_textfilestreamer(self):
+        streamer = streamers.SampledTextFileStreamer(
+            self.tmpdir, 5, seed=1)
+        doc_id = [info['doc_id'] for info in streamer.info_stream()]
+        self.assertEqual(len(set(doc_id)), 5)
+        other = streamers.SampledTextFileStreamer(self.tmpdir, 5, seed=1)
+        self.assertEqual(other.doc_id, doc_id)
+
+    def test_sampled_textfilestreamer_strata(self):
+        streamer = streamers.SampledTextFileStreamer(
+            self.tmpdir, {2000: 2, 2002: 3}, seed=1, strata=self.years)
+        years = Counter(self.years[doc] for doc in streamer.doc_id)
+        self.assertEqual(years, Counter({2000: 2, 2002: 3}))
+
+    def test_sampled_vwstreamer(self):
+        sfile = ''.join(' 1 doc%d| a:%d\n' % (i, i + 1) for i in range(30))
+        streamer = streamers.SampledVWStreamer(
+            StringIO(sfile), 2, seed=2, strata=lambda doc: doc[-1])
+        doc_id = [info['doc_id'] for info in streamer.info_stream()]
+        self.assertEqual(len(set(doc_id)), 20)
+        self.assertEqual(
+            set(Counter(doc[-1] for doc in doc_id).values()), set([2]))
+
+
+def _upper_chunk(chunk):
+    return [item.upper() for item in chunk]
+
+
+def _fail_on_a7_chunk(chunk):
+    if 'a7' in chunk:
+        raise RuntimeError('worker crashed')
+    return _upper_chunk(chunk)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint_dir = os.path.join(self.tmpdir, 'ckpt')
+        self.items = ['a%d' % i for i in range(10)]
+        self.benchmark = ''.join('A%d\n' % i for i in range(10))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume(self):
+        checkpoint = common.Checkpoint(self.checkpoint_dir)
+        items = checkpoint.get_items(self.items)
+        with self.assertRaises(RuntimeError):
+            checkpoint.run(_fail_on_a7_chunk, items, StringIO(), chunksize=2)
+
+        # Restart:  The saved items are used, finished segments are skipped
+        checkpoint = common.Checkpoint(self.checkpoint_dir)
+        items = checkpoint.get_items(['ignored'])
+        self.assertEqual(items, self.items)
+        outfile = StringIO()
+        stats = checkpoint.run(_upper_chunk, items, outfile, chunksize=2)
+        self.assertEqual(stats['num_resumed'], 3)
+        self.assertEqual(stats['num_written'], 2)
+        self.assertEqual(outfile.getvalue(), self.benchmark)
+
+    def test_get_items_keeps_whitespace(self):
+        checkpoint = common.Checkpoint(self.checkpoint_dir)
+        items = checkpoint.get_items(['a \n', ' b', 'c\t'])
+        self.assertEqual(items, ['a ', ' b', 'c\t'])
+        self.assertEqual(
+            common.Checkpoint(self.checkpoint_dir).get_items([]), items)
+
+    def test_resume_n_jobs(self):
+        checkpoint = common.Checkpoint(self.checkpoint_dir)
+        with self.assertRaises(RuntimeError):
+            checkpoint.run(
+                _fail_on_a7_chunk, self.items, StringIO(), chunksize=3,
+                n_jobs=2)
+        outfile = StringIO()
+        stats = common.Checkpoint(self.checkpoint_dir).run(
+            _upper_chunk, self.items, outfile, chunksize=3, n_jobs=2)
+        self.assertEqual(stats['num_segments'], 4)
+        self.assertEqual(outfile.getvalue(), self.benchmark)
+
+    def test_mismatch(self):
+        checkpoint = common.Checkpoint(self.checkpoint_dir, config={'a': 1})
+        checkpoint.run(_upper_chunk, self.items, StringIO(), chunksize=2)
+        with self.assertRaises(ValueError):
+            common.Checkpoint(self.checkpoint_dir, config={'a': 2})
+        with self.assertRaises(ValueError):
+            common.Checkpoint(self.checkpoint_dir, config={'a': 1}).run(
+                _upper_chunk, self.items, StringIO(), chunksize=3)
+
+    def test_textfilestreamer_to_vw(self):
+        for i in range(5):
+            with open(os.path.join(self.tmpdir, 'doc%d.txt' % i), 'w') as f:
+                f.write('hello there cable%d' % i)
+        streamer = streamers.TextFileStreamer(
+            text_base_path=self.tmpdir, file_type='*.txt', shuffle=False,
+            tokenizer=text_processors.TokenizerBasic())
+        plain, checkpointed = StringIO(), StringIO()
+        streamer.to_vw(plain)
+        streamer.to_vw(
+            checkpointed, chunksize=2, checkpoint_dir=self.checkpoint_dir)
+        self.assertEqual(plain.getvalue(), checkpointed.getvalue())
+
+
+class TestGetPaths(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for sub in ['a', 'a/b', 'c']:
+            os.makedirs(os.path.join(self.tmpdir, sub))
+            for name in ['doc1.txt', 'doc2.TXT', 'notes.xml']:
+                path = os.path.join(self.tmpdir, sub, name)
+                with open(path, 'w') as f:
+                    f.write('hello')
+                self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_paths(self):
+        paths = filefilter.get_paths(self.tmpdir, file_type='*.txt')
+        self.assertEqual(
+            sorted(paths),
+            sorted(p for p in self.paths if not p.endswith('.xml')))
+        self.assertEqual(
+            filefilter.get_paths(self.tmpdir, file_type='*.txt', n_threads=3),
+            paths)
+        relative = filefilter.get_paths(self.tmpdir, relative=True, limit=4)
+        self.assertEqual(len(relative), 4)
+        self.assertTrue(
+            all(os.path.join(self.tmpdir, p) in self.paths for p in relative))
+
+    def test_path_manifest(self):
+        manifest_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, manifest_dir)
+        manifest_path = os.path.join(manifest_dir, 'tree.manifest')
+        manifest = filefilter.PathManifest.update(manifest_path, self.tmpdir)
+        self.assertEqual(len(manifest), 9)
+        self.assertEqual(
+            set(path for path, size, mtime in manifest.iter_files()),
+            set(self.paths))
+        manifest = filefilter.PathManifest.update(manifest_path, self.tmpdir)
+        self.assertEqual(manifest.num_rescanned, 0)
+
+        new_path = os.path.join(self.tmpdir, 'a', 'b', 'doc3.txt')
+        with open(new_path, 'w') as f:
+            f.write('hello again')
+        paths = filefilter.get_paths(
+            self.tmpdir, file_type='*.txt', manifest=manifest_path)
+        self.assertTrue(new_path in paths)
+        manifest = filefilter.PathManifest.load(manifest_path)
+        self.assertEqual(manifest.num_rescanned, 1)
+
+    def test_path_manifest_modified_in_place(self):
+        manifest_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, manifest_dir)
+        manifest_path = os.path.join(manifest_dir, 'tree.manifest')
+        filefilter.PathManifest.update(manifest_path, self.tmpdir)
+
+        path = self.paths[0]
+        dir_mtime = os.stat(os.path.dirname(path)).st_mtime
+        with open(path, 'a') as f:
+            f.write(' and more')
+        self.assertEqual(os.stat(os.path.dirname(path)).st_mtime, dir_mtime)
+
+        # By default unchanged directories are trusted
+        manifest = filefilter.PathManifest.update(manifest_path, self.tmpdir)
+        self.assertEqual(manifest.num_rescanned, 0)
+
+        manifest = filefilter.PathManifest.update(
+            manifest_path, self.tmpdir, restat_files=True)
+        self.assertEqual(manifest.num_rescanned, 1)
+        sizes = dict(
+            (p, size) for p, size, mtime in manifest.iter_files())
+        self.assertEqual(sizes[path], os.path.getsize(path))
+
+
+class TestDocIdIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base_path = os.path.join(self.tmpdir, 'docs')
+        self.db_path = os.path.join(self.tmpdir, 'docs.db')
+        for sub in ['a', 'b']:
+            os.makedirs(os.path.join(self.base_path, sub))
+            for i in range(3):
+                self._write(sub, 'doc%s%d.txt' % (sub, i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, sub, name):
+        path = os.path.join(self.base_path, sub, name)
+        with open(path, 'w') as f:
+            f.write('hello %s' % name)
+        return path
+
+    def test_update(self):
+        index = filefilter.DocIdIndex(self.db_path, self.base_path)
+        self.assertEqual(index.update(), 3)
+        self.assertEqual(len(index), 6)
+        self.assertEqual(
+            index['doca1'], os.path.join(self.base_path, 'a', 'doca1.txt'))
+        self.assertFalse('docc0' in index)
+        with self.assertRaises(KeyError):
+            index['docc0']
+
+        # Reopen (settings are read back) and update incrementally
+        new_path = self._write('b', 'docb9.txt')
+        os.remove(os.path.join(self.base_path, 'a', 'doca0.txt'))
+        index = filefilter.DocIdIndex(self.db_path)
+        self.assertEqual(index.update(), 2)
+        self.assertEqual(index['docb9'], new_path)
+        self.assertFalse('doca0' in index)
+        self.assertEqual(index.update(), 0)
+
+        with self.assertRaises(ValueError):
+            filefilter.DocIdIndex(self.db_path, file_type='*.xml')
+
+    def test_non_ascii_path(self):
+        path = self._write('a', 'doc\xc3\xa9.txt')
+        index = filefilter.DocIdIndex(self.db_path, self.base_path)
+        index.update()
+        self.assertEqual(index['doc\xc3\xa9'], path)
+        self.assertEqual(index[u'doc\xe9'], path)
+
+    def test_get_doc_id_index_refresh(self):
+        filefilter.get_doc_id_index(self.db_path, self.base_path)
+        new_path = self._write('b', 'docb9.txt')
+        # An existing index is opened without a crawl...
+        index = filefilter.get_doc_id_index(self.db_path, self.base_path)
+        self.assertFalse('docb9' in index)
+        # ...unless asked to refresh
+        index = filefilter.get_doc_id_index(
+            self.db_path, self.base_path, refresh=True)
+        self.assertEqual(index['docb9'], new_path)
+        self.assertEqual(
+            [name for name in os.listdir(self.tmpdir) if name.endswith('.tmp')],
+            [])
+        # Reopening an existing index leaves a single copy of the settings
+        self.assertEqual(
+            index._conn.execute("SELECT COUNT(*) FROM meta").fetchone()[0], 3)
+
+    def test_streamer(self):
+        streamer = streamers.TextFileStreamer(
+            text_base_path=self.base_path, doc_id_index=self.db_path)
+        texts = [
+            info['text'] for info in streamer.info_stream(
+                doc_id=['docb2', 'doca1'])]
+        self.assertEqual(texts, ['hello docb2.txt', 'hello doca1.txt'])
+        self.assertFalse('_lazy_paths' in streamer.__dict__)
+        finder = filefilter.PathFinder(
+            text_base_path=self.base_path, doc_id_index=self.db_path)
+        self.assertEqual(
+            finder['doca2'], [os.path.join(self.base_path, 'a', 'doca2.txt')])
+
+
+class TestPartitionedWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.template = os.path.join(self.tmpdir, 'part-{}.vw')
+        self.lines = [' 1 doc%d| a:%d\n' % (i, i + 1) for i in range(50)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            return f.readlines()
+
+    def test_hash(self):
+        writer = common.PartitionedWriter(
+            self.template, common.hash_partitioner(5), max_open=2,
+            buffer_bytes=20, compress='gz')
+        with writer:
+            writer.writelines(self.lines)
+        self.assertEqual(len(writer.paths), 5)
+        result = []
+        for partition, path in writer.paths.iteritems():
+            lines = self.read(path)
+            self.assertEqual(len(lines), writer.counts[partition])
+            for line in lines:
+                doc_id = line.split('|')[0].split()[-1]
+                self.assertTrue(common.in_shard(doc_id, (int(partition), 5)))
+            result += lines
+        self.assertEqual(sorted(result), sorted(self.lines))
+
+    def test_round_robin(self):
+        with common.PartitionedWriter(
+            self.template, common.round_robin_partitioner(3)) as writer:
+            writer.writelines(self.lines)
+        self.assertEqual(self.read(writer.paths['1']), self.lines[1::3])
+
+    def test_key(self):
+        meta_path = os.path.join(self.tmpdir, 'meta.csv')
+        with open(meta_path, 'w') as f:
+            f.write('doc_id|year\n')
+            for i in range(40):
+                f.write('doc%d|%d\n' % (i, 1970 + i % 2))
+        partitioner = common.get_partitioner(
+            'key', meta_path=meta_path, key='year')
+        with common.PartitionedWriter(self.template, partitioner) as writer:
+            writer.writelines(self.lines)
+        self.assertEqual(
+            writer.counts, {'1970': 20, '1971': 20, 'unknown': 10})
+        self.assertEqual(
+            self.read(writer.paths['1971']), self.lines[1:40:2])
+
+
+class TestDDRS(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rows = [
+            (i, '<DOC.BODY>text %d<?HR?>footer<?PRE?>page 2</DOC.BODY>' % i)
+            for i in range(10)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, id, spec):
+        with open(os.path.join(self.tmpdir, '%d.%s.txt' % (id, spec))) as f:
+            return f.read()
+
+    def test_document(self):
+        text = (
+            '<DOC.BODY><PARA>a\\nb</PARA><?BR?>c<?HR?>foot<?PRE?>d'
+            '</DOC.BODY>')
+        doc = ddrs.Document(3, text)
+        self.assertEqual(
+            doc.clean_text,
+            '  \n a \n b \n  \n c *FOOTER* foot *PAGE* d ')
+        self.assertEqual(
+            doc.sectioned_pages,
+            [{'body': '  \n a \n b \n  \n c ', 'footer': ' foot '},
+             {'body': ' d ', 'footer': ''}])
+        self.assertEqual(doc.format('raw'), text)
+        self.assertFalse(hasattr(doc, '__dict__'))
+
+    def test_iter_pages(self):
+        text = '<PARA>one<?HR?>f1<?HR?>f2<?PRE?>two<?PRE?><?HR?>f3'
+        doc = ddrs.Document(3, text)
+        self.assertEqual(
+            doc.page_spans(),
+            [(0, 9, 15, 25), (32, 35, 35, 35), (42, 42, 48, 50)])
+        self.assertEqual(
+            list(doc.iter_pages()),
+            [(1, ' \n one', 'f1 *FOOTER* f2'), (2, 'two', ''), (3, '', 'f3')])
+
+    def test_page_streamer(self):
+        ddrs.write_documents(self.tmpdir, self.rows[:3], ['raw'])
+        streamer = ddrs.PageStreamer(
+            text_base_path=self.tmpdir,
+            tokenizer=text_processors.TokenizerBasic())
+        infos = sorted(streamer.info_stream(), key=lambda info: info['doc_id'])
+        self.assertEqual(len(infos), 6)
+        self.assertEqual(infos[1]['doc_id'], '0_2')
+        self.assertEqual(infos[1]['tokens'], ['page'])
+        self.assertEqual(infos[0]['footer'], 'footer')
+
+        outfile = StringIO()
+        streamer.to_vw(outfile, n_jobs=2, chunksize=2)
+        self.assertEqual(
+            sorted(outfile.getvalue().splitlines())[:2],
+            [' 1 0_1| text:1', ' 1 0_2| page:1'])
+
+    def test_write_documents(self):
+        num_written = ddrs.write_documents(
+            self.tmpdir, self.rows, ['raw', 'nofoot'], n_jobs=2, chunksize=3)
+        self.assertEqual(num_written, 10)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 20)
+        self.assertEqual(self.read(7, 'raw'), self.rows[7][1])
+        doc = ddrs.Document(*self.rows[7])
+        self.assertEqual(self.read(7, 'nofoot'), doc.format('nofoot'))
+
+    def test_write_documents_resume(self):
+        ddrs.write_documents(self.tmpdir, self.rows[:4], ['raw', 'clean'])
+        os.remove(os.path.join(self.tmpdir, '2.clean.txt'))
+        num_written = ddrs.write_documents(
+            self.tmpdir, self.rows, ['raw', 'clean'], resume=True)
+        self.assertEqual(num_written, 7)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 20)
+
+    def test_write_documents_null_text(self):
+        num_written = ddrs.write_documents(
+            self.tmpdir, [(1, None)], ['raw', 'clean'])
+        self.assertEqual(num_written, 1)
+        self.assertEqual(self.read(1, 'raw'), '')
+        self.assertEqual(self.read(1, 'clean'), '')
+
+
 class TestTopic(unittest.TestCase):
     def setUp(self):
         self.Topics = topic_seek.Topics
@@ -1,14 +1,25 @@
 """
 Common functions/classes for dataprep.
 """
+from collections import OrderedDict, deque
 from random import choice
 import numpy as np
+import os
+import random
+import resource
+import shutil
 import sys
+import tempfile
+import threading
+import zlib
 import csv
+import gzip
+import hashlib
 import json
 import cPickle
 from StringIO import StringIO
-from itertools import izip_longest
+from itertools import count, islice, izip, izip_longest
+from multiprocessing import Pool, cpu_count
 
 
 ################################################################################
@@ -245,6 +256,21 @@ class smart_open(object):
         return False
 
 
+def get_outfile_name(outfile):
+    """
+    Return a name identifying outfile:  the path itself, the name of an open
+    file, or the path_template of a PartitionedWriter.  None for buffers
+    (e.g. StringIO) that have no name.
+    """
+    if isinstance(outfile, basestring):
+        return outfile
+    for attr in ['name', 'path_template']:
+        if hasattr(outfile, attr):
+            return getattr(outfile, attr)
+
+    return None
+
+
 ################################################################################
 # Functions to read special file formats
 ################################################################################
@@ -460,6 +486,1013 @@ def grouper(iterable, chunksize, fillvalue=None):
     return izip_longest(fillvalue=fillvalue, *args)
 
 
+def chunker(iterable, chunksize):
+    """
+    Group iterable into lists of length chunksize.  Unlike grouper, the
+    (possibly) shorter last chunk is not padded.
+
+    chunker('ABCDEFG', 3) --> ABC DEF G
+
+    Parameters
+    ----------
+    iterable : Iterable
+    chunksize : Integer
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunksize))
+        if not chunk:
+            raise StopIteration
+        yield chunk
+
+
+def get_num_jobs(n_jobs):
+    """
+    Convert an n_jobs argument to a positive number of processes.
+    -1 means all available CPUs, -2 all except 1, ...
+    """
+    if n_jobs < 0:
+        n_jobs = cpu_count() + 1 + n_jobs
+
+    return max(1, n_jobs)
+
+
+def bounded_imap(pool, func, iterable, buffer_size):
+    """
+    Like pool.imap(func, iterable), but with at most buffer_size results
+    pending at once.  pool.imap consumes iterable as fast as it can, which
+    for a long (or lazy) iterable means unbounded memory.
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool or multiprocessing.pool.ThreadPool
+    func : Function
+        Applied to every item in iterable
+    iterable : Iterable
+    buffer_size : Positive integer
+        Maximum number of submitted but not yet yielded results.
+
+    Returns
+    -------
+    results : Iterator
+        func(item) for item in iterable, in order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= buffer_size:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def buffered_shuffle(iterable, buffer_size, seed=None):
+    """
+    Lazily shuffle iterable using a buffer of buffer_size items.  Every
+    incoming item replaces a random item of the (full) buffer, which is
+    yielded.  Memory is bounded by buffer_size, and the first item is
+    yielded after reading only buffer_size items.
+
+    The result is only partially random:  an item can move at most about
+    buffer_size positions earlier (but arbitrarily far later).  For a full
+    shuffle, follow with external_shuffle.
+
+    Parameters
+    ----------
+    iterable : Iterable
+    buffer_size : Positive integer
+    seed : Hashable or None
+        The same seed (and iterable) gives the same order.
+    """
+    rng = random.Random(seed)
+    iterator = iter(iterable)
+    buf = list(islice(iterator, buffer_size))
+    rng.shuffle(buf)
+
+    for item in iterator:
+        i = rng.randrange(len(buf))
+        yield buf[i]
+        buf[i] = item
+
+    rng.shuffle(buf)
+    for item in buf:
+        yield item
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident set size, in MB, of this process (or, if children, of the
+    largest terminated child process).
+    """
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on OS X, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return maxrss / 2.**20
+    else:
+        return maxrss / 2.**10
+
+
+def external_shuffle(
+    infile, outfile, seed=None, num_buckets=None, bucket_bytes=2**28,
+    tmpdir=None, buffer_bytes=2**24):
+    """
+    Shuffle the lines of infile, writing them to outfile, using temporary
+    files rather than memory.  Memory use is bounded by the size of the
+    largest bucket (plus buffer_bytes).
+
+    Lines are first scattered at random into num_buckets temporary buckets,
+    then every bucket is shuffled in memory and appended to outfile.  Since
+    every line picks its bucket uniformly at random, the result is a uniform
+    random permutation.
+
+    Scattered lines are held in memory, then appended to the buckets in
+    batches of about buffer_bytes, opening one bucket at a time.  So
+    num_buckets is not limited by the number of files a process may have
+    open.
+
+    Parameters
+    ----------
+    infile : filepath or buffer
+    outfile : filepath or buffer
+    seed : Hashable
+        Seed for the random number generator.  The same seed (and the same
+        num_buckets) gives the same permutation.
+    num_buckets : Integer
+        Number of temporary buckets.  If None and infile is a path, use
+        enough buckets so that each holds about bucket_bytes.  If None and
+        infile is a buffer, use 16.
+    bucket_bytes : Integer
+        Target size of one bucket in bytes.  Used only to set num_buckets.
+    tmpdir : String
+        Directory to hold the buckets.  Defaults to the system temp dir.
+    buffer_bytes : Integer
+        Write scattered lines to the buckets every time about this many
+        bytes are held in memory.
+    """
+    rand = random.Random(seed)
+
+    if num_buckets is None:
+        if isinstance(infile, basestring):
+            num_buckets = int(
+                np.ceil(os.path.getsize(infile) / float(bucket_bytes)))
+        else:
+            num_buckets = 16
+    num_buckets = max(1, num_buckets)
+
+    bucket_dir = tempfile.mkdtemp(dir=tmpdir)
+    bucket_paths = [
+        os.path.join(bucket_dir, 'bucket-%d' % i) for i in xrange(num_buckets)]
+    try:
+        # Scatter
+        pending = [[] for i in xrange(num_buckets)]
+        num_pending_bytes = 0
+        with smart_open(infile, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    line += '\n'
+                pending[rand.randrange(num_buckets)].append(line)
+                num_pending_bytes += len(line)
+                if num_pending_bytes >= buffer_bytes:
+                    _append_to_buckets(bucket_paths, pending)
+                    num_pending_bytes = 0
+        _append_to_buckets(bucket_paths, pending)
+
+        # Shuffle each bucket in memory and gather
+        with smart_open(outfile, 'wb') as g:
+            for bucket_path in bucket_paths:
+                if not os.path.exists(bucket_path):
+                    continue
+                with open(bucket_path, 'rb') as bucket:
+                    lines = bucket.readlines()
+                rand.shuffle(lines)
+                g.writelines(lines)
+    finally:
+        shutil.rmtree(bucket_dir)
+
+
+def _append_to_buckets(bucket_paths, pending):
+    """
+    Append pending[i] (a list of lines, emptied) to bucket_paths[i], with one
+    bucket open at a time.
+    """
+    for bucket_path, lines in izip(bucket_paths, pending):
+        if lines:
+            with open(bucket_path, 'ab') as bucket:
+                bucket.writelines(lines)
+            del lines[:]
+
+
+###############################################################################
+# Sampling
+###############################################################################
+
+
+def reservoir_sample(iterable, k, seed=None):
+    """
+    Uniform random sample (without replacement) of k items from iterable,
+    drawn in one pass while holding only k items in memory.
+
+    Parameters
+    ----------
+    iterable : Iterable
+    k : Nonnegative integer
+        Sample size.  If iterable has fewer than k items, return them all.
+    seed : Hashable or None
+        The same seed (and iterable) gives the same sample.
+
+    Returns
+    -------
+    sample : List
+        The sampled items, in the order they appeared in iterable.
+
+    Notes
+    -----
+    Uses "Algorithm L" (Li 1994), which draws O(k log(n / k)) random numbers
+    and skips over the items in between with islice.
+    """
+    rng = random.Random(seed)
+    iterator = iter(iterable)
+    # Keep (position, item) so the sample can be returned in stream order
+    reservoir = list(enumerate(islice(iterator, k)))
+    if len(reservoir) < k or k == 0:
+        return [item for i, item in reservoir]
+
+    position = k - 1
+    w = np.exp(np.log(rng.random()) / k)
+    while True:
+        skip = int(np.floor(np.log(rng.random()) / np.log(1 - w)))
+        position += skip + 1
+        item = next(islice(iterator, skip, None), _SENTINEL)
+        if item is _SENTINEL:
+            break
+        reservoir[rng.randrange(k)] = (position, item)
+        w *= np.exp(np.log(rng.random()) / k)
+
+    return [item for i, item in sorted(reservoir, key=lambda x: x[0])]
+
+
+def stratified_reservoir_sample(iterable, k, key, seed=None):
+    """
+    Draw a separate uniform random sample from every stratum of iterable, in
+    one pass.
+
+    Parameters
+    ----------
+    iterable : Iterable
+    k : Nonnegative integer or dict
+        Sample size per stratum.  If a dict, k[stratum] is the sample size
+        for stratum, and strata not in k are not sampled.
+    key : Function
+        key(item) is the stratum of item (e.g. its year).  Items with stratum
+        None are skipped.
+    seed : Hashable or None
+        The same seed (and iterable) gives the same sample.
+
+    Returns
+    -------
+    sample : Dict
+        sample[stratum] is the list of sampled items in that stratum, in the
+        order they appeared in iterable.
+    """
+    rng = random.Random(seed)
+    reservoirs = {}
+    counts = {}
+    for position, item in enumerate(iterable):
+        stratum = key(item)
+        if stratum is None:
+            continue
+        k_stratum = k.get(stratum, 0) if isinstance(k, dict) else k
+        if k_stratum == 0:
+            continue
+
+        reservoir = reservoirs.setdefault(stratum, [])
+        counts[stratum] = counts.get(stratum, 0) + 1
+        if len(reservoir) < k_stratum:
+            reservoir.append((position, item))
+        else:
+            j = rng.randrange(counts[stratum])
+            if j < k_stratum:
+                reservoir[j] = (position, item)
+
+    return {
+        stratum: [item for i, item in sorted(reservoir, key=lambda x: x[0])]
+        for stratum, reservoir in reservoirs.iteritems()}
+
+
+_SENTINEL = object()
+
+
+###############################################################################
+# Sharding
+###############################################################################
+
+
+def shard_hash(doc_id):
+    """
+    Stable 64 bit hash of str(doc_id).  Unlike the builtin hash, this is the
+    same on every machine and Python build.
+    """
+    return int(hashlib.md5(str(doc_id)).hexdigest()[:16], 16)
+
+
+def in_shard(doc_id, shard):
+    """
+    True if doc_id belongs to shard.
+
+    Parameters
+    ----------
+    doc_id : String or Integer
+    shard : Tuple (k, n)
+        Shard k out of n, with 0 <= k < n.  Every doc_id is in exactly one
+        of the shards (0, n),...,(n - 1, n).
+    """
+    k, n = shard
+
+    return shard_hash(doc_id) % n == k
+
+
+def parse_shard(shard_str):
+    """
+    Convert the string 'k/n' to the shard tuple (k, n).
+    """
+    try:
+        k, n = [int(item) for item in shard_str.split('/')]
+    except ValueError:
+        raise ValueError("shard must look like k/n, got %s" % shard_str)
+    if not 0 <= k < n:
+        raise ValueError("shard k/n must have 0 <= k < n, got %s" % shard_str)
+
+    return k, n
+
+
+class ShardManifest(object):
+    """
+    Summary of the doc_id written by one shard:  the shard (k, n), the
+    number of documents, and order independent checksums of their doc_id.
+
+    Manifests are small JSON files.  check_shard_manifests verifies that a
+    set of them is complete and (optionally) matches a reference manifest
+    for the whole corpus.
+    """
+    def __init__(self, shard=(0, 1)):
+        """
+        Parameters
+        ----------
+        shard : Tuple (k, n)
+            (0, 1) means the whole corpus.
+        """
+        self.shard = tuple(shard)
+        self.num_docs = 0
+        self.xor = 0
+        self.sum = 0
+
+    def add(self, doc_id):
+        """
+        Record that doc_id was written.
+        """
+        value = shard_hash(doc_id)
+        if value % self.shard[1] != self.shard[0]:
+            raise ValueError(
+                "doc_id %s is not in shard %s" % (doc_id, self.shard))
+        self.num_docs += 1
+        self.xor ^= value
+        self.sum = (self.sum + value) % 2**64
+
+    @classmethod
+    def from_doc_ids(cls, doc_ids, shard=(0, 1)):
+        manifest = cls(shard)
+        for doc_id in doc_ids:
+            manifest.add(doc_id)
+
+        return manifest
+
+    def to_dict(self):
+        return {
+            'shard': list(self.shard), 'num_docs': self.num_docs,
+            'xor': '%016x' % self.xor, 'sum': '%016x' % self.sum}
+
+    def save(self, savefile):
+        with smart_open(savefile, 'w') as f:
+            json.dump(self.to_dict(), f, sort_keys=True)
+            f.write('\n')
+
+    @classmethod
+    def load(cls, loadfile):
+        with smart_open(loadfile, 'r') as f:
+            manifest_dict = json.load(f)
+
+        manifest = cls(manifest_dict['shard'])
+        manifest.num_docs = manifest_dict['num_docs']
+        manifest.xor = int(manifest_dict['xor'], 16)
+        manifest.sum = int(manifest_dict['sum'], 16)
+
+        return manifest
+
+
+def check_shard_manifests(manifests, reference=None):
+    """
+    Check that manifests are exactly the shards (0, n),...,(n - 1, n) and,
+    if given, that together they cover the same doc_id as reference.
+
+    Parameters
+    ----------
+    manifests : Iterable over ShardManifest
+    reference : ShardManifest
+        Manifest of the whole corpus, e.g. from an unsharded run.
+
+    Returns
+    -------
+    combined : ShardManifest
+        The manifest (with shard (0, 1)) of all shards put together.
+
+    Raises
+    ------
+    ValueError if the check fails.
+    """
+    manifests = list(manifests)
+    if not manifests:
+        raise ValueError("No manifests given")
+
+    num_shards = manifests[0].shard[1]
+    shard_ids = sorted(manifest.shard for manifest in manifests)
+    expected = [(k, num_shards) for k in range(num_shards)]
+    if shard_ids != expected:
+        raise ValueError(
+            "Expected shards %s, got %s" % (expected, shard_ids))
+
+    combined = ShardManifest()
+    for manifest in manifests:
+        combined.num_docs += manifest.num_docs
+        combined.xor ^= manifest.xor
+        combined.sum = (combined.sum + manifest.sum) % 2**64
+
+    if reference is not None:
+        if combined.to_dict() != reference.to_dict():
+            raise ValueError(
+                "Shards %s do not match reference %s"
+                % (combined.to_dict(), reference.to_dict()))
+
+    return combined
+
+
+###############################################################################
+# Partitioned output
+###############################################################################
+
+
+class PartitionedWriter(object):
+    """
+    File-like object that sends every record (line) written to it to one of
+    many partition files, e.g. N shards for parallel trainers or one file per
+    year.  Pass it wherever an open outfile is expected.
+
+    Lines are buffered per partition and at most max_open files are open at
+    once (least recently used are closed and later reopened for appending),
+    so thousands of partitions do not exhaust file descriptors.
+
+    Examples
+    --------
+    >>> with PartitionedWriter('cables-{}.vw', hash_partitioner(8)) as f:
+    >>>     files_to_vw.tokenize(f, ...)
+    >>> f.paths
+    """
+    def __init__(
+        self, path_template, partitioner, get_doc_id=None, compress=None,
+        max_open=128, buffer_bytes=2**16, max_buffer_bytes=2**26):
+        """
+        Parameters
+        ----------
+        path_template : String
+            path_template.format(partition) is the path of a partition,
+            e.g. 'cables-{}.vw'.
+        partitioner : Function
+            partitioner(doc_id) returns the partition of a record.  See
+            round_robin_partitioner, hash_partitioner, key_partitioner.
+        get_doc_id : Function
+            get_doc_id(line) returns the doc_id of a record.  Defaults to
+            reading the tag of a VW formatted line.
+        compress : None or 'gz'
+            If 'gz', gzip every partition and append '.gz' to its path.
+        max_open : Integer
+            Maximum number of simultaneously open partition files.
+        buffer_bytes : Integer
+            Write a partition to disk once this many bytes are buffered.
+        max_buffer_bytes : Integer
+            Write every partition to disk once this many bytes are buffered
+            in total.
+        """
+        assert compress in (None, 'gz'), "compress must be None or 'gz'"
+        self.path_template = path_template
+        self.partitioner = partitioner
+        self.get_doc_id = get_doc_id if get_doc_id else _vw_doc_id
+        self.compress = compress
+        self.max_open = max_open
+        self.buffer_bytes = buffer_bytes
+        self.max_buffer_bytes = max_buffer_bytes
+
+        # {partition: path}, in order of first appearance
+        self.paths = OrderedDict()
+        self.counts = {}
+        self._buffers = {}
+        self._buffered = {}
+        self._total_buffered = 0
+        # Open files, least recently used first
+        self._open_files = OrderedDict()
+        # Partitions opened at least once
+        self._opened = set()
+
+    def write(self, line):
+        """
+        Write one complete record (line, including the newline).
+        """
+        partition = str(self.partitioner(self.get_doc_id(line)))
+        if partition not in self.paths:
+            path = self.path_template.format(partition.replace('/', '_'))
+            self.paths[partition] = path + ('.gz' if self.compress else '')
+            self.counts[partition] = 0
+            self._buffers[partition] = []
+            self._buffered[partition] = 0
+
+        self._buffers[partition].append(line)
+        self._buffered[partition] += len(line)
+        self._total_buffered += len(line)
+        self.counts[partition] += 1
+
+        if self._buffered[partition] >= self.buffer_bytes:
+            self._flush_partition(partition)
+        if self._total_buffered >= self.max_buffer_bytes:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _flush_partition(self, partition):
+        if not self._buffers[partition]:
+            return
+        f = self._open_files.pop(partition, None)
+        if f is None:
+            if len(self._open_files) >= self.max_open:
+                self._open_files.popitem(last=False)[1].close()
+            # Truncate on first open, append when reopened
+            mode = 'ab' if partition in self._opened else 'wb'
+            self._opened.add(partition)
+            if self.compress == 'gz':
+                # Reopening appends a gzip member, which gzip readers accept
+                f = gzip.open(self.paths[partition], mode)
+            else:
+                f = open(self.paths[partition], mode)
+        self._open_files[partition] = f
+
+        f.write(''.join(self._buffers[partition]))
+        self._total_buffered -= self._buffered[partition]
+        self._buffers[partition] = []
+        self._buffered[partition] = 0
+
+    def flush(self):
+        for partition in self._buffers:
+            self._flush_partition(partition)
+        for f in self._open_files.itervalues():
+            f.flush()
+
+    def close(self):
+        self.flush()
+        for f in self._open_files.itervalues():
+            f.close()
+        self._open_files = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+        return False
+
+
+def _vw_doc_id(line):
+    """
+    The doc_id (tag) of a VW formatted line, or None.
+    """
+    preamble = line[: line.index('|')]
+    if preamble and preamble[-1] != ' ':
+        return preamble[preamble.rfind(' ') + 1:]
+
+
+def round_robin_partitioner(num_partitions):
+    """
+    Returns a partitioner sending record i to partition i % num_partitions.
+    """
+    counter = count()
+
+    return lambda doc_id: next(counter) % num_partitions
+
+
+def hash_partitioner(num_partitions):
+    """
+    Returns a partitioner sending doc_id to partition
+    shard_hash(doc_id) % num_partitions, i.e. partition k holds shard
+    (k, num_partitions) (see in_shard).
+    """
+    return lambda doc_id: shard_hash(doc_id) % num_partitions
+
+
+def key_partitioner(key_map, default='unknown'):
+    """
+    Returns a partitioner sending doc_id to partition key_map[doc_id], or to
+    default if doc_id is not in key_map.
+    """
+    return lambda doc_id: key_map.get(doc_id, default)
+
+
+def read_key_map(meta_path, key, doc_id_col='doc_id', sep='|'):
+    """
+    Returns {doc_id: value of column key} from a delimited metadata file,
+    e.g. meta.csv as written by the scripts/*_to_text.py scripts.
+    """
+    with smart_open(meta_path, 'rb') as f:
+        reader = csv.DictReader(f, delimiter=sep)
+        return {row[doc_id_col]: row[key] for row in reader}
+
+
+def get_partitioner(
+    method, num_partitions=None, meta_path=None, key=None,
+    doc_id_col='doc_id', sep='|'):
+    """
+    Returns a partitioner for the command line options of files_to_vw.py and
+    filter_sfile.py.
+
+    Parameters
+    ----------
+    method : 'roundrobin', 'hash', or 'key'
+    num_partitions : Integer
+        For 'roundrobin' and 'hash'.
+    meta_path, key, doc_id_col, sep :
+        For 'key'.  See read_key_map.
+    """
+    if method == 'roundrobin':
+        return round_robin_partitioner(num_partitions)
+    elif method == 'hash':
+        return hash_partitioner(num_partitions)
+    elif method == 'key':
+        return key_partitioner(
+            read_key_map(meta_path, key, doc_id_col=doc_id_col, sep=sep))
+    else:
+        raise ValueError("Unknown partition method %s" % method)
+
+
+###############################################################################
+# Caching
+###############################################################################
+
+
+def approx_sizeof(obj):
+    """
+    Approximate memory footprint of obj in bytes, including the contents of
+    (nested) lists, tuples, and dicts.  Shared objects are counted every time
+    they appear, so this is an overestimate.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(approx_sizeof(item) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(
+            approx_sizeof(key) + approx_sizeof(value)
+            for key, value in obj.iteritems())
+
+    return size
+
+
+class SpillCache(object):
+    """
+    Append-only sequence that keeps (approximately) at most max_bytes in
+    memory.  Once the budget is exceeded, the in-memory items are pickled,
+    compressed, and appended to a temporary file.
+
+    Iterating gives every item appended so far, in order.  Appending and
+    iterating are thread safe.  The temporary file is removed when the cache
+    is closed or garbage collected.
+    """
+    def __init__(self, max_bytes=2**27, tmpdir=None, compresslevel=1):
+        """
+        Parameters
+        ----------
+        max_bytes : Integer
+            Memory budget, as measured by approx_sizeof.
+        tmpdir : String
+            Directory to spill to.  Defaults to the system temp dir.
+        compresslevel : Integer in 0,...,9
+            zlib compression level used for spilled blocks.
+        """
+        self.max_bytes = max_bytes
+        self.tmpdir = tmpdir
+        self.compresslevel = compresslevel
+
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._len = 0
+        self._spill_file = None
+        # (offset, length) of every spilled block
+        self._blocks = []
+        self._lock = threading.Lock()
+
+    def append(self, item):
+        with self._lock:
+            self._buffer.append(item)
+            self._buffer_bytes += approx_sizeof(item)
+            self._len += 1
+            if self._buffer_bytes > self.max_bytes:
+                self._spill()
+
+    def _spill(self):
+        """
+        Move the in-memory items to disk.  Call with self._lock held.
+        """
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(dir=self.tmpdir)
+
+        block = zlib.compress(
+            cPickle.dumps(self._buffer, 2), self.compresslevel)
+        self._spill_file.seek(0, 2)
+        self._blocks.append((self._spill_file.tell(), len(block)))
+        self._spill_file.write(block)
+
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    @property
+    def num_spilled_blocks(self):
+        return len(self._blocks)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        block_num = 0
+        while True:
+            with self._lock:
+                if block_num < len(self._blocks):
+                    offset, length = self._blocks[block_num]
+                    self._spill_file.seek(offset)
+                    block = self._spill_file.read(length)
+                else:
+                    block = None
+                    buffered = list(self._buffer)
+            if block is None:
+                break
+            for item in cPickle.loads(zlib.decompress(block)):
+                yield item
+            block_num += 1
+
+        for item in buffered:
+            yield item
+
+    def close(self):
+        """
+        Remove the spill file, if any.  The cache is unusable afterwards.
+        """
+        with self._lock:
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+            self._blocks = []
+            self._buffer = []
+
+    def __del__(self):
+        if getattr(self, '_spill_file', None) is not None:
+            self._spill_file.close()
+
+
+###############################################################################
+# Checkpointing
+###############################################################################
+
+
+class Checkpoint(object):
+    """
+    Resumable progress of a long chunked map (e.g. files_to_vw) stored in a
+    directory:
+
+        items           The items to process, one per line, written once so
+                        that every restart sees the same items in the same
+                        order (e.g. after a shuffle)
+        state.json      Settings and the list of completed segments
+        segment-N       Sealed output of chunk N
+
+    A segment is written to a temporary file and renamed when complete, so a
+    segment file exists iff its chunk was fully processed.  On restart,
+    run() skips those chunks.
+
+    Examples
+    --------
+    >>> checkpoint = Checkpoint('ckpt/', config={'tokenizer': 'basic'})
+    >>> paths = checkpoint.get_items(lambda: get_paths('bodyfiles/'))
+    >>> checkpoint.run(tokenize_chunk, paths, 'out.vw', chunksize=1000)
+    """
+    def __init__(self, checkpoint_dir, config=None):
+        """
+        Parameters
+        ----------
+        checkpoint_dir : String
+            Created if it does not exist.
+        config : Dict or None
+            JSON serializable settings of the run.  Resuming with different
+            settings raises a ValueError.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        # Round trip through JSON so e.g. tuples compare equal to lists
+        self.config = json.loads(json.dumps(config))
+
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+            if self.state['config'] != self.config:
+                raise ValueError(
+                    "Checkpoint %s was made with config %s, not %s" % (
+                        checkpoint_dir, self.state['config'], self.config))
+        else:
+            self.state = {
+                'config': self.config, 'chunksize': None,
+                'num_segments': None, 'completed': [], 'done': False}
+            self._save_state()
+
+    @property
+    def state_path(self):
+        return os.path.join(self.checkpoint_dir, 'state.json')
+
+    @property
+    def items_path(self):
+        return os.path.join(self.checkpoint_dir, 'items')
+
+    def segment_path(self, segment):
+        return os.path.join(self.checkpoint_dir, 'segment-%07d' % segment)
+
+    def _save_state(self):
+        _atomic_write(self.state_path, json.dumps(self.state, sort_keys=True))
+
+    def get_items(self, items):
+        """
+        Return the list of items of this run.  The first time, items are
+        taken from items and saved.  After that, the saved items are returned
+        and items is ignored.
+
+        Parameters
+        ----------
+        items : Iterable over strings, or function returning one
+            A trailing newline is stripped (other whitespace is kept).  A
+            function is only called if needed (e.g. to avoid a second crawl
+            of the files).
+        """
+        if os.path.exists(self.items_path):
+            with open(self.items_path) as f:
+                return [line.rstrip('\n') for line in f]
+
+        if callable(items):
+            items = items()
+        items = [
+            item[:-1] if item.endswith('\n') else item for item in items]
+        _atomic_write(self.items_path, ''.join(i + '\n' for i in items))
+
+        return items
+
+    def run(
+        self, func, items, outfile, chunksize=1000, n_jobs=1,
+        buffer_size=None, initializer=None, initargs=()):
+        """
+        Write func(chunk) for every chunk of items to a sealed segment,
+        skipping chunks sealed by previous runs, then concatenate the
+        segments to outfile.
+
+        Parameters
+        ----------
+        func : Function
+            func(chunk) returns the list of output lines (without newlines)
+            for a list of items.  Must be picklable if n_jobs > 1.
+        items : List
+            Must be the same every time this checkpoint is run, e.g. from
+            self.get_items.
+        outfile : filepath or buffer
+        chunksize : Integer
+            Number of items per segment.  Must be the same on every run.
+        n_jobs : Integer
+            Number of worker processes.  -1 means all available CPUs.
+        buffer_size : Integer
+            At most this many chunks are in flight.  Defaults to 2 * n_jobs.
+        initializer, initargs :
+            If given, every worker (or this process if n_jobs == 1) first
+            calls initializer(*initargs).
+
+        Returns
+        -------
+        stats : Dict
+            num_segments, num_resumed (sealed by previous runs) and
+            num_written (by this run).
+        """
+        num_segments = (len(items) + chunksize - 1) // chunksize
+        if self.state['chunksize'] is None:
+            self.state['chunksize'] = chunksize
+            self.state['num_segments'] = num_segments
+        elif (self.state['chunksize'], self.state['num_segments']) != (
+            chunksize, num_segments):
+            raise ValueError(
+                "Checkpoint %s has chunksize %s and %s segments, not %s and "
+                "%s" % (
+                    self.checkpoint_dir, self.state['chunksize'],
+                    self.state['num_segments'], chunksize, num_segments))
+
+        completed = set(
+            s for s in xrange(num_segments)
+            if os.path.exists(self.segment_path(s)))
+        num_resumed = len(completed)
+        self.state['completed'] = sorted(completed)
+        self._save_state()
+
+        tasks = (
+            (self.segment_path(s), items[s * chunksize: (s + 1) * chunksize])
+            for s in xrange(num_segments) if s not in completed)
+
+        n_jobs = get_num_jobs(n_jobs)
+        if n_jobs == 1:
+            _init_checkpoint_worker(func, initializer, initargs)
+            results_iterator = (_write_checkpoint_segment(t) for t in tasks)
+            pool = None
+        else:
+            pool = Pool(
+                n_jobs, _init_checkpoint_worker, (func, initializer, initargs))
+            results_iterator = bounded_imap(
+                pool, _write_checkpoint_segment, tasks,
+                buffer_size if buffer_size else 2 * n_jobs)
+
+        try:
+            for segment_path in results_iterator:
+                completed.add(int(segment_path.rsplit('-', 1)[1]))
+                self.state['completed'] = sorted(completed)
+                self._save_state()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        with smart_open(outfile, 'w') as open_outfile:
+            for s in xrange(num_segments):
+                with open(self.segment_path(s), 'rb') as f:
+                    # Line by line, so outfile may be a PartitionedWriter
+                    open_outfile.writelines(f)
+
+        self.state['done'] = True
+        self._save_state()
+
+        return {
+            'num_segments': num_segments, 'num_resumed': num_resumed,
+            'num_written': num_segments - num_resumed}
+
+    def remove(self):
+        """
+        Delete checkpoint_dir and everything in it.
+        """
+        shutil.rmtree(self.checkpoint_dir)
+
+
+# The function applied by Checkpoint.run workers.  Set once per worker.
+_checkpoint_worker_state = {}
+
+
+def _init_checkpoint_worker(func, initializer, initargs):
+    _checkpoint_worker_state['func'] = func
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _write_checkpoint_segment(task):
+    """
+    Write the output lines for task = (segment_path, chunk) and seal the
+    segment.  Returns segment_path.
+    """
+    segment_path, chunk = task
+    lines = _checkpoint_worker_state['func'](chunk)
+    _atomic_write(segment_path, ''.join(line + '\n' for line in lines))
+
+    return segment_path
+
+
+def _atomic_write(path, data):
+    """
+    Write data to path.  A reader (or a restart after a crash) sees either
+    the old file or the complete new one, never a partial one.
+    """
+    # One temporary file per process, so concurrent writers do not collide
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
 ###############################################################################
 # Shared abstract base classes
 ###############################################################################
@@ -100,6 +100,28 @@ class DBCONNECT(object):
             print 'Error details:'
             return e
 
+    def iter_query(self, sql, args=None):
+        """
+        Returns an iterator over the rows (as dicts) of the result of sql.
+
+        Uses an unbuffered server-side cursor, so rows are streamed from the
+        server rather than all fetched into memory.  Consume (or close) the
+        iterator before running another query on this connection.
+
+        Parameters
+        ----------
+        sql : string
+        args : tuple, list or dict
+            Passed to cursor.execute to be escaped into sql
+        """
+        cursor = self.conn.cursor(pymysql.cursors.SSDictCursor)
+        try:
+            cursor.execute(sql, args)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
     def __get_rows_by_idlist_iter(self, id_list, table_name, fields='*'):
         """
         Parameters
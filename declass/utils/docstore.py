@@ -0,0 +1,345 @@
+"""
+A packed document store:  one append-only data file holding every document
+(optionally compressed) plus an offset index keyed by doc_id.  Replaces
+corpora stored as one small file per document.
+
+Files making up the store at path:
+    path        The concatenated (compressed) documents
+    path.idx    One line per document:  doc_id<TAB>offset<TAB>length
+    path.meta   JSON with the compression settings
+    path.dict   The zstd compression dictionary (if any)
+"""
+import json
+import os
+import re
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import filefilter
+
+
+class DocStore(object):
+    """
+    Append documents to, and read documents from, a packed document store.
+
+    Examples
+    --------
+    >>> with DocStore('cables.pack', mode='a', compression='zlib') as store:
+    >>>     store.add('doc1', 'Some text')
+    >>> store = DocStore('cables.pack')
+    >>> store.get('doc1')
+    >>> for doc_id, text in store:
+    >>>     ...
+    """
+    def __init__(
+        self, path, mode='r', compression=None, zstd_dict=None, level=3,
+        buffering=2**22):
+        """
+        Parameters
+        ----------
+        path : String
+            Path to the data file.  The other files sit next to it.
+        mode : 'r' or 'a'
+            'r' to read, 'a' to append (creating the store if needed).
+        compression : None, 'zlib', or 'zstd'
+            Used only when creating a store.  An existing store keeps the
+            compression it was created with.  'zstd' requires the zstandard
+            package.
+        zstd_dict : String
+            Raw bytes of a zstd dictionary (see train_zstd_dict).  Used only
+            when creating a store with compression='zstd'.
+        level : Integer
+            Compression level.  Used only when creating a store.
+        buffering : Integer
+            Buffer size for reading the data file.  Large buffers turn
+            sequential iteration into a few large reads.
+        """
+        assert mode in ('r', 'a'), "mode must be 'r' or 'a'"
+        self.path = path
+        self.mode = mode
+        self.buffering = buffering
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        elif mode == 'a':
+            meta = {'compression': compression, 'level': level}
+            self._write_meta(meta, zstd_dict)
+        else:
+            raise IOError("No document store at %s" % path)
+
+        self.compression = meta['compression']
+        self.level = meta['level']
+        self._init_codec()
+        self._load_index(truncate=(mode == 'a'))
+
+        if mode == 'a':
+            self._data_file = open(self.path, 'ab')
+            self._index_file = open(self.index_path, 'ab')
+            self._data_file.seek(0, 2)
+            self._offset = self._data_file.tell()
+
+    @property
+    def index_path(self):
+        return self.path + '.idx'
+
+    @property
+    def meta_path(self):
+        return self.path + '.meta'
+
+    @property
+    def dict_path(self):
+        return self.path + '.dict'
+
+    def _write_meta(self, meta, zstd_dict):
+        if meta['compression'] not in (None, 'zlib', 'zstd'):
+            raise ValueError(
+                "compression %s not recognized" % meta['compression'])
+        if zstd_dict is not None:
+            with open(self.dict_path, 'wb') as f:
+                f.write(zstd_dict)
+        with open(self.meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def _init_codec(self):
+        if self.compression == 'zstd':
+            if zstandard is None:
+                raise ImportError(
+                    "compression='zstd' requires the zstandard package")
+            if os.path.exists(self.dict_path):
+                with open(self.dict_path, 'rb') as f:
+                    zstd_dict = zstandard.ZstdCompressionDict(f.read())
+            else:
+                zstd_dict = None
+            compressor = zstandard.ZstdCompressor(
+                level=self.level, dict_data=zstd_dict)
+            decompressor = zstandard.ZstdDecompressor(dict_data=zstd_dict)
+            self._compress = compressor.compress
+            self._decompress = decompressor.decompress
+        elif self.compression == 'zlib':
+            self._compress = lambda data: zlib.compress(data, self.level)
+            self._decompress = zlib.decompress
+        else:
+            self._compress = self._decompress = lambda data: data
+
+    def _load_index(self, truncate=False):
+        """
+        Set self._entries, a list of (doc_id, offset, length) in data file
+        order, and self._offsets = {doc_id: (offset, length)}.  If a doc_id
+        was added more than once, the last one wins.
+
+        A crash can leave a partial last line in the index.  It is ignored,
+        and if truncate, cut off so that later lines are appended cleanly.
+        """
+        entries = []
+        if os.path.exists(self.index_path):
+            complete_bytes = 0
+            with open(self.index_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    doc_id, offset, length = line[:-1].split('\t')
+                    entries.append((doc_id, int(offset), int(length)))
+                    complete_bytes += len(line)
+                partial = f.tell() != complete_bytes
+            if partial and truncate:
+                with open(self.index_path, 'r+b') as f:
+                    f.truncate(complete_bytes)
+
+        self._entries = entries
+        self._offsets = {
+            doc_id: (offset, length) for doc_id, offset, length in entries}
+
+    def add(self, doc_id, text):
+        """
+        Append one document.
+
+        Parameters
+        ----------
+        doc_id : String
+            Must not contain tabs or newlines.
+        text : String
+        """
+        assert self.mode == 'a', "Store not opened for appending"
+        doc_id = str(doc_id)
+        if re.search(r'[\t\n\r]', doc_id):
+            raise ValueError("doc_id %r contains whitespace" % doc_id)
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+
+        data = self._compress(text)
+        self._data_file.write(data)
+        # The data must reach the file before the index line pointing to it
+        self._data_file.flush()
+        self._index_file.write(
+            '%s\t%d\t%d\n' % (doc_id, self._offset, len(data)))
+        self._entries.append((doc_id, self._offset, len(data)))
+        self._offsets[doc_id] = (self._offset, len(data))
+        self._offset += len(data)
+
+    def get(self, doc_id):
+        """
+        Return the text of doc_id.  Raises KeyError if it is not stored.
+        """
+        offset, length = self._offsets[str(doc_id)]
+        self.flush()
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return self._decompress(f.read(length))
+
+    def iter_doc_id(self, doc_id):
+        """
+        Returns an iterator over (doc_id, text) for doc_id in doc_id, reading
+        in data file order.  Unknown doc_id raise KeyError.
+        """
+        locations = sorted(
+            self._offsets[str(doc)] + (str(doc),) for doc in doc_id)
+        self.flush()
+        with open(self.path, 'rb') as f:
+            for offset, length, doc in locations:
+                f.seek(offset)
+                yield doc, self._decompress(f.read(length))
+
+    def __iter__(self):
+        """
+        Iterate over (doc_id, text) for every (latest) document, in the order
+        added, with sequential reads.  Bytes not in the index (e.g. written
+        before a crash) are skipped.
+        """
+        self.flush()
+        with open(self.path, 'rb', self.buffering) as f:
+            for doc_id, offset, length in self._entries:
+                if f.tell() != offset:
+                    f.seek(offset)
+                data = f.read(length)
+                # Skip documents that were later re-added
+                if self._offsets[doc_id][0] == offset:
+                    yield doc_id, self._decompress(data)
+
+    def __contains__(self, doc_id):
+        return str(doc_id) in self._offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    @property
+    def doc_id(self):
+        """
+        All doc_id in the store, in the order added.
+        """
+        return [
+            doc_id for doc_id, offset, length in self._entries
+            if self._offsets[doc_id][0] == offset]
+
+    def flush(self):
+        if self.mode == 'a':
+            self._data_file.flush()
+            self._index_file.flush()
+
+    def close(self):
+        if self.mode == 'a':
+            self._data_file.close()
+            self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+        return False
+
+
+def train_zstd_dict(texts, dict_size=2**17):
+    """
+    Train a zstd dictionary on a sample of texts.  Since cables and other
+    declassified documents are very repetitive, a dictionary greatly improves
+    compression of individual documents.
+
+    Parameters
+    ----------
+    texts : Iterable over strings
+        The sample, e.g. a few thousand documents.
+    dict_size : Integer
+        Size of the dictionary in bytes.
+
+    Returns
+    -------
+    zstd_dict : String
+        Raw dictionary bytes, to pass to DocStore(zstd_dict=...)
+    """
+    if zstandard is None:
+        raise ImportError("train_zstd_dict requires the zstandard package")
+    samples = [
+        text.encode('utf-8') if isinstance(text, unicode) else text
+        for text in texts]
+
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+def pack_paths(
+    store_path, paths, name_strip=r'\..*', compression=None, level=3,
+    dict_sample_size=0, dict_size=2**17):
+    """
+    Bulk import the files in paths into a (new or existing) DocStore.
+
+    Parameters
+    ----------
+    store_path : String
+    paths : Iterable over paths
+    name_strip : raw string
+        Regex stripped from the filename to form the doc_id.  The default
+        matches TextFileStreamer.
+    compression : None, 'zlib', or 'zstd'
+    level : Integer
+        Compression level
+    dict_sample_size : Integer
+        If compression='zstd' and the store is new, train a dictionary on the
+        first dict_sample_size files.
+    dict_size : Integer
+        Size of the zstd dictionary in bytes.
+
+    Returns
+    -------
+    num_docs : Integer
+        Number of documents added.
+    """
+    regex = re.compile(name_strip)
+    paths = iter(paths)
+
+    # Files read to train the dictionary are kept for the first import
+    sample = []
+    zstd_dict = None
+    is_new = not os.path.exists(store_path + '.meta')
+    if is_new and compression == 'zstd' and dict_sample_size:
+        for path in paths:
+            path = path.strip()
+            with open(path, 'rb') as f:
+                sample.append((path, f.read()))
+            if len(sample) == dict_sample_size:
+                break
+        zstd_dict = train_zstd_dict(
+            [text for path, text in sample], dict_size=dict_size)
+
+    num_docs = 0
+    with DocStore(
+        store_path, mode='a', compression=compression, zstd_dict=zstd_dict,
+        level=level) as store:
+        for path, text in sample:
+            store.add(_path_to_doc_id(path, regex), text)
+            num_docs += 1
+        for path in paths:
+            path = path.strip()
+            with open(path, 'rb') as f:
+                store.add(_path_to_doc_id(path, regex), f.read())
+            num_docs += 1
+
+    return num_docs
+
+
+def _path_to_doc_id(path, regex):
+    return regex.sub('', filefilter.path_to_name(path, strip_ext=False))
@@ -1,22 +1,36 @@
-from fnmatch import fnmatch
+import cPickle
+from fnmatch import fnmatch, translate
+from itertools import imap, izip
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
 import re
+import sqlite3
 import sys
 import subprocess
+import tarfile
+import zipfile
 #import pdb 
 from numpy.random import rand
 from functools import partial
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from . import common
-from common import lazyprop
+from common import lazyprop, SaveLoad
 
 """
 Contains a collection of function that clean, decode and move files around.
 """
 
 def get_paths(base_path, file_type="*", relative=False, get_iter=False, 
-        limit=None):
+        limit=None, n_threads=1, manifest=None):
     """
     Crawls subdirectories and returns an iterator over paths to files that
     match the file_type.
@@ -33,9 +47,21 @@ def get_paths(base_path, file_type="*", relative=False, get_iter=False,
         If False, get absolute paths
     get_iter : Boolean
         If True, return an iterator over paths rather than a list.
+    n_threads : Integer
+        List this many directories concurrently.  Helps on network file
+        systems, where every directory listing costs a round trip.
+    manifest : String
+        Path to a PathManifest of base_path.  If it exists, only directories
+        whose mtime changed since it was written are listed again.  The
+        (updated) manifest is then saved there.  See PathManifest.
+
+    Notes
+    -----
+    Directories are crawled breadth first.
     """
     path_iter = _get_paths_iter(
-        base_path, file_type=file_type, relative=relative, limit=limit)
+        base_path, file_type=file_type, relative=relative, limit=limit,
+        n_threads=n_threads, manifest=manifest)
 
     if get_iter:
         return path_iter
@@ -43,19 +69,468 @@ def get_paths(base_path, file_type="*", relative=False, get_iter=False,
         return [path for path in path_iter]
 
 
-def _get_paths_iter(base_path, file_type="*", relative=False, limit=None):
-    counter=0
-    for path, subdirs, files in os.walk(base_path, followlinks=True):
-        for name in files:
-            if fnmatch(name.lower(), file_type):
-                if relative:
-                    path = path.replace(base_path, "")
-                    if path.startswith('/'):
-                        path = path[1:]
+def _get_paths_iter(
+    base_path, file_type="*", relative=False, limit=None, n_threads=1,
+    manifest=None):
+    # Compile the glob once rather than calling fnmatch on every name
+    match = re.compile(translate(file_type)).match
+
+    if manifest is not None:
+        dir_iter = PathManifest.update(
+            manifest, base_path, n_threads=n_threads).dirs
+    else:
+        dir_iter = _crawl(base_path, n_threads=n_threads)
+
+    counter = 0
+    for dirpath, (dir_mtime, subdirs, files) in dir_iter:
+        if relative:
+            dirpath = dirpath[len(base_path):].lstrip('/')
+        for name, size, mtime in files:
+            if match(name.lower()):
                 if counter == limit:
                     raise StopIteration
-                yield os.path.join(path, name)
-                counter+=1
+                yield os.path.join(dirpath, name)
+                counter += 1
+
+
+def _crawl(
+    base_path, n_threads=1, stat_files=False, previous=None,
+    restat_files=False):
+    """
+    Crawl base_path breadth first, yielding (dirpath, dir_info) for every
+    directory.  dir_info = (mtime, subdirs, files) where files is a list of
+    (name, size, mtime).  size and mtime are None unless stat_files.
+
+    Directories are listed in a pool of n_threads threads.  If previous (a
+    dict {dirpath: dir_info}) has an entry with the current mtime of a
+    directory, that entry is used without listing the directory (with
+    restat_files, its files are stat'ed again).  Unreadable directories are
+    skipped (as with os.walk).
+    """
+    scan = partial(
+        _scan_dir, stat_files=stat_files, previous=previous,
+        restat_files=restat_files)
+    pool = ThreadPool(n_threads) if n_threads > 1 else None
+
+    frontier = [base_path]
+    try:
+        while frontier:
+            if pool is not None:
+                dir_infos = common.bounded_imap(
+                    pool, scan, frontier, 4 * n_threads)
+            else:
+                dir_infos = imap(scan, frontier)
+
+            next_frontier = []
+            for dirpath, dir_info in izip(frontier, dir_infos):
+                if dir_info is None:
+                    continue
+                next_frontier.extend(
+                    os.path.join(dirpath, name) for name in dir_info[1])
+                yield dirpath, dir_info
+            frontier = next_frontier
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _scan_dir(dirpath, stat_files=False, previous=None, restat_files=False):
+    """
+    Return dir_info = (mtime, subdirs, files) for dirpath (see _crawl), or
+    None if dirpath cannot be read.
+    """
+    try:
+        dir_mtime = os.stat(dirpath).st_mtime
+        if previous is not None:
+            dir_info = previous.get(dirpath)
+            if (dir_info is not None) and (dir_info[0] == dir_mtime):
+                if not restat_files:
+                    return dir_info
+                # Same names, but files may have been modified in place
+                try:
+                    return dir_mtime, dir_info[1], [
+                        _stat_file(dirpath, name)
+                        for name, size, mtime in dir_info[2]]
+                except OSError:
+                    # A file vanished since the mtime check.  List again.
+                    pass
+
+        subdirs, files = [], []
+        if scandir is not None:
+            for entry in scandir(dirpath):
+                # Like os.walk(followlinks=True), follow links to directories
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif stat_files:
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime))
+                else:
+                    files.append((entry.name, None, None))
+        else:
+            for name in os.listdir(dirpath):
+                path = os.path.join(dirpath, name)
+                if os.path.isdir(path):
+                    subdirs.append(name)
+                elif stat_files:
+                    st = os.stat(path)
+                    files.append((name, st.st_size, st.st_mtime))
+                else:
+                    files.append((name, None, None))
+    except OSError:
+        return None
+
+    return dir_mtime, subdirs, files
+
+
+def _stat_file(dirpath, name):
+    st = os.stat(os.path.join(dirpath, name))
+
+    return name, st.st_size, st.st_mtime
+
+
+class PathManifest(SaveLoad):
+    """
+    Record of a directory tree:  every directory with its mtime and
+    subdirectories, and every file with its size and mtime.
+
+    Adding or removing a file changes the mtime of its directory, so a
+    manifest is brought up to date by listing only the directories whose
+    mtime changed.  Modifying a file in place does not change its directory,
+    so the recorded size and mtime of such a file go stale, unless
+    restat_files is set:  then every file is stat'ed again (in the same
+    thread pool), at about the cost of a full crawl.
+
+    Examples
+    --------
+    >>> manifest = PathManifest.update('bodyfiles.manifest', 'bodyfiles/')
+    >>> for path, size, mtime in manifest.iter_files():
+    >>>     ...
+    """
+    def __init__(
+        self, base_path, n_threads=1, previous=None, restat_files=False):
+        """
+        Crawl base_path.
+
+        Parameters
+        ----------
+        base_path : String
+        n_threads : Integer
+            List this many directories concurrently.
+        previous : PathManifest
+            Reuse the listings of directories unchanged since previous.
+        restat_files : Boolean
+            If True, stat the files of unchanged directories again, to catch
+            files modified in place.
+        """
+        self.base_path = base_path
+
+        if (previous is not None) and (previous.base_path == base_path):
+            previous_dirs = dict(previous.dirs)
+        else:
+            previous_dirs = {}
+
+        # List of (dirpath, (mtime, subdirs, files)), breadth first
+        self.dirs = list(_crawl(
+            base_path, n_threads=n_threads, stat_files=True,
+            previous=previous_dirs, restat_files=restat_files))
+        # Directories with added, removed or modified files
+        self.num_rescanned = sum(
+            1 for dirpath, dir_info in self.dirs
+            if previous_dirs.get(dirpath) != dir_info)
+
+    @classmethod
+    def update(cls, manifest_path, base_path, n_threads=1, restat_files=False):
+        """
+        Load the manifest at manifest_path (if it exists), bring it up to
+        date with base_path, save it, and return it.  See __init__.
+
+        The manifest is saved to a temporary file then renamed, so processes
+        sharing manifest_path never load a partial one.
+        """
+        previous = None
+        if os.path.exists(manifest_path):
+            previous = cls.load(manifest_path)
+        manifest = cls(
+            base_path, n_threads=n_threads, previous=previous,
+            restat_files=restat_files)
+        if (previous is None) or manifest.num_rescanned:
+            common._atomic_write(
+                manifest_path, cPickle.dumps(manifest, protocol=-1))
+
+        return manifest
+
+    def iter_files(self):
+        """
+        Returns an iterator over (path, size, mtime) for every file.
+        """
+        for dirpath, (dir_mtime, subdirs, files) in self.dirs:
+            for name, size, mtime in files:
+                yield os.path.join(dirpath, name), size, mtime
+
+    def __len__(self):
+        return sum(len(dir_info[2]) for dirpath, dir_info in self.dirs)
+
+
+class DocIdIndex(object):
+    """
+    Persistent doc_id -> path index of the files under base_path, stored in
+    an SQLite database.  Lookups use a B-tree index (O(log n)) and need no
+    crawl, and the database can be shared by many processes.
+
+    The index is brought up to date incrementally:  update() re-indexes only
+    directories whose mtime changed, using a PathManifest stored at
+    db_path + '.manifest'.
+
+    Examples
+    --------
+    >>> index = DocIdIndex('bodyfiles.db', 'bodyfiles/', file_type='*.txt')
+    >>> index.update()
+    >>> index['1976STATE012345']
+    >>> index.get_many(['1976STATE012345', '1976STATE012346'])
+    """
+    def __init__(
+        self, db_path, base_path=None, file_type=None, name_strip=None):
+        """
+        Parameters
+        ----------
+        db_path : String
+            Path to the SQLite database.  Created (empty, call update) if it
+            does not exist.
+        base_path : String
+            Directory to index.  Required when creating the index.
+        file_type : String
+            Index only files matching this glob (compared to the lowercased
+            filename).  Default '*'.
+        name_strip : String (Regex)
+            doc_id is the filename with this pattern stripped.  Default
+            r'\..*' (everything after the first period).
+
+        Settings that are None are read from an existing index.  Settings
+        that differ from those of an existing index raise a ValueError.
+        """
+        self.db_path = db_path
+        settings = {
+            'base_path': base_path, 'file_type': file_type,
+            'name_strip': name_strip}
+
+        # Check for, or create, the schema in one write transaction so that
+        # processes opening a new index at the same time do not race.
+        # sqlite3 commits implicitly before DDL, so manage it by hand.
+        conn = self._conn
+        conn.isolation_level = None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute(
+                "SELECT name FROM sqlite_master WHERE name = 'meta'"
+                ).fetchall():
+                stored = dict(conn.execute("SELECT key, value FROM meta"))
+                for key, value in settings.items():
+                    if value is None:
+                        settings[key] = stored[key]
+                if settings != stored:
+                    raise ValueError(
+                        "Index %s was built with %s, not %s" % (
+                            db_path, stored, settings))
+            else:
+                assert base_path is not None, (
+                    "Need base_path to create an index")
+                if file_type is None:
+                    settings['file_type'] = '*'
+                if name_strip is None:
+                    settings['name_strip'] = r'\..*'
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS meta (key TEXT, value TEXT)")
+                conn.executemany(
+                    "INSERT INTO meta VALUES (?, ?)", settings.items())
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS docs "
+                    "(doc_id TEXT, path TEXT, dir TEXT)")
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS docs_doc_id ON docs (doc_id)")
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS docs_dir ON docs (dir)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS dirs "
+                    "(dir TEXT PRIMARY KEY, mtime REAL)")
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.isolation_level = ''
+
+        self.base_path = settings['base_path']
+        self.file_type = settings['file_type']
+        self.name_strip = settings['name_strip']
+
+    @property
+    def _conn(self):
+        """
+        A connection for this process.  SQLite connections must not be
+        shared across a fork, so every process opens its own.
+
+        Text is stored as bytestrings, so paths need not be ASCII.
+        """
+        pid = os.getpid()
+        if self.__dict__.get('_conn_pid') != pid:
+            conn = sqlite3.connect(self.db_path)
+            conn.text_factory = str
+            self.__dict__['_connection'] = conn
+            self.__dict__['_conn_pid'] = pid
+
+        return self.__dict__['_connection']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_connection', None)
+        state.pop('_conn_pid', None)
+
+        return state
+
+    @property
+    def manifest_path(self):
+        return self.db_path + '.manifest'
+
+    def update(self, n_threads=1):
+        """
+        Bring the index up to date with the directory tree.
+
+        Parameters
+        ----------
+        n_threads : Integer
+            Crawl with this many threads.
+
+        Returns
+        -------
+        num_changed : Integer
+            Number of directories (re)indexed or removed.
+        """
+        manifest = PathManifest.update(
+            self.manifest_path, self.base_path, n_threads=n_threads)
+        match = re.compile(translate(self.file_type)).match
+        regex = re.compile(self.name_strip)
+
+        conn = self._conn
+        indexed = dict(conn.execute("SELECT dir, mtime FROM dirs"))
+        num_changed = 0
+        with conn:
+            for dirpath, (dir_mtime, subdirs, files) in manifest.dirs:
+                if indexed.pop(dirpath, None) == dir_mtime:
+                    continue
+                num_changed += 1
+                conn.execute("DELETE FROM docs WHERE dir = ?", (dirpath,))
+                conn.executemany(
+                    "INSERT INTO docs VALUES (?, ?, ?)",
+                    ((regex.sub('', name), os.path.join(dirpath, name),
+                        dirpath)
+                        for name, size, mtime in files
+                        if match(name.lower())))
+                conn.execute(
+                    "INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                    (dirpath, dir_mtime))
+            # Directories that no longer exist
+            for dirpath in indexed:
+                num_changed += 1
+                conn.execute("DELETE FROM docs WHERE dir = ?", (dirpath,))
+                conn.execute("DELETE FROM dirs WHERE dir = ?", (dirpath,))
+
+        return num_changed
+
+    def get(self, doc_id, default=None):
+        """
+        Return the path of doc_id, or default if it is not indexed.
+        """
+        if isinstance(doc_id, unicode):
+            doc_id = doc_id.encode('utf-8')
+        row = self._conn.execute(
+            "SELECT path FROM docs WHERE doc_id = ? LIMIT 1",
+            (str(doc_id),)).fetchone()
+
+        return row[0] if row is not None else default
+
+    def __getitem__(self, doc_id):
+        path = self.get(doc_id)
+        if path is None:
+            raise KeyError(doc_id)
+
+        return path
+
+    def get_many(self, doc_ids):
+        """
+        Return the list of paths of doc_ids.  Raises KeyError if one is not
+        indexed.
+        """
+        return [self[doc_id] for doc_id in doc_ids]
+
+    def __contains__(self, doc_id):
+        return self.get(doc_id) is not None
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+
+def get_doc_id_index(
+    db_path, base_path, file_type='*', name_strip=r'\..*', n_threads=1,
+    refresh=False):
+    """
+    Open the DocIdIndex at db_path, building it if it is new.  An existing
+    index is used as is (no crawl) unless refresh, in which case it is
+    brought up to date with base_path.
+    """
+    index = DocIdIndex(
+        db_path, base_path, file_type=file_type, name_strip=name_strip)
+    is_built = index._conn.execute("SELECT 1 FROM dirs LIMIT 1").fetchone()
+    if refresh or not is_built:
+        index.update(n_threads=n_threads)
+
+    return index
+
+
+def iter_archive(archive_path, file_type="*", limit=None):
+    """
+    Returns an iterator over (member_name, text) for the regular files in a
+    .tar, .tar.gz, .tar.bz2 or .zip archive, read in one sequential pass
+    without extracting anything to disk.
+
+    Parameters
+    ----------
+    archive_path : String
+    file_type : String
+        String to filter members with.  E.g. '*.txt'.  Note that the member
+        filenames will be converted to lowercase before this comparison.
+    limit : Integer
+        Yield at most this many members.
+    """
+    counter = 0
+    if zipfile.is_zipfile(archive_path):
+        archive = zipfile.ZipFile(archive_path)
+        try:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                name = path_to_name(info.filename, strip_ext=False)
+                if fnmatch(name.lower(), file_type):
+                    if counter == limit:
+                        raise StopIteration
+                    yield info.filename, archive.read(info)
+                    counter += 1
+        finally:
+            archive.close()
+    else:
+        # 'r|*' reads the (possibly compressed) tar as a stream, never seeking
+        archive = tarfile.open(archive_path, mode='r|*')
+        try:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                name = path_to_name(member.name, strip_ext=False)
+                if fnmatch(name.lower(), file_type):
+                    if counter == limit:
+                        raise StopIteration
+                    yield member.name, archive.extractfile(member).read()
+                    counter += 1
+        finally:
+            archive.close()
 
 
 def path_to_name(path, strip_ext=True):
@@ -117,7 +592,7 @@ class PathFinder(object):
     """
     def __init__(
         self, text_base_path=None, file_type='*', name_strip=r'\..*',
-        limit=None):
+        limit=None, crawl_threads=1, path_manifest=None, doc_id_index=None):
         """
         Parameters
         ----------
@@ -130,11 +605,23 @@ class PathFinder(object):
             Default pattern r'\..*' strips everything after the first period
         limit : Integer
             Limit the paths returned to this number
+        crawl_threads : Integer
+            Crawl with this many threads.  See get_paths.
+        path_manifest : String
+            Path to a PathManifest to reuse (and update).  See get_paths.
+        doc_id_index : String
+            Path to a DocIdIndex of text_base_path (built if it does not
+            exist).  If given, self[identifiers] looks paths up there rather
+            than crawling text_base_path.  Call DocIdIndex.update() after
+            files are added or removed.
         """
         self.text_base_path = text_base_path
         self.file_type = file_type
         self.name_strip = name_strip
         self.limit = limit
+        self.crawl_threads = crawl_threads
+        self.path_manifest = path_manifest
+        self.doc_id_index = doc_id_index
 
     @lazyprop
     def paths(self):
@@ -142,8 +629,9 @@ class PathFinder(object):
         Get all paths that we will use.
         """
         if self.text_base_path:
-            paths = filefilter.get_paths(
-                self.text_base_path, self.file_type, limit=self.limit)
+            paths = get_paths(
+                self.text_base_path, self.file_type, limit=self.limit,
+                n_threads=self.crawl_threads, manifest=self.path_manifest)
         else:
             paths = None
 
@@ -176,4 +664,13 @@ class PathFinder(object):
         if isinstance(identifiers, str):
             identifiers = [identifiers]
 
+        if self.doc_id_index:
+            return self._index.get_many(identifiers)
+
         return [self._doc_id_to_path[str(doc_id)] for doc_id in identifiers]
+
+    @lazyprop
+    def _index(self):
+        return get_doc_id_index(
+            self.doc_id_index, self.text_base_path, file_type=self.file_type,
+            name_strip=self.name_strip, n_threads=self.crawl_threads)
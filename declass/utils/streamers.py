@@ -1,14 +1,22 @@
 """
 Classes for streaming tokens/info from files/sparse files etc...
 """
+from array import array
 from collections import Counter
+import copy
+import cPickle
+from itertools import imap, islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import random
 from random import shuffle
 import re
-from functools import partial
+import sys
+from time import time
 
-from parallel_easy.base import imap_easy
+import numpy as np
 
-from . import filefilter, nlp, common, text_processors
+from . import docstore, filefilter, nlp, common, text_processors
 from text_processors import TokenizerBasic
 from common import lazyprop, smart_open
 
@@ -17,7 +25,8 @@ class BaseStreamer(object):
     """
     Base class...don't use this directly.
     """
-    def single_stream(self, item, cache_list=[], **kwargs):
+    def single_stream(
+        self, item, cache_list=None, cache_max_bytes=2**27, **kwargs):
         """
         Stream a single item from source.
 
@@ -26,25 +35,37 @@ class BaseStreamer(object):
         item : String
             The single item to pull from info and stream.
         cache_list : List of strings
-            Cache these items on every iteration
+            Cache these items on every iteration.  E.g. cache_list=['doc_id']
+            makes self.doc_id_cache hold the doc_id of every streamed item.
+        cache_max_bytes : Integer
+            Each cache holds about this many bytes in memory, then spills to
+            a temporary file.  See common.SpillCache.
         kwargs : Keyword args
             Passed on to self.info_stream
+
+        Notes
+        -----
+        Every call makes new caches, so concurrent streams do not share them.
+        The attributes self.<item>_cache refer to the caches of the most
+        recently started stream.
         """
         # Initialize the cached items as attributes
-        for cache_item in cache_list:
-            self.__dict__[cache_item + '_cache'] = []
+        caches = {}
+        for cache_item in (cache_list if cache_list else []):
+            caches[cache_item] = common.SpillCache(max_bytes=cache_max_bytes)
+            self.__dict__[cache_item + '_cache'] = caches[cache_item]
 
         # Iterate through self.info_stream and pull off required information.
         stream = self.info_stream(**kwargs)
         for i, info in enumerate(stream):
             if i == self.limit:
                 raise StopIteration
-            for cache_item in cache_list:
-                self.__dict__[cache_item + '_cache'].append(info[cache_item])
+            for cache_item, cache in caches.iteritems():
+                cache.append(info[cache_item])
 
             yield info[item]
 
-    def token_stream(self, cache_list=[], **kwargs):
+    def token_stream(self, cache_list=None, **kwargs):
         """
         Returns an iterator over tokens with possible caching of other info.
 
@@ -54,10 +75,30 @@ class BaseStreamer(object):
             Call self.token_stream('doc_id', 'tokens') to cache
             info['doc_id'] and info['tokens'] (assuming both are available).
         kwargs : Keyword args
-            Passed on to self.info_stream
+            Passed on to self.single_stream and then self.info_stream
         """
         return self.single_stream('tokens', cache_list=cache_list, **kwargs)
 
+    def to_vw(self, outfile, **kwargs):
+        """
+        Write the token counts of self.info_stream to a VW (Vowpal Wabbit)
+        formatted file.
+
+        Parameters
+        ----------
+        outfile : filepath or buffer
+        kwargs : Keyword args
+            Passed on to self.info_stream
+        """
+        formatter = text_processors.VWFormatter()
+
+        with smart_open(outfile, 'w') as open_outfile:
+            for info in self.info_stream(**kwargs):
+                tok_sstr = formatter.get_sstr(
+                    Counter(info['tokens']), importance=1,
+                    doc_id=info['doc_id'])
+                open_outfile.write(tok_sstr + '\n')
+
 
 class VWStreamer(BaseStreamer):
     """
@@ -65,7 +106,8 @@ class VWStreamer(BaseStreamer):
     preserve token order, all tokens are unordered.
     """
     def __init__(
-        self, sfile=None, cache_sfile=False, limit=None, shuffle=False):
+        self, sfile=None, cache_sfile=False, limit=None, shuffle=False,
+        use_index=False, shard=None, seed=None):
         """
         Parameters
         ----------
@@ -77,11 +119,25 @@ class VWStreamer(BaseStreamer):
             Only return this many results
         shuffle : Boolean
             If True, shuffle paths once (and only once) before streaming
+        use_index : Boolean
+            If True and sfile is a path, streaming by doc_id seeks to the
+            requested records using a text_processors.SFileIndex (stored at
+            sfile + '.idx' and rebuilt whenever sfile changes).  Off by
+            default, since it writes a file next to sfile.
+        shard : Tuple (k, n) or None
+            If given, stream only records whose doc_id is in shard k of n.
+            See common.in_shard.
+        seed : Integer or None
+            Seed for the shuffle.  The same seed (and sfile) gives the same
+            order.
         """
         self.sfile = sfile
         self.cache_sfile = cache_sfile
         self.limit = limit
         self.shuffle = shuffle
+        self.seed = seed
+        self.use_index = use_index
+        self.shard = shard
 
         self.formatter = text_processors.VWFormatter()
         
@@ -93,53 +149,198 @@ class VWStreamer(BaseStreamer):
             self.source = self._sfile_stream
 
     def _init_cached_stream(self):
-        records = {}
+        """
+        Cache the sfile as CSR arrays.  Row i holds the record with doc_id
+        self._doc_id_arr[i], its features are
+        self.vocab[self.indices[self.indptr[i]: self.indptr[i + 1]]] with
+        values self.values[self.indptr[i]: self.indptr[i + 1]].
+
+        If a doc_id appears more than once, only its last record is kept.
+        """
+        doc_id = []
+        importance = array('d')
+        target = array('d')
+        # Whether importance/target were parsed as int (rather than float)
+        importance_is_int = array('b')
+        target_is_int = array('b')
+        indptr = array('l', [0])
+        indices = array('l')
+        values = array('d')
+        token2idx = {}
+        values_are_int = True
+
         for record_dict in self._sfile_stream():
-            doc_id = record_dict['doc_id']
-            records[doc_id] = record_dict
+            doc_id.append(record_dict.get('doc_id', ''))
+            importance.append(record_dict.get('importance', np.nan))
+            target.append(record_dict.get('target', np.nan))
+            importance_is_int.append(
+                isinstance(record_dict.get('importance'), int))
+            target_is_int.append(isinstance(record_dict.get('target'), int))
+            for token, value in record_dict['feature_values'].iteritems():
+                indices.append(token2idx.setdefault(token, len(token2idx)))
+                values.append(value)
+                values_are_int = values_are_int and isinstance(value, int)
+            indptr.append(len(indices))
+
+        vocab = np.empty(len(token2idx), dtype=object)
+        for token, idx in token2idx.iteritems():
+            vocab[idx] = token
+
+        self._doc_id_arr = np.array(doc_id, dtype=object)
+        self.importance = np.frombuffer(importance, dtype=np.float64)
+        self.target = np.frombuffer(target, dtype=np.float64)
+        self._importance_is_int = np.frombuffer(
+            importance_is_int, dtype=np.int8).astype(bool)
+        self._target_is_int = np.frombuffer(
+            target_is_int, dtype=np.int8).astype(bool)
+        self.indptr = np.frombuffer(indptr, dtype=np.dtype('l'))
+        self.indices = np.frombuffer(indices, dtype=np.dtype('l')).astype(
+            np.min_scalar_type(max(len(vocab) - 1, 0)))
+        self.values = np.frombuffer(values, dtype=np.float64)
+        if values_are_int:
+            self.values = self.values.astype(np.int32)
+        self.vocab = vocab
+        self._drop_duplicate_rows()
+        self._doc_id_sorter = np.argsort(self._doc_id_arr, kind='mergesort')
 
-        # Set self.records and self.doc_id
-        self.records = records
-        doc_id = records.keys()
+        # Shuffling permutes the row indices, not the records
         if self.shuffle:
-            shuffle(doc_id)
-        self.doc_id = doc_id
+            self._row_order = np.random.RandomState(self.seed).permutation(
+                len(self._doc_id_arr))
+        else:
+            self._row_order = np.arange(len(self._doc_id_arr))
 
-    def _cached_stream(self, doc_id=None):
-        records = self.records
+    def _drop_duplicate_rows(self):
+        """
+        Keep only the last cached row of every (non-empty) doc_id.
+        """
+        num_rows = len(self._doc_id_arr)
+        _, last_reversed = np.unique(
+            self._doc_id_arr[::-1], return_index=True)
+        keep_row = np.zeros(num_rows, dtype=bool)
+        keep_row[num_rows - 1 - last_reversed] = True
+        keep_row[self._doc_id_arr == ''] = True
+        if keep_row.all():
+            return
+
+        row_lengths = np.diff(self.indptr)
+        keep_value = np.repeat(keep_row, row_lengths)
+        self.indptr = np.concatenate(
+            [[0], np.cumsum(row_lengths[keep_row])]).astype(self.indptr.dtype)
+        self.indices = self.indices[keep_value]
+        self.values = self.values[keep_value]
+        for name in [
+            '_doc_id_arr', 'importance', 'target', '_importance_is_int',
+            '_target_is_int']:
+            setattr(self, name, getattr(self, name)[keep_row])
+
+    @property
+    def doc_id(self):
+        """
+        The doc_id of the cached records (a list), in the order they are
+        streamed.
+        """
+        return self._doc_id_arr[self._row_order].tolist()
+
+    def _doc_id_to_row(self, doc):
+        """
+        Return the row index of the cached record with doc_id == doc.
+        """
+        doc = str(doc)
+        position = np.searchsorted(
+            self._doc_id_arr, doc, sorter=self._doc_id_sorter)
+        if position < len(self._doc_id_arr):
+            row = self._doc_id_sorter[position]
+            if self._doc_id_arr[row] == doc:
+                return row
+        raise KeyError(doc)
+
+    def get_features(self, row):
+        """
+        Return views (tokens, values) of the features in cached row.
+        """
+        row_slice = slice(self.indptr[row], self.indptr[row + 1])
+
+        return self.vocab[self.indices[row_slice]], self.values[row_slice]
+
+    def get_record_dict(self, row):
+        """
+        Reconstruct the record_dict of cached row.
+        """
+        tokens, values = self.get_features(row)
+        record_dict = {
+            'feature_values': dict(zip(tokens.tolist(), values.tolist()))}
+        if self._doc_id_arr[row]:
+            record_dict['doc_id'] = self._doc_id_arr[row]
+        for key in ['importance', 'target']:
+            value = getattr(self, key)[row]
+            if not np.isnan(value):
+                is_int = getattr(self, '_%s_is_int' % key)[row]
+                record_dict[key] = int(value) if is_int else float(value)
 
+        return record_dict
+
+    def _cached_stream(self, doc_id=None):
         if doc_id is None:
-            for i, doc in enumerate(self.doc_id):
-                record_dict = self.records[doc]
+            for i, row in enumerate(self._row_order):
                 if i == self.limit:
                     raise StopIteration
-                yield record_dict
+                yield self.get_record_dict(row)
         else:
             if (self.limit is not None) and self.cache_sfile:
                 raise ValueError(
                     "Cannot use both self.limit and doc_id with cached stream")
             for doc in doc_id:
-                yield records[doc]
+                yield self.get_record_dict(self._doc_id_to_row(doc))
 
     def _sfile_stream(self, doc_id=None):
         """
         Stream record_dict from an sfile that sits on disk.
         """
+        if (doc_id is not None) and self.use_index and isinstance(
+            self.sfile, basestring):
+            for record_dict in self._indexed_sfile_stream(doc_id):
+                yield record_dict
+            raise StopIteration
+
         # Open file if path.  If buffer or StringIO, passthrough.
         with common.smart_open(self.sfile, 'rb') as infile:
             if doc_id is not None:
                 doc_id = set(doc_id)
 
-            for i, line in enumerate(infile):
-                if i == self.limit:
+            num_yielded = 0
+            for line in infile:
+                if num_yielded == self.limit:
                     raise StopIteration
                 
                 record_dict = self.formatter.sstr_to_dict(line) 
                 if doc_id is not None:
                     if record_dict['doc_id'] not in doc_id:
                         continue
+                if not self._in_shard(record_dict):
+                    continue
+                num_yielded += 1
                 yield record_dict
 
+    def _indexed_sfile_stream(self, doc_id):
+        """
+        Stream record_dict for doc_id, seeking to each record with the index.
+        """
+        index = text_processors.SFileIndex.get(
+            self.sfile, formatter=self.formatter)
+        num_yielded = 0
+        for line in index.iter_lines(doc_id):
+            if num_yielded == self.limit:
+                raise StopIteration
+            record_dict = self.formatter.sstr_to_dict(line)
+            if self._in_shard(record_dict):
+                num_yielded += 1
+                yield record_dict
+
+    def _in_shard(self, record_dict):
+        return (self.shard is None) or common.in_shard(
+            record_dict.get('doc_id'), self.shard)
+
     def info_stream(self, doc_id=None):
         """
         Returns an iterator over info dicts.
@@ -158,13 +359,425 @@ class VWStreamer(BaseStreamer):
             yield record_dict
 
 
+class DBStreamer(BaseStreamer):
+    """
+    For streaming documents straight from a database table, e.g. the
+    statedeptcables, Document, or Kissinger tables, without first writing
+    one file per document.
+
+    Rows are read in batches ordered by an id column (keyset pagination:
+    each batch starts after the last id of the previous one), each batch
+    through an unbuffered server-side cursor when db is a DBCONNECT.
+    """
+    # Default (id_field, text_field, doc_id_field) for known tables
+    table_specs = {
+        'statedeptcables': ('DOCID', 'MSGTEXT', 'DOC_NBR'),
+        'Document': ('id', 'body', 'id'),
+        'Kissinger': ('doc_id', 'body', 'doc_id'),
+        }
+
+    def __init__(
+        self, db, table='statedeptcables', id_field=None, text_field=None,
+        doc_id_field=None, tokenizer=None, tokenizer_func=None, limit=None,
+        batch_size=1000, skip_empty_text=True, shard=None):
+        """
+        Parameters
+        ----------
+        db : database.DBCONNECT or DB-API 2.0 connection
+            E.g. a sqlite3 connection can stand in for MySQL when testing.
+        table : String
+            Table to stream from.
+        id_field : String
+            Unique, sortable column used for pagination.  Defaults to the
+            entry in self.table_specs.
+        text_field : String
+            Column holding the text.  Defaults to the entry in
+            self.table_specs.
+        doc_id_field : String
+            Column used to form the doc_id (spaces are replaced by
+            underscores).  Defaults to the entry in self.table_specs.
+        tokenizer : Subclass of BaseTokenizer
+            Should have a text_to_token_list method.  Try using MakeTokenizer
+            to convert a function to a valid tokenizer.
+        tokenizer_func : Function
+            Transforms a string (representing one document) to a list of
+            strings (the 'tokens').
+        limit : int or None
+            Limit for number of docs processed.
+        batch_size : Integer
+            Fetch this many rows per query.
+        skip_empty_text : Boolean
+            If True, do not stream rows with NULL or empty text.
+        shard : Tuple (k, n) or None
+            If given, stream only rows whose doc_id is in shard k of n.
+            See common.in_shard.
+        """
+        default_specs = self.table_specs.get(table, (None, None, None))
+        self.db = db
+        self.table = table
+        self.id_field = id_field if id_field else default_specs[0]
+        self.text_field = text_field if text_field else default_specs[1]
+        self.doc_id_field = (
+            doc_id_field if doc_id_field else default_specs[2])
+        self.limit = limit
+        self.batch_size = batch_size
+        self.skip_empty_text = skip_empty_text
+        self.shard = shard
+        self.tokenizer = tokenizer
+        self.tokenizer_func = tokenizer_func
+
+        for name in [
+            self.table, self.id_field, self.text_field, self.doc_id_field]:
+            if (name is None) or (not re.match(r'^\w+$', name)):
+                raise ValueError(
+                    "Table and field names must be alphanumeric, got %s"
+                    % name)
+
+        assert (tokenizer is None) or (tokenizer_func is None)
+        if tokenizer_func:
+            self.tokenizer = text_processors.MakeTokenizer(tokenizer_func)
+
+    @property
+    def _placeholder(self):
+        """
+        The parameter marker used by self.db, e.g. '%s' or '?'.
+        """
+        if hasattr(self.db, 'iter_query'):
+            return '%s'
+        module = sys.modules[type(self.db).__module__.split('.')[0]]
+        paramstyle = getattr(module, 'paramstyle', 'format')
+        if paramstyle == 'qmark':
+            return '?'
+        elif paramstyle in ('format', 'pyformat'):
+            return '%s'
+        else:
+            raise ValueError("paramstyle %s not supported" % paramstyle)
+
+    def _execute(self, sql, args):
+        """
+        Returns an iterator over rows (as dicts) of the result of sql.
+        """
+        if hasattr(self.db, 'iter_query'):
+            for row in self.db.iter_query(sql, args):
+                yield row
+        else:
+            cursor = self.db.cursor()
+            try:
+                cursor.execute(sql, args)
+                names = [item[0] for item in cursor.description]
+                for row in cursor:
+                    yield dict(zip(names, row))
+            finally:
+                cursor.close()
+
+    def _row_stream(self, doc_id=None, with_text=True):
+        """
+        Returns an iterator over rows with keys id_field, doc_id_field and
+        (if with_text) text_field.
+        """
+        fields = set([self.id_field, self.doc_id_field])
+        if with_text:
+            fields.add(self.text_field)
+        fields = ', '.join(sorted(fields))
+        select = "SELECT %s FROM %s" % (fields, self.table)
+        ph = self._placeholder
+
+        if doc_id is not None:
+            for doc_group in common.chunker(doc_id, self.batch_size):
+                sql = "%s WHERE %s IN (%s)" % (
+                    select, self.doc_id_field, ', '.join([ph] * len(doc_group)))
+                for row in self._execute(sql, tuple(doc_group)):
+                    yield row
+            raise StopIteration
+
+        last_id = None
+        while True:
+            if last_id is None:
+                sql = "%s ORDER BY %s LIMIT %d" % (
+                    select, self.id_field, self.batch_size)
+                args = ()
+            else:
+                sql = "%s WHERE %s > %s ORDER BY %s LIMIT %d" % (
+                    select, self.id_field, ph, self.id_field, self.batch_size)
+                args = (last_id,)
+
+            num_rows = 0
+            for row in self._execute(sql, args):
+                num_rows += 1
+                last_id = row[self.id_field]
+                yield row
+
+            if num_rows < self.batch_size:
+                raise StopIteration
+
+    def doc_id_stream(self):
+        """
+        Returns an iterator over the doc_id_field value of every row, without
+        reading any text.  Pass (a filtered version of) it to info_stream to
+        fetch only the text you need.  With a DBCONNECT, exhaust this
+        iterator (e.g. into a list) first:  rows stream through an
+        unbuffered cursor that must be consumed before the next query.
+        """
+        for row in self._row_stream(with_text=False):
+            yield row[self.doc_id_field]
+
+    def info_stream(self, doc_id=None, limit=None):
+        """
+        Returns an iterator over rows yielding dictionaries with keys 'text',
+        'doc_id', and (if self.tokenizer) 'tokens'.
+
+        Parameters
+        ----------
+        doc_id : iterable over strings or ints
+            Stream only rows with doc_id_field in this list
+        limit : Integer
+            Use limit in place of self.limit.
+        """
+        if limit is None:
+            limit = self.limit
+
+        num_yielded = 0
+        for row in self._row_stream(doc_id=doc_id):
+            if num_yielded == limit:
+                raise StopIteration
+
+            text = row[self.text_field]
+            if self.skip_empty_text and not text:
+                continue
+            row_doc_id = str(row[self.doc_id_field]).replace(' ', '_')
+            if (self.shard is not None) and not common.in_shard(
+                row_doc_id, self.shard):
+                continue
+
+            info_dict = {'text': text, 'doc_id': row_doc_id}
+            if self.tokenizer:
+                info_dict['tokens'] = self.tokenizer.text_to_token_list(text)
+
+            num_yielded += 1
+            yield info_dict
+
+
+class DocStoreStreamer(BaseStreamer):
+    """
+    For streaming from a packed docstore.DocStore.
+    """
+    def __init__(
+        self, store_path, tokenizer=None, tokenizer_func=None, limit=None,
+        shard=None):
+        """
+        Parameters
+        ----------
+        store_path : String
+            Path to the DocStore data file.
+        tokenizer : Subclass of BaseTokenizer
+            Should have a text_to_token_list method.  Try using MakeTokenizer
+            to convert a function to a valid tokenizer.
+        tokenizer_func : Function
+            Transforms a string (representing one document) to a list of
+            strings (the 'tokens').
+        limit : int or None
+            Limit for number of docs processed.
+        shard : Tuple (k, n) or None
+            If given, stream only documents whose doc_id is in shard k of n.
+            See common.in_shard.
+        """
+        self.store_path = store_path
+        self.limit = limit
+        self.shard = shard
+        self.tokenizer = tokenizer
+        self.tokenizer_func = tokenizer_func
+
+        assert (tokenizer is None) or (tokenizer_func is None)
+        if tokenizer_func:
+            self.tokenizer = text_processors.MakeTokenizer(tokenizer_func)
+
+    @lazyprop
+    def store(self):
+        return docstore.DocStore(self.store_path)
+
+    @property
+    def doc_id(self):
+        return self.store.doc_id
+
+    def info_stream(self, doc_id=None, limit=None):
+        """
+        Returns an iterator over documents yielding dictionaries with keys
+        'text', 'doc_id', and (if self.tokenizer) 'tokens'.
+
+        Parameters
+        ----------
+        doc_id : list of strings or ints
+            If given, fetch these documents (by seeking) rather than reading
+            the whole store sequentially.
+        limit : Integer
+            Use limit in place of self.limit.
+        """
+        if limit is None:
+            limit = self.limit
+
+        if doc_id is not None:
+            documents = self.store.iter_doc_id(doc_id)
+        else:
+            documents = iter(self.store)
+
+        if self.shard is not None:
+            documents = (
+                (doc, text) for doc, text in documents
+                if common.in_shard(doc, self.shard))
+
+        for doc, text in islice(documents, limit):
+            info_dict = {'text': text, 'doc_id': doc}
+            if self.tokenizer:
+                info_dict['tokens'] = self.tokenizer.text_to_token_list(text)
+
+            yield info_dict
+
+
+class ArchiveStreamer(BaseStreamer):
+    """
+    For streaming the text files inside .tar, .tar.gz, .tar.bz2 or .zip
+    archives, without extracting them.
+    """
+    def __init__(
+        self, archive_paths, file_type='*', name_strip=r'\..*',
+        tokenizer=None, tokenizer_func=None, limit=None, shard=None):
+        """
+        Parameters
+        ----------
+        archive_paths : String or list of strings
+            Path(s) to the archive(s).  Archives are read one after another,
+            each in a single sequential pass.
+        file_type : String
+            String to filter members with.  E.g. '*.txt'.  Note that the
+            member filenames will be converted to lowercase before this
+            comparison.
+        name_strip : raw string
+            Regex to strip doc_id (from the member filename, as in
+            TextFileStreamer).
+        tokenizer : Subclass of BaseTokenizer
+            Should have a text_to_token_list method.  Try using MakeTokenizer
+            to convert a function to a valid tokenizer.
+        tokenizer_func : Function
+            Transforms a string (representing one file) to a list of strings
+            (the 'tokens').
+        limit : int or None
+            Limit for number of docs processed.
+        shard : Tuple (k, n) or None
+            If given, use only members whose doc_id is in shard k of n.
+            See common.in_shard.
+        """
+        if isinstance(archive_paths, basestring):
+            archive_paths = [archive_paths]
+        self.archive_paths = archive_paths
+        self.file_type = file_type
+        self.name_strip = name_strip
+        self.limit = limit
+        self.shard = shard
+        self.tokenizer = tokenizer
+        self.tokenizer_func = tokenizer_func
+
+        assert (tokenizer is None) or (tokenizer_func is None)
+        if tokenizer_func:
+            self.tokenizer = text_processors.MakeTokenizer(tokenizer_func)
+
+    def _doc_stream(self, limit=None):
+        """
+        Returns an iterator over (doc_id, archive_path, member_name, text).
+        """
+        regex = re.compile(self.name_strip)
+        documents = (
+            (regex.sub('', filefilter.path_to_name(name, strip_ext=False)),
+                archive_path, name, text)
+            for archive_path in self.archive_paths
+            for name, text in filefilter.iter_archive(
+                archive_path, file_type=self.file_type))
+
+        if self.shard is not None:
+            documents = (
+                doc for doc in documents
+                if common.in_shard(doc[0], self.shard))
+
+        return islice(documents, limit)
+
+    def info_stream(self, limit=None):
+        """
+        Returns an iterator over archive members yielding dictionaries with
+        keys 'text', 'doc_id', 'archive_path', 'member_name', and
+        (if self.tokenizer) 'tokens'.
+
+        Parameters
+        ----------
+        limit : Integer
+            Use limit in place of self.limit.
+        """
+        if limit is None:
+            limit = self.limit
+
+        for doc_id, archive_path, name, text in self._doc_stream(limit):
+            info_dict = {
+                'text': text, 'doc_id': doc_id, 'archive_path': archive_path,
+                'member_name': name}
+            if self.tokenizer:
+                info_dict['tokens'] = self.tokenizer.text_to_token_list(text)
+
+            yield info_dict
+
+    def to_vw(self, outfile, n_jobs=1, chunksize=1000, buffer_size=None):
+        """
+        Write the archive members to a VW (Vowpal Wabbit) formatted file.
+
+        The archives are read sequentially by this process, and chunks of
+        (doc_id, text) are tokenized by n_jobs workers.
+
+        Parameters
+        ----------
+        outfile : filepath or buffer
+        n_jobs : Integer
+            Use n_jobs different jobs to do the processing.  Set = 4 for 4
+            jobs.  Set = -1 to use all available, -2 for all except 1,...
+        chunksize : Integer
+            Workers tokenize this many members at once.
+        buffer_size : Integer
+            At most this many chunks are in flight (submitted but not yet
+            written).  Defaults to 2 * n_jobs.
+        """
+        formatter = text_processors.VWFormatter()
+        n_jobs = common.get_num_jobs(n_jobs)
+
+        doc_group_iter = common.chunker(
+            ((doc_id, text) for doc_id, _, _, text in self._doc_stream(
+                self.limit)),
+            chunksize)
+
+        if n_jobs == 1:
+            _init_to_vw_worker(self, formatter)
+            results_iterator = imap(_worker_texts_to_sstr, doc_group_iter)
+            pool = None
+        else:
+            pool = Pool(n_jobs, _init_to_vw_worker, (self, formatter))
+            results_iterator = common.bounded_imap(
+                pool, _worker_texts_to_sstr, doc_group_iter,
+                buffer_size if buffer_size else 2 * n_jobs)
+
+        try:
+            with smart_open(outfile, 'w') as open_outfile:
+                for group_results in results_iterator:
+                    for sstr in group_results:
+                        open_outfile.write(sstr + '\n')
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+
 class TextFileStreamer(BaseStreamer):
     """
     For streaming from text files.
     """
     def __init__(
         self, text_base_path=None, file_type='*', name_strip=r'\..*', 
-        tokenizer=None, tokenizer_func=None, limit=None, shuffle=True):
+        tokenizer=None, tokenizer_func=None, limit=None, shuffle=True,
+        prefetch=0, shard=None, crawl_threads=1, path_manifest=None,
+        doc_id_index=None):
         """
         Parameters
         ----------
@@ -185,6 +798,26 @@ class TextFileStreamer(BaseStreamer):
             Limit for number of docs processed.
         shuffle : Boolean
             If True, shuffle paths once (and only once) before streaming
+        prefetch : Nonnegative integer
+            If > 0, read the next prefetch files concurrently in a pool of
+            prefetch threads.  Helps when file access latency (e.g. NFS)
+            rather than bandwidth limits throughput.  Yield order is
+            unchanged.
+        shard : Tuple (k, n) or None
+            If given, use only paths whose doc_id is in shard k of n.  Every
+            node can then process a disjoint part of the corpus without
+            coordination.  See common.in_shard.
+        crawl_threads : Integer
+            Crawl text_base_path with this many threads.  See
+            filefilter.get_paths.
+        path_manifest : String
+            Path to a filefilter.PathManifest of text_base_path.  Reused (and
+            updated) so that repeated runs need not crawl the whole tree.
+        doc_id_index : String
+            Path to a filefilter.DocIdIndex of text_base_path (built if it
+            does not exist).  If given, info_stream(doc_id=...) looks paths
+            up there rather than crawling text_base_path.  Call
+            DocIdIndex.update() after files are added or removed.
         """
         self.text_base_path = text_base_path
         self.file_type = file_type
@@ -193,6 +826,12 @@ class TextFileStreamer(BaseStreamer):
         self.tokenizer = tokenizer
         self.tokenizer_func = tokenizer_func
         self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.shard = shard
+        self.crawl_threads = crawl_threads
+        self.path_manifest = path_manifest
+        self.doc_id_index = doc_id_index
+        self.read_wait_time = 0.
 
         assert (tokenizer is None) or (tokenizer_func is None)
         if tokenizer_func:
@@ -205,7 +844,14 @@ class TextFileStreamer(BaseStreamer):
         """
         if self.text_base_path:
             paths = filefilter.get_paths(
-                self.text_base_path, file_type=self.file_type)
+                self.text_base_path, file_type=self.file_type,
+                n_threads=self.crawl_threads, manifest=self.path_manifest)
+            if self.shard is not None:
+                regex = re.compile(self.name_strip)
+                paths = [
+                    p for p in paths if common.in_shard(
+                        regex.sub('', filefilter.path_to_name(
+                            p, strip_ext=False)), self.shard)]
             if self.shuffle:
                 shuffle(paths)
             if self.limit:
@@ -235,6 +881,12 @@ class TextFileStreamer(BaseStreamer):
         """
         return dict(zip(self.doc_id, self.paths))
 
+    @lazyprop
+    def _index(self):
+        return filefilter.get_doc_id_index(
+            self.doc_id_index, self.text_base_path, file_type=self.file_type,
+            name_strip=self.name_strip, n_threads=self.crawl_threads)
+
     def info_stream(self, paths=None, doc_id=None, limit=None):
         """
         Returns an iterator over paths yielding dictionaries with information
@@ -251,27 +903,58 @@ class TextFileStreamer(BaseStreamer):
             limit = self.limit
 
         if doc_id is not None:
-            paths = [self._doc_id_to_path[str(doc)] for doc in doc_id]
+            if self.doc_id_index:
+                paths = self._index.get_many(doc_id)
+            else:
+                paths = [self._doc_id_to_path[str(doc)] for doc in doc_id]
         elif paths is None:            
             paths = self.paths
 
-        for index, onepath in enumerate(paths):
-            if index == limit:
-                raise StopIteration
-
-            with open(onepath, 'r') as f:
-                text = f.read()
-                doc_id = re.sub(self.name_strip, '', 
-                        filefilter.path_to_name(onepath, strip_ext=False))
-                info_dict = {'text': text, 'cached_path': onepath, 
-                        'doc_id': doc_id}
-                if self.tokenizer:
-                    info_dict['tokens'] = (
-                        self.tokenizer.text_to_token_list(text))
+        for onepath, text in self._text_stream(islice(paths, limit)):
+            doc_id = re.sub(self.name_strip, '', 
+                    filefilter.path_to_name(onepath, strip_ext=False))
+            info_dict = {'text': text, 'cached_path': onepath, 
+                    'doc_id': doc_id}
+            if self.tokenizer:
+                info_dict['tokens'] = (
+                    self.tokenizer.text_to_token_list(text))
 
             yield info_dict
 
-    def to_vw(self, outfile, n_jobs=1, chunksize=1000):
+    def _text_stream(self, paths):
+        """
+        Returns an iterator over (path, text) for path in paths, reading
+        ahead self.prefetch files if self.prefetch > 0.
+
+        Time spent waiting for text is accumulated in self.read_wait_time
+        (reset on every call).
+        """
+        self.read_wait_time = 0.
+        if self.prefetch:
+            pool = ThreadPool(self.prefetch)
+            texts = common.bounded_imap(
+                pool, _read_path, paths, self.prefetch)
+        else:
+            pool = None
+            texts = imap(_read_path, paths)
+
+        try:
+            while True:
+                t0 = time()
+                try:
+                    path_text = texts.next()
+                except StopIteration:
+                    break
+                finally:
+                    self.read_wait_time += time() - t0
+                yield path_text
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def to_vw(
+        self, outfile, n_jobs=1, chunksize=1000, buffer_size=None,
+        checkpoint_dir=None):
         """
         Write our filestream to a VW (Vowpal Wabbit) formatted file.
 
@@ -286,28 +969,279 @@ class TextFileStreamer(BaseStreamer):
             results to master.  If this is too low, communication overhead
             will dominate.  If this is too high, jobs will not be distributed
             evenly.
+        buffer_size : Integer
+            At most this many chunks are in flight (submitted but not yet
+            written).  Defaults to 2 * n_jobs.
+        checkpoint_dir : String
+            If given, record progress in this directory (see
+            common.Checkpoint) and write every chunk to a sealed segment
+            there, so an interrupted run resumes where it left off when
+            called again with the same checkpoint_dir and chunksize.  The
+            segments are concatenated to outfile at the end.
+
+        Notes
+        -----
+        Every worker receives a copy of this streamer (tokenizer and
+        settings, but not the path or doc_id lists) once, at startup.  After
+        that only chunks of paths are sent.  When n_jobs > 1,
+        self.to_vw_stats records the pickled size of that copy, the size
+        of this whole streamer (which would otherwise be sent with every
+        chunk), and the resulting number of bytes saved.
         """
         # Note:  This is similar to declass/cmd/files_to_vw.py
         # This implementation is more complicated, due to the fact that a
         # streamer specifies the method to extract doc_id from a stream.
         # To be faithful to the streamer, we must therefore use the streamer
-        # to stream the files.  This requires a combination of imap_easy and
-        # a chunker.
-        #
+        # to stream the files, and it is this streamer we send to workers.
+        formatter = text_processors.VWFormatter()
+        worker_streamer = self._worker_copy()
+        n_jobs = common.get_num_jobs(n_jobs)
+
+        if checkpoint_dir is not None:
+            checkpoint = common.Checkpoint(
+                checkpoint_dir,
+                config={
+                    'name_strip': self.name_strip, 'shard': self.shard,
+                    'text_base_path': self.text_base_path,
+                    'outfile': common.get_outfile_name(outfile)})
+            paths = checkpoint.get_items(lambda: self.paths)
+            self.to_vw_stats = checkpoint.run(
+                _worker_group_to_sstr, paths, outfile, chunksize=chunksize,
+                n_jobs=n_jobs, buffer_size=buffer_size,
+                initializer=_init_to_vw_worker,
+                initargs=(worker_streamer, formatter))
+            return
+
         # Create an iterator over chunks of paths
-        path_group_iter = common.grouper(self.paths, chunksize)
+        path_group_iter = common.chunker(self.paths, chunksize)
 
-        formatter = text_processors.VWFormatter()
+        if n_jobs == 1:
+            _init_to_vw_worker(worker_streamer, formatter)
+            results_iterator = imap(_worker_group_to_sstr, path_group_iter)
+            pool = None
+        else:
+            pool = Pool(
+                n_jobs, _init_to_vw_worker, (worker_streamer, formatter))
+            results_iterator = common.bounded_imap(
+                pool, _worker_group_to_sstr, path_group_iter,
+                buffer_size if buffer_size else 2 * n_jobs)
 
-        func = partial(_group_to_sstr, self, formatter)
-        # Process one group at a time...set imap_easy chunksize arg to 1
-        # since each group contains many paths.
-        results_iterator = imap_easy(func, path_group_iter, n_jobs, 1)
+        num_chunks = 0
+        try:
+            with smart_open(outfile, 'w') as open_outfile:
+                for group_results in results_iterator:
+                    num_chunks += 1
+                    for sstr in group_results:
+                        open_outfile.write(sstr + '\n')
+        finally:
+            if pool is not None:
+                pool.terminate()
 
-        with smart_open(outfile, 'w') as open_outfile:
-            for group_results in results_iterator:
-                for sstr in group_results:
-                    open_outfile.write(sstr + '\n')
+        if pool is not None:
+            worker_bytes = len(cPickle.dumps((worker_streamer, formatter), 2))
+            streamer_bytes = len(cPickle.dumps((self, formatter), 2))
+            self.to_vw_stats = {
+                'num_chunks': num_chunks, 'n_jobs': n_jobs,
+                'worker_init_bytes': worker_bytes,
+                'streamer_bytes': streamer_bytes,
+                'bytes_saved': (
+                    streamer_bytes * num_chunks - worker_bytes * n_jobs)}
+
+    def _worker_copy(self):
+        """
+        Return a shallow copy of self, without the (possibly huge) lazily
+        evaluated attributes such as self.paths and self.doc_id.
+        """
+        worker_streamer = copy.copy(self)
+        for key in worker_streamer.__dict__.keys():
+            if key.startswith('_lazy_'):
+                del worker_streamer.__dict__[key]
+
+        return worker_streamer
+
+
+class SampledTextFileStreamer(TextFileStreamer):
+    """
+    For streaming a uniform random sample of text files, drawn in one pass
+    over the directory tree without listing (and shuffling) every path.
+    """
+    def __init__(
+        self, text_base_path, sample_size, file_type='*', name_strip=r'\..*',
+        tokenizer=None, tokenizer_func=None, seed=None, strata=None,
+        shuffle=False, prefetch=0, shard=None, crawl_threads=1,
+        path_manifest=None):
+        """
+        Parameters
+        ----------
+        text_base_path : string
+            Base path to dir containing files.
+        sample_size : Nonnegative integer or dict
+            Number of files to sample.  With strata, the number of files
+            to sample per stratum, or a dict {stratum: number}.
+        seed : Hashable or None
+            The same seed (and directory tree) gives the same sample.
+        strata : Dict-like, Function, or None
+            If given, sample separately from every stratum.  The stratum of
+            a file is strata[doc_id] (e.g. a pandas Series of years indexed
+            by doc_id) or strata(doc_id).  Files with no stratum are skipped.
+        shuffle : Boolean
+            If True, shuffle the sample.  Otherwise it is streamed in crawl
+            order.
+        text_base_path, file_type, name_strip, tokenizer, tokenizer_func,
+        prefetch, shard, crawl_threads, path_manifest :
+            See TextFileStreamer.
+        """
+        TextFileStreamer.__init__(
+            self, text_base_path=text_base_path, file_type=file_type,
+            name_strip=name_strip, tokenizer=tokenizer,
+            tokenizer_func=tokenizer_func, shuffle=shuffle,
+            prefetch=prefetch, shard=shard, crawl_threads=crawl_threads,
+            path_manifest=path_manifest)
+        self.sample_size = sample_size
+        self.seed = seed
+        self.strata = strata
+
+    @lazyprop
+    def paths(self):
+        """
+        The sampled paths.
+        """
+        regex = re.compile(self.name_strip)
+        get_doc_id = lambda p: regex.sub(
+            '', filefilter.path_to_name(p, strip_ext=False))
+
+        paths = filefilter.get_paths(
+            self.text_base_path, file_type=self.file_type, get_iter=True,
+            n_threads=self.crawl_threads, manifest=self.path_manifest)
+        if self.shard is not None:
+            paths = (
+                p for p in paths if common.in_shard(get_doc_id(p), self.shard))
+
+        paths = _sample(
+            paths, self.sample_size, self.seed, self.strata, get_doc_id)
+        if self.shuffle:
+            random.Random(self.seed).shuffle(paths)
+
+        return paths
+
+
+class SampledVWStreamer(VWStreamer):
+    """
+    For streaming a uniform random sample of the records in a VW file, drawn
+    in one pass while holding only the sampled lines in memory.
+    """
+    def __init__(self, sfile, sample_size, seed=None, strata=None, shard=None):
+        """
+        Parameters
+        ----------
+        sfile : File path or buffer
+            Points to a sparse (VW) formatted file.
+        sample_size : Nonnegative integer or dict
+            Number of records to sample.  With strata, the number of records
+            to sample per stratum, or a dict {stratum: number}.
+        seed : Hashable or None
+            The same seed (and sfile) gives the same sample.
+        strata : Dict-like, Function, or None
+            If given, sample separately from every stratum.  The stratum of
+            a record is strata[doc_id] or strata(doc_id).  Records with no
+            stratum are skipped.
+        shard : Tuple (k, n) or None
+            If given, sample only records whose doc_id is in shard k of n.
+
+        Notes
+        -----
+        Streaming with doc_id reads the whole sfile, as with VWStreamer.
+        """
+        VWStreamer.__init__(self, sfile=sfile, shard=shard)
+        self.sample_size = sample_size
+        self.seed = seed
+        self.strata = strata
+
+    @lazyprop
+    def _sampled_lines(self):
+        preamble_char = self.formatter.preamble_char
+        get_doc_id = lambda line: self.formatter._parse_preamble(
+            line[: line.index(preamble_char)]).get('doc_id')
+
+        with common.smart_open(self.sfile, 'rb') as infile:
+            lines = (line for line in infile if line.strip())
+            if self.shard is not None:
+                lines = (
+                    line for line in lines
+                    if common.in_shard(get_doc_id(line), self.shard))
+
+            return _sample(
+                lines, self.sample_size, self.seed, self.strata, get_doc_id)
+
+    def _sfile_stream(self, doc_id=None):
+        """
+        Stream record_dict for the sampled records, or (if doc_id is given)
+        for doc_id.
+        """
+        if doc_id is not None:
+            for record_dict in VWStreamer._sfile_stream(self, doc_id=doc_id):
+                yield record_dict
+            raise StopIteration
+
+        for line in islice(self._sampled_lines, self.limit):
+            yield self.formatter.sstr_to_dict(line)
+
+
+def _sample(items, sample_size, seed, strata, get_doc_id):
+    """
+    Return a (possibly stratified) reservoir sample of items as a list.
+    See SampledTextFileStreamer.
+    """
+    if strata is None:
+        return common.reservoir_sample(items, sample_size, seed=seed)
+
+    if callable(strata):
+        key = lambda item: strata(get_doc_id(item))
+    else:
+        key = lambda item: strata.get(get_doc_id(item))
+    sample = common.stratified_reservoir_sample(
+        items, sample_size, key, seed=seed)
+
+    return [item for stratum in sorted(sample) for item in sample[stratum]]
+
+
+# The streamer and formatter used by to_vw workers.  Set once per worker
+# process by _init_to_vw_worker.
+_to_vw_worker_state = {}
+
+
+def _init_to_vw_worker(streamer, formatter):
+    _to_vw_worker_state['streamer'] = streamer
+    _to_vw_worker_state['formatter'] = formatter
+
+
+def _worker_group_to_sstr(path_group):
+    return _group_to_sstr(
+        _to_vw_worker_state['streamer'], _to_vw_worker_state['formatter'],
+        path_group)
+
+
+def _worker_texts_to_sstr(doc_group):
+    """
+    Return a list of sstr's, one for every (doc_id, text) in doc_group,
+    tokenized with the worker's streamer.tokenizer.
+    """
+    tokenizer = _to_vw_worker_state['streamer'].tokenizer
+    formatter = _to_vw_worker_state['formatter']
+
+    return [
+        formatter.get_sstr(
+            Counter(tokenizer.text_to_token_list(text)), importance=1,
+            doc_id=doc_id)
+        for doc_id, text in doc_group]
+
+
+def _read_path(path):
+    """
+    Return (path, text) where text is the contents of path.
+    """
+    with open(path, 'r') as f:
+        return path, f.read()
 
 
 def _group_to_sstr(streamer, formatter, path_group):
@@ -315,9 +1249,6 @@ def _group_to_sstr(streamer, formatter, path_group):
     Return a list of sstr's (sparse string representations).  One for every
     path in path_group.
     """
-    # grouper might append None to the last group if this one is shorter
-    path_group = (p for p in path_group if p is not None)
-
     group_results = []
 
     info_stream = streamer.info_stream(paths=path_group)
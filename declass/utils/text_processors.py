@@ -5,7 +5,9 @@ import zlib
 import random
 import copy
 import cPickle
+import os
 import re
+import warnings
 
 import nltk
 import numpy as np
@@ -489,6 +491,30 @@ class SFileFilter(SaveLoad):
         self.sfile_loaded = True
         self.collisions_resolved = False
 
+    def load_counts(self, token_score, doc_freq, num_docs):
+        """
+        Load token statistics computed elsewhere (e.g. from tokens held in
+        memory) rather than by parsing an sfile, building self.token2id.
+
+        Parameters
+        ----------
+        token_score : Dict
+            {token: total count of token}
+        doc_freq : Dict
+            {token: number of documents containing token}
+        num_docs : Integer
+        """
+        assert not self.sfile_loaded
+
+        hash_fun = self._get_hash_fun()
+        self.token2id = {token: hash_fun(token) for token in token_score}
+        self.token_score = defaultdict(float, token_score)
+        self.doc_freq = defaultdict(int, doc_freq)
+        self.num_docs = num_docs
+
+        self.sfile_loaded = True
+        self.collisions_resolved = False
+
     def _load_sfile_fwd(self, sfile):
         """
         Builds the "forward" objects involved in loading an sfile.
@@ -610,10 +636,13 @@ class SFileFilter(SaveLoad):
         self.bit_precision_required = int(np.ceil(np.log2(max_id)))
 
     def filter_sfile(
-        self, infile, outfile, doc_id_list=None, enforce_all_doc_id=True):
+        self, infile, outfile, doc_id_list=None, enforce_all_doc_id=True,
+        weighting=None, normalize=None, bm25_k1=1.2, bm25_b=0.75,
+        use_index=False):
         """
         Alter an sfile by converting tokens to id values, and removing tokens
-        not in self.token2id.  Optionally filters on doc_id.
+        not in self.token2id.  Optionally filters on doc_id and reweights
+        the feature values.
 
         Parameters
         ----------
@@ -624,6 +653,22 @@ class SFileFilter(SaveLoad):
         enforce_all_doc_id : Boolean
             If True (and doc_id is not None), raise exception unless all doc_id
             in doc_id_list are seen.
+        weighting : None, 'tfidf', 'sublinear_tf', or 'bm25'
+            None -> write the raw values (usually counts)
+            tfidf -> tf * idf
+            sublinear_tf -> (1 + log(tf)) * idf
+            bm25 -> Okapi BM25 term weight
+            See self.get_idf for the idf used with each scheme.
+        normalize : None, 'l1', or 'l2'
+            Normalize the (weighted) values of every record to unit length.
+        bm25_k1 : Nonnegative real
+            Term frequency saturation parameter for 'bm25'.
+        bm25_b : Real in [0, 1]
+            Document length normalization parameter for 'bm25'.
+        use_index : Boolean
+            If True, infile is a path to a VW file, and doc_id_list is given,
+            read only the requested records using an SFileIndex (built, and
+            saved at infile + '.idx', if needed).
         """
         assert self.sfile_loaded, "Must load an sfile before you can filter"
         if not hasattr(self, 'id2token'):
@@ -635,22 +680,116 @@ class SFileFilter(SaveLoad):
                 " self.save() before filtering")
 
         extra_filter = self._get_extra_filter(doc_id_list)
+        weighter = self._get_weighter(weighting, normalize, bm25_k1, bm25_b)
 
         with smart_open(infile) as f, smart_open(outfile, 'w') as g:
             # Each line represents one document
-            for line in f:
+            if (use_index and (doc_id_list is not None)
+                    and isinstance(infile, basestring)
+                    and isinstance(self.formatter, VWFormatter)):
+                lines = SFileIndex.get(
+                    infile, formatter=self.formatter).iter_lines(doc_id_list)
+            else:
+                lines = f
+            for line in lines:
                 record_dict = self.formatter.sstr_to_dict(line)
                 if extra_filter(record_dict):
-                    record_dict['feature_values'] = {
+                    record_dict['feature_values'] = weighter({
                         self.token2id[token]: value 
                         for token, value
                         in record_dict['feature_values'].iteritems() 
-                        if token in self.token2id}
+                        if token in self.token2id})
                     new_sstr = self.formatter.get_sstr(**record_dict)
                     g.write(new_sstr + '\n')
 
         self._done_check(enforce_all_doc_id)
 
+    def get_idf(self, weighting='tfidf'):
+        """
+        Return the inverse document frequency as a vector indexed by token id.
+
+        Parameters
+        ----------
+        weighting : 'tfidf', 'sublinear_tf', or 'bm25'
+            tfidf, sublinear_tf -> log((1 + num_docs) / (1 + doc_freq)) + 1
+            bm25 -> log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+        Returns
+        -------
+        idf : 1-D numpy array
+            idf[self.token2id[token]] is the idf of token.  Entries for ids
+            not in self.token2id are 0.  The length is one more than the
+            largest id, so compactify before calling this.
+        """
+        ids = np.array(self.token2id.values(), dtype=np.int64)
+        doc_freq = np.array(
+            [self.doc_freq[tok] for tok in self.token2id], dtype=float)
+        num_docs = float(self.num_docs)
+
+        if weighting in ('tfidf', 'sublinear_tf'):
+            values = np.log((1 + num_docs) / (1 + doc_freq)) + 1
+        elif weighting == 'bm25':
+            values = np.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+        else:
+            raise ValueError("weighting %s not recognized" % weighting)
+
+        idf = np.zeros(ids.max() + 1 if len(ids) else 0)
+        idf[ids] = values
+
+        return idf
+
+    def _get_weighter(self, weighting, normalize, bm25_k1, bm25_b):
+        """
+        Return a function that reweights one record's feature_values, a dict
+        {id: value}.  The idf vector and average document length are computed
+        once here, so each record costs one pass over its features.
+        """
+        if normalize not in (None, 'l1', 'l2'):
+            raise ValueError("normalize %s not recognized" % normalize)
+
+        if weighting is None:
+            weight_values = lambda ids, tf: tf
+        else:
+            idf = self.get_idf(weighting)
+            if weighting == 'tfidf':
+                weight_values = lambda ids, tf: tf * idf[ids]
+            elif weighting == 'sublinear_tf':
+                def weight_values(ids, tf):
+                    sublinear = np.zeros_like(tf)
+                    positive = tf > 0
+                    sublinear[positive] = 1 + np.log(tf[positive])
+                    return sublinear * idf[ids]
+            else:
+                # The average length of a document, counting only kept tokens
+                # (1 if no tokens were kept, to avoid dividing by zero)
+                avg_doc_len = (
+                    sum(self.token_score[tok] for tok in self.token2id)
+                    / float(max(self.num_docs, 1))) or 1
+                def weight_values(ids, tf):
+                    doc_len = tf.sum()
+                    denom = tf + bm25_k1 * (
+                        1 - bm25_b + bm25_b * doc_len / avg_doc_len)
+                    return idf[ids] * tf * (bm25_k1 + 1) / denom
+
+        def weighter(feature_values):
+            if (weighting is None and normalize is None) or not feature_values:
+                return feature_values
+            ids = np.fromiter(feature_values.iterkeys(), dtype=np.int64)
+            tf = np.fromiter(feature_values.itervalues(), dtype=float)
+            values = weight_values(ids, tf)
+            if normalize == 'l1':
+                norm = np.abs(values).sum()
+            elif normalize == 'l2':
+                norm = np.sqrt((values**2).sum())
+            else:
+                norm = 0
+            if norm > 0:
+                values = values / norm
+
+            return dict(zip(ids.tolist(), values.tolist()))
+
+        return weighter
+
     def _get_extra_filter(self, doc_id_list):
         self._doc_id_seen = set()
 
@@ -781,6 +920,310 @@ class SFileFilter(SaveLoad):
         SaveLoad.save(self, savepath, protocol=protocol)
 
 
+class SFileIndex(SaveLoad):
+    """
+    Sidecar index mapping doc_id to the (byte offset, length) of its record
+    in an sfile on disk.  Allows fetching records by doc_id with a seek
+    rather than a parse of the whole file.
+
+    The index is stored next to the sfile (at sfile + '.idx') and is rebuilt
+    whenever the size or modification time of the sfile changes.
+
+    Examples
+    --------
+    >>> index = SFileIndex.get('myfile.vw')
+    >>> for line in index.iter_lines(['doc1', 'doc2']):
+    >>>     print line
+    """
+    def __init__(self, sfile, formatter=None):
+        """
+        Parameters
+        ----------
+        sfile : File path
+            Points to a sparse formatted file.
+        formatter : Subclass of SparseFormatter
+            Used to read the doc_id from each record.  Defaults to VWFormatter.
+        """
+        self.sfile = sfile
+        self.formatter = formatter if formatter else VWFormatter()
+        self.build()
+
+    @classmethod
+    def get(cls, sfile, formatter=None, index_path=None):
+        """
+        Load the index for sfile, (re)building and saving it if it is missing,
+        stale, or cannot be loaded.  If the index cannot be saved (e.g. a
+        read-only directory), a warning is issued and the rebuilt index is
+        returned without saving.
+
+        The index is saved to a temporary file then renamed, so processes
+        sharing an sfile never load a partial index.
+
+        Parameters
+        ----------
+        sfile : File path
+        formatter : Subclass of SparseFormatter
+        index_path : File path
+            Where the index is stored.  Defaults to sfile + '.idx'
+        """
+        if index_path is None:
+            index_path = sfile + '.idx'
+
+        if os.path.exists(index_path):
+            try:
+                index = cls.load(index_path)
+            except Exception:
+                # E.g. a partial index left by an older version:  rebuild it
+                index = None
+            if (index is not None) and not index.is_stale():
+                return index
+
+        index = cls(sfile, formatter=formatter)
+        try:
+            common._atomic_write(index_path, cPickle.dumps(index, protocol=-1))
+        except (IOError, OSError) as e:
+            warnings.warn("Could not save the index of %s:  %s" % (sfile, e))
+
+        return index
+
+    def build(self):
+        """
+        Build the index with one pass through self.sfile.
+        """
+        offsets = {}
+        duplicates = defaultdict(list)
+        preamble_char = self.formatter.preamble_char
+        stat = os.stat(self.sfile)
+
+        with open(self.sfile, 'rb') as open_file:
+            offset = 0
+            for line in open_file:
+                # Only the preamble needs parsing to get the doc_id
+                end = line.find(preamble_char)
+                if end != -1:
+                    doc_id = self.formatter._parse_preamble(
+                        line[:end]).get('doc_id')
+                    if doc_id is not None:
+                        if doc_id in offsets:
+                            duplicates[doc_id].append((offset, len(line)))
+                        else:
+                            offsets[doc_id] = (offset, len(line))
+                offset += len(line)
+
+        self.offsets = offsets
+        self.duplicates = dict(duplicates)
+        self.sfile_size = stat.st_size
+        self.sfile_mtime = stat.st_mtime
+
+    def is_stale(self):
+        """
+        True if self.sfile changed (or vanished) since the index was built.
+        """
+        try:
+            stat = os.stat(self.sfile)
+        except OSError:
+            return True
+
+        return (
+            (stat.st_size != self.sfile_size)
+            or (stat.st_mtime != self.sfile_mtime))
+
+    def __contains__(self, doc_id):
+        return doc_id in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def iter_lines(self, doc_id):
+        """
+        Returns an iterator over the sfile lines with doc_id in doc_id.
+        Lines are returned in the order they appear in the sfile, and unseen
+        doc_id are skipped.
+
+        Parameters
+        ----------
+        doc_id : Iterable over strings
+        """
+        locations = []
+        for doc in set(doc_id):
+            if doc in self.offsets:
+                locations.append(self.offsets[doc])
+                locations.extend(self.duplicates.get(doc, []))
+        locations.sort()
+
+        with open(self.sfile, 'rb') as open_file:
+            for offset, length in locations:
+                open_file.seek(offset)
+                yield open_file.read(length)
+
+
+class SFileSegments(object):
+    """
+    An sfile kept as a directory of segments, for incremental updates.
+    Every update writes one new segment holding the records of added or
+    modified documents, plus a tombstone file listing deleted doc_id:
+
+        segment-N.vw            Records written by update N
+        segment-N.tombstones    doc_id deleted by update N, one per line
+        files.pkl               {path: (size, mtime, md5)} of the files
+                                that the segments represent
+
+    Segments are applied in order, tombstones before records, so the latest
+    update of a doc_id wins.  compact() merges everything into one sfile.
+    """
+    def __init__(self, directory, formatter=None):
+        """
+        Parameters
+        ----------
+        directory : String
+            Created if it does not exist.
+        formatter : Subclass of SparseFormatter
+            Used to read the doc_id from each record.  Defaults to VWFormatter.
+        """
+        self.directory = directory
+        self.formatter = formatter if formatter else VWFormatter()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @property
+    def files_path(self):
+        return os.path.join(self.directory, 'files.pkl')
+
+    def segment_path(self, num):
+        return os.path.join(self.directory, 'segment-%05d.vw' % num)
+
+    def tombstone_path(self, num):
+        return os.path.join(self.directory, 'segment-%05d.tombstones' % num)
+
+    @property
+    def segment_numbers(self):
+        numbers = [
+            int(name[len('segment-'): -len('.vw')])
+            for name in os.listdir(self.directory)
+            if name.startswith('segment-') and name.endswith('.vw')]
+
+        return sorted(numbers)
+
+    def load_files(self):
+        """
+        Return {path: (size, mtime, md5)} as of the last update ({} if none).
+        """
+        if os.path.exists(self.files_path):
+            return common.unpickleme(self.files_path)
+        else:
+            return {}
+
+    def add_segment(self, lines, tombstones, files):
+        """
+        Write a new segment and record the files it brings us up to date
+        with.
+
+        Parameters
+        ----------
+        lines : Iterable over strings
+            Records of added or modified documents (without newlines).
+        tombstones : Iterable over strings
+            doc_id of deleted documents.
+        files : Dict
+            {path: (size, mtime, md5)} after this update.
+
+        Returns
+        -------
+        num : Integer
+            Number of the new segment.
+        """
+        numbers = self.segment_numbers
+        num = numbers[-1] + 1 if numbers else 1
+
+        _write_then_rename(
+            self.tombstone_path(num), (t + '\n' for t in tombstones))
+        # A segment exists only once complete.  If we crash before saving
+        # files, the next update recomputes (and supersedes) this segment.
+        _write_then_rename(self.segment_path(num), (l + '\n' for l in lines))
+        common.pickleme(files, self.files_path + '.tmp')
+        os.rename(self.files_path + '.tmp', self.files_path)
+
+        return num
+
+    def _iter_segment(self, num):
+        """
+        Iterate over (doc_id, line) in segment num.
+        """
+        preamble_char = self.formatter.preamble_char
+        with open(self.segment_path(num), 'rb') as f:
+            for line in f:
+                preamble = line[: line.index(preamble_char)]
+                yield self.formatter._parse_preamble(preamble).get(
+                    'doc_id'), line
+
+    def _iter_tombstones(self, num):
+        path = self.tombstone_path(num)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    yield line.rstrip('\n')
+
+    def compact(self, outfile=None, in_place=False):
+        """
+        Write the current version of every document to outfile, in two passes
+        over the segments.
+
+        Parameters
+        ----------
+        outfile : filepath, buffer, or None
+        in_place : Boolean
+            If True, replace all segments by a single new segment holding the
+            compacted records.
+
+        Returns
+        -------
+        num_docs : Integer
+        """
+        numbers = self.segment_numbers
+
+        # Pass 1:  Find the (segment, line number) of the latest record of
+        # every live doc_id
+        latest = {}
+        for num in numbers:
+            for doc_id in self._iter_tombstones(num):
+                latest.pop(doc_id, None)
+            for i, (doc_id, line) in enumerate(self._iter_segment(num)):
+                latest[doc_id] = (num, i)
+        keep = set(latest.itervalues())
+
+        # Pass 2:  Write those records, in segment order
+        if outfile is not None:
+            with smart_open(outfile, 'w') as open_outfile:
+                open_outfile.writelines(self._iter_kept(numbers, keep))
+
+        if in_place:
+            new_num = numbers[-1] + 1 if numbers else 1
+            _write_then_rename(
+                self.segment_path(new_num), self._iter_kept(numbers, keep))
+            for num in numbers:
+                os.remove(self.segment_path(num))
+                if os.path.exists(self.tombstone_path(num)):
+                    os.remove(self.tombstone_path(num))
+
+        return len(latest)
+
+    def _iter_kept(self, numbers, keep):
+        for num in numbers:
+            for i, (doc_id, line) in enumerate(self._iter_segment(num)):
+                if (num, i) in keep:
+                    yield line
+
+
+def _write_then_rename(path, lines):
+    """
+    Write lines to path + '.tmp', then rename it to path.
+    """
+    with open(path + '.tmp', 'wb') as f:
+        for line in lines:
+            f.write(line)
+    os.rename(path + '.tmp', path)
+
+
 def collision_probability(vocab_size, bit_precision):
     """
     Approximate probability of at least one collision 
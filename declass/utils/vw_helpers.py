@@ -3,15 +3,18 @@ Wrappers to help with Vowpal Wabbit (VW).
 """
 import csv
 from collections import defaultdict
+import itertools
+import re
 import sys
 
+import numpy as np
 import pandas as pd
 
 from declass.utils import common, text_processors
 from common import smart_open
 
 
-def parse_varinfo(varinfo_file):
+def parse_varinfo(varinfo_file, top_k=None, chunksize=10**6, id2token=None):
     """
     Uses the output of the vw-varinfo utility to get a DataFrame with variable
     info.
@@ -20,38 +23,66 @@ def parse_varinfo(varinfo_file):
     ----------
     varinfo_file : Path or buffer
         The output of vw-varinfo
+    top_k : Integer
+        If given, keep only the top_k rows with largest absolute rel_score,
+        sorted by that.  The file is read chunksize rows at a time, so memory
+        stays bounded even for large (e.g. -b 24) models.
+    chunksize : Integer
+        With top_k, read this many rows at a time.
+    id2token : Dict or text_processors.SFileFilter
+        If given, add a 'token' column holding id2token[hash_val] (NaN if
+        hash_val is not in id2token).
     """
+    if isinstance(id2token, text_processors.SFileFilter):
+        id2token = id2token.id2token
+
     with smart_open(varinfo_file) as open_file:
-        # For some reason, pandas is confused...so just split the lines
-        # Create a dict {item1: [...], item2: [...],...} for each item in the
-        # header
-        header = open_file.next().split()
-        rows = {col_name: [] for col_name in header}
-        for line in open_file:
-            for i, item in enumerate(line.split()):
-                rows[header[i]].append(item)
-
-    # Create a data frame
-    varinfo = pd.DataFrame(rows)
-    # Format columns correctly
-    varinfo.FeatureName = varinfo.FeatureName.str.replace('^', '')
-    varinfo.HashVal = varinfo.HashVal.astype(int)
-    varinfo.MaxVal = varinfo.MaxVal.astype(float)
-    varinfo.MinVal = varinfo.MinVal.astype(float)
-    varinfo.RelScore = (
-        varinfo.RelScore.str.replace('%', '').astype(float) / 100)
-    varinfo.Weight = varinfo.Weight.astype(float)
-
-    # Rename columns to decent Python names
-    varinfo = varinfo.rename(
-        columns={'FeatureName': 'feature_name', 'HashVal': 'hash_val',
-            'MaxVal': 'max_val', 'MinVal': 'min_val', 'RelScore': 'rel_score',
-            'Weight': 'weight'}).set_index('hash_val')
+        # Feature names never contain whitespace, but the delimiter is a mix
+        # of tabs and spaces
+        reader = pd.read_csv(
+            open_file, delim_whitespace=True, quoting=csv.QUOTE_NONE,
+            dtype={'FeatureName': object, 'HashVal': np.int64,
+                   'MinVal': float, 'MaxVal': float, 'Weight': float,
+                   'RelScore': object},
+            chunksize=chunksize if top_k else None)
+        if top_k:
+            varinfo = None
+            for chunk in reader:
+                chunk = _format_varinfo(chunk)
+                if varinfo is not None:
+                    chunk = pd.concat([varinfo, chunk])
+                varinfo = chunk.loc[
+                    chunk.rel_score.abs().sort_values(
+                        ascending=False, kind='mergesort').index[:top_k]]
+        else:
+            varinfo = _format_varinfo(reader)
+
+    varinfo = varinfo.set_index('hash_val')
+    if id2token is not None:
+        varinfo['token'] = pd.Series(id2token).reindex(varinfo.index).values
 
     return varinfo
 
 
-def parse_lda_topics(topics_file, num_topics, normalize=True):
+def _format_varinfo(varinfo):
+    """
+    Format the columns of a raw vw-varinfo DataFrame, giving them decent
+    Python names.
+    """
+    varinfo = pd.DataFrame({
+        'feature_name': varinfo.FeatureName.str.replace('^', ''),
+        'hash_val': varinfo.HashVal.values,
+        'max_val': varinfo.MaxVal.values,
+        'min_val': varinfo.MinVal.values,
+        'rel_score': varinfo.RelScore.str.rstrip('%').astype(float) / 100,
+        'weight': varinfo.Weight.values})
+
+    return varinfo
+
+
+def parse_lda_topics(
+    topics_file, num_topics, normalize=True, dtype=np.float64, hash_vals=None,
+    chunk_bytes=2**24):
     """
     Returns a DataFrame representation of the topics output of an lda VW run.
 
@@ -64,38 +95,59 @@ def parse_lda_topics(topics_file, num_topics, normalize=True):
     normalize : Boolean
         Normalize the rows so that they represent probabilities of topic
         given hash_val
+    dtype : numpy dtype
+        Type of the topic weights.  np.float32 halves memory.
+    hash_vals : Iterable over integers, or text_processors.SFileFilter
+        If given, keep only rows with these hash values (e.g. the keys of
+        sfile_filter.id2token), so memory scales with the vocabulary rather
+        than 2^b.
+    chunk_bytes : Integer
+        Parse about this many bytes of the file at a time.
 
     Notes
     -----
     The trick is dealing with lack of a marker for the information printed
-    on top, and the inconsistant delimiter choice.
+    on top, and the inconsistant delimiter choice.  The header ends at the
+    first line that is an integer followed by num_topics numbers.  The rest
+    is parsed in chunks by numpy.
     """
-    topics = {'topic_%d' % i: [] for i in range(num_topics)}
-    topics['hash_val'] = []
-    # The topics file contains a bunch of informational printout stuff at
-    # the top.  Figure out what line this ends on
+    if isinstance(hash_vals, text_processors.SFileFilter):
+        hash_vals = hash_vals.id2token.keys()
+    if hash_vals is not None:
+        hash_vals = np.fromiter(hash_vals, dtype=np.int64)
+
+    row_re = re.compile(
+        r'^\s*\d+' + r'\s+[-+.\deE]+' * num_topics + r'\s*$')
+    hash_val_chunks, topic_chunks = [], []
+
     with smart_open(topics_file, 'r') as open_file:
-        # Once we detect that we're in the valid rows, there better not be
-        # any exceptions!
-        in_valid_rows = False
+        # Skip the header
+        first_rows = []
         for line in open_file:
-            try:
-                # If this row raises an exception, then it isn't a valid row
-                # Sometimes trailing space...that's the reason for split()
-                # rather than csv.reader or a direct pandas read.
-                split_line = line.split()
-                hash_val = int(split_line[0])
-                topic_weights = [float(item) for item in split_line[1:]]
-                assert len(topic_weights) == num_topics
-                for i, weight in enumerate(topic_weights):
-                    topics['topic_%d' % i].append(weight)
-                topics['hash_val'].append(hash_val)
-                in_valid_rows = True
-            except (ValueError, IndexError, AssertionError):
-                if in_valid_rows:
-                    raise
-
-    topics = pd.DataFrame(topics).set_index('hash_val')
+            if row_re.match(line):
+                first_rows.append(line)
+                break
+
+        chunks = iter(lambda: open_file.readlines(chunk_bytes), [])
+        for lines in itertools.chain([first_rows], chunks):
+            # Parse as float64, so large hash values keep their precision
+            block = np.fromstring(''.join(lines), dtype=np.float64, sep=' ')
+            if block.size % (num_topics + 1):
+                raise ValueError(
+                    "Found a row without %d topics after the header"
+                    % num_topics)
+            block = block.reshape(-1, num_topics + 1)
+            chunk_hash_vals = block[:, 0].astype(np.int64)
+            if hash_vals is not None:
+                keep = np.in1d(chunk_hash_vals, hash_vals)
+                block, chunk_hash_vals = block[keep], chunk_hash_vals[keep]
+            hash_val_chunks.append(chunk_hash_vals)
+            topic_chunks.append(block[:, 1:].astype(dtype))
+
+    topics = pd.DataFrame(
+        np.concatenate(topic_chunks),
+        index=pd.Index(np.concatenate(hash_val_chunks), name='hash_val'),
+        columns=['topic_%d' % i for i in range(num_topics)])
     if normalize:
         topics = topics.div(topics.sum(axis=1), axis=0)
 
@@ -176,6 +228,164 @@ def parse_lda_predictions(
     return predictions
 
 
+def find_start_offset_lda_predictions(predictions_file, block_bytes=2**20):
+    """
+    Return the byte offset of the start of the last set of predictions in
+    predictions_file.  Like find_start_line_lda_predictions, but reads
+    backward from the end of the file, so only the last pass is read.
+
+    Parameters
+    ----------
+    predictions_file : filepath or seekable buffer
+        The -p output of a VW lda run
+    block_bytes : Integer
+        Read backward this many bytes at a time.
+    """
+    with smart_open(predictions_file, 'rb') as open_file:
+        open_file.seek(0)
+        first_doc_id = open_file.readline().split()[-1]
+        open_file.seek(0, 2)
+        pos = open_file.tell()
+
+        # carry holds the (partial) line straddling two blocks
+        carry = ''
+        while pos > 0:
+            read_start = max(0, pos - block_bytes)
+            open_file.seek(read_start)
+            data = open_file.read(pos - read_start) + carry
+            # Unless at the start of the file, the first line may be partial
+            if read_start > 0:
+                newline = data.find('\n')
+                if newline == -1:
+                    # Still inside one line:  keep reading backward
+                    carry = data
+                    pos = read_start
+                    continue
+                lines_start = newline + 1
+            else:
+                lines_start = 0
+            line_starts = []
+            offset = read_start + lines_start
+            for line in data[lines_start:].split('\n'):
+                line_starts.append((offset, line))
+                offset += len(line) + 1
+            for offset, line in reversed(line_starts):
+                if (first_doc_id in line) and (
+                    line.split()[-1] == first_doc_id):
+                    return offset
+            carry = data[:lines_start]
+            pos = read_start
+
+    return 0
+
+
+def load_lda_predictions(
+    predictions_file, num_topics, normalize=True, dtype=np.float64,
+    all_passes_file=None, chunk_bytes=2**24):
+    """
+    Return a DataFrame representation of the last pass in a VW prediction
+    file.  The start of the last pass is found by seeking backward from the
+    end (see find_start_offset_lda_predictions), then only that block is
+    parsed, in chunks, into a numpy matrix.
+
+    Parameters
+    ----------
+    predictions_file : filepath or seekable buffer
+        The -p output of a VW lda run
+    num_topics : Integer
+        The number of topics you should see
+    normalize : Boolean
+        Normalize the rows so that they represent probabilities of topic
+        given doc_id.
+    dtype : numpy dtype
+        Type of the topic weights.
+    all_passes_file : filepath
+        If given, also save every pass to this .npy file, an array of shape
+        (num_passes, num_docs, num_topics) written chunk by chunk.  Load it
+        with np.load(all_passes_file, mmap_mode='r') to study convergence.
+    chunk_bytes : Integer
+        Parse about this many bytes of the file at a time.
+    """
+    start_offset = find_start_offset_lda_predictions(predictions_file)
+
+    doc_id, topic_chunks = [], []
+    with smart_open(predictions_file, 'rb') as open_file:
+        open_file.seek(start_offset)
+        for lines in iter(lambda: open_file.readlines(chunk_bytes), []):
+            chunk_doc_id, chunk_topics = _parse_prediction_lines(
+                lines, num_topics, dtype)
+            doc_id.extend(chunk_doc_id)
+            topic_chunks.append(chunk_topics)
+
+    predictions = pd.DataFrame(
+        np.concatenate(topic_chunks), index=pd.Index(doc_id, name='doc_id'),
+        columns=['topic_%d' % i for i in range(num_topics)])
+
+    if all_passes_file is not None:
+        _save_all_passes(
+            predictions_file, all_passes_file, len(doc_id), num_topics, dtype,
+            chunk_bytes)
+
+    if normalize:
+        predictions = predictions.div(predictions.sum(axis=1), axis=0)
+
+    return predictions
+
+
+def _parse_prediction_lines(lines, num_topics, dtype):
+    """
+    Returns (doc_id, topics) for prediction lines, with doc_id a list and
+    topics a numpy array of shape (number of non-blank lines, num_topics).
+    """
+    rows = [line.split() for line in lines if line.strip()]
+    for row in rows:
+        if len(row) != num_topics + 1:
+            raise ValueError(
+                "Expected lines of %d topics + a doc_id, got %s.  Is "
+                "num_topics correct?" % (num_topics, ' '.join(row)))
+    items = np.array(rows, dtype=str).reshape(-1, num_topics + 1)
+
+    return items[:, -1].tolist(), items[:, :-1].astype(dtype)
+
+
+def _save_all_passes(
+    predictions_file, all_passes_file, num_docs, num_topics, dtype,
+    chunk_bytes):
+    """
+    Write every pass of predictions_file to a .npy file of shape
+    (num_passes, num_docs, num_topics), one chunk at a time.
+    """
+    with smart_open(predictions_file, 'rb') as open_file:
+        open_file.seek(0, 2)
+        size = open_file.tell()
+        open_file.seek(0)
+        num_rows = sum(block.count('\n') for block in iter(
+            lambda: open_file.read(chunk_bytes), ''))
+        # The last line may lack a newline
+        open_file.seek(max(0, size - 1))
+        if size and open_file.read(1) != '\n':
+            num_rows += 1
+        if num_rows % num_docs:
+            raise ValueError(
+                "%d rows is not a whole number of passes over %d documents"
+                % (num_rows, num_docs))
+
+        all_passes = np.lib.format.open_memmap(
+            all_passes_file, mode='w+', dtype=dtype,
+            shape=(num_rows // num_docs, num_docs, num_topics))
+        rows = all_passes.reshape(-1, num_topics)
+
+        open_file.seek(0)
+        row = 0
+        for lines in iter(lambda: open_file.readlines(chunk_bytes), []):
+            _, chunk_topics = _parse_prediction_lines(lines, num_topics, dtype)
+            rows[row: row + len(chunk_topics)] = chunk_topics
+            row += len(chunk_topics)
+
+        all_passes.flush()
+        del all_passes
+
+
 class LDAResults(object):
     """
     Facilitates working with results of VW lda runs.
@@ -210,15 +420,14 @@ class LDAResults(object):
         self.sfile_frame = sfile_filter.to_frame()
 
         # Load the topics file
-        topics = parse_lda_topics(topics_file, num_topics, normalize=False)
+        topics = parse_lda_topics(
+            topics_file, num_topics, normalize=False, hash_vals=sfile_filter)
         topics = topics.reindex(index=sfile_filter.id2token.keys())
         topics = topics.rename(index=sfile_filter.id2token)
 
-        # Load the predictions
-        start_line = find_start_line_lda_predictions(
-            predictions_file, num_topics)
-        predictions = parse_lda_predictions(
-            predictions_file, num_topics, start_line, normalize=False)
+        # Load the last pass of predictions
+        predictions = load_lda_predictions(
+            predictions_file, num_topics, normalize=False)
 
         # Set probabilities
         self._set_probabilities(topics, predictions)
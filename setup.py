@@ -11,6 +11,7 @@ setup(
     name=DISTNAME,
     version='0.1',
     packages=['declass',],
+    scripts=['scripts/declass-pipeline'],
     license=LICENSE,
     url=URL,
     maintainer_email=EMAIL,